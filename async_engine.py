@@ -0,0 +1,247 @@
+"""Concurrent batch submission and result downloads on AsyncAnthropic.
+
+The engine runs an asyncio event loop in a background thread. Callers in
+the UI or the monitor hand it work and get a concurrent.futures.Future back,
+so they never wait on the network themselves. At most ASYNC_CONCURRENCY API
+calls run at once. Downloaded results go through a bounded queue to a single
+writer, so downloads slow down when the local store cannot keep up, and
+memory stays bounded however many results are in flight.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import anthropic
+
+from ingestion import RECONCILE_PAGE_SIZE, reconcile_timed_out_create, record_submission
+from request_cache import split_cached, evict
+from result_store import RESULTS_CHUNK_SIZE, INGEST_LATENCY, count_results, finish_ingest, results_ingested, store_results
+from scheduler import RATE_LIMITS, admit_submissions, load_requests, record_failure, record_released
+from metrics import api_call, instrumented_async_http_client
+
+# API calls in flight at once
+ASYNC_CONCURRENCY = int(os.getenv('ASYNC_CONCURRENCY', '8'))
+# Downloaded result chunks waiting for the writer before downloads pause
+INGEST_QUEUE_CHUNKS = int(os.getenv('INGEST_QUEUE_CHUNKS', '8'))
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """The process-wide engine, started on first use"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncEngine()
+        return _engine
+
+
+class AsyncEngine:
+    def __init__(self, client=None, concurrency=ASYNC_CONCURRENCY):
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        # batch_id -> future of the download it is part of, while one is running
+        self.ingesting = {}
+        self.ingesting_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-engine', daemon=True)
+        self.thread.start()
+        # Loop-bound objects are created on the loop's own thread
+        self.run(self._setup(client)).result()
+
+    async def _setup(self, client):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.client = client or anthropic.AsyncAnthropic(
+            api_key=os.getenv('ANTHROPIC_API_KEY'),
+            http_client=instrumented_async_http_client([RATE_LIMITS.observe_response]),
+        )
+
+    def run(self, coro):
+        """Schedule a coroutine on the engine's loop; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    # Submission
+
+    async def create(self, requests):
+        """Async version of ingestion.create_batch()"""
+        hits, misses = await asyncio.to_thread(split_cached, requests)
+        batch_id = status = None
+        if misses:
+            started = time.time()
+            async with self.semaphore:
+                try:
+                    with api_call('create'):
+                        message_batch = await self.client.messages.batches.create(requests=misses)
+                except anthropic.APITimeoutError:
+                    with api_call('list'):
+                        listed = (await self.client.messages.batches.list(limit=RECONCILE_PAGE_SIZE)).data
+                    message_batch = await asyncio.to_thread(reconcile_timed_out_create, listed, len(misses), started)
+                    if message_batch is None:
+                        raise
+            batch_id, status = message_batch.id, message_batch.processing_status
+        return hits, batch_id, status
+
+    async def submit(self, requests, parent_batch_id=None, username=None, source_id=None):
+        """Async version of ingestion.submit_batch()"""
+        hits, batch_id, status = await self.create(requests)
+        return await asyncio.to_thread(record_submission, batch_id, status, requests, hits, parent_batch_id, username,
+                                       source_id)
+
+    async def _submit_shards(self, shards, username, source_id):
+        # Shards are read from the (possibly streamed) iterable only when a
+        # slot is free, so at most `concurrency` of them are held in memory
+        slots = asyncio.Semaphore(self.concurrency)
+        shards = iter(shards)
+        tasks = []
+
+        async def submit_shard(shard):
+            try:
+                return await self.submit(shard, username=username, source_id=source_id)
+            finally:
+                slots.release()
+
+        while True:
+            await slots.acquire()
+            shard = await asyncio.to_thread(next, shards, None)
+            if shard is None:
+                slots.release()
+                break
+            tasks.append(asyncio.create_task(submit_shard(shard)))
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit_shards(self, shards, username=None, source_id=None):
+        """Submit one batch per shard concurrently.
+
+        The future's result is a list with a SubmittedBatch or the exception
+        raised for each shard, in order.
+        """
+        return self.run(self._submit_shards(shards, username, source_id))
+
+    async def _release_entry(self, entry):
+        try:
+            requests = await asyncio.to_thread(load_requests, entry['id'])
+            hits, batch_id, status = await self.create(requests)
+        except Exception as e:
+            await asyncio.to_thread(record_failure, entry, e)
+            return None
+        return await asyncio.to_thread(record_released, entry, batch_id, status, requests, hits)
+
+    async def _release_submissions(self, holder, ttl):
+        admitted = await asyncio.to_thread(admit_submissions, holder, ttl)
+        released = await asyncio.gather(*(self._release_entry(entry) for entry in admitted))
+        return [submitted for submitted in released if submitted is not None]
+
+    def release_submissions(self, holder, ttl):
+        """Submit the queued batches that fit under the quotas concurrently; result is their SubmittedBatches.
+
+        The entries are claimed by holder for ttl seconds; the caller keeps
+        the claims alive with scheduler.renew_claims() until they are done.
+        """
+        return self.run(self._release_submissions(holder, ttl))
+
+    # Results
+
+    async def _download(self, batch_id, queue, chunk_size):
+        count = 0
+        async with self.semaphore:
+            with api_call('results'):
+                results = await self.client.messages.batches.results(batch_id)
+            chunk = []
+            async for result in results:
+                chunk.append(result)
+                if len(chunk) >= chunk_size:
+                    await queue.put((batch_id, chunk))
+                    count += len(chunk)
+                    chunk = []
+            if chunk:
+                await queue.put((batch_id, chunk))
+                count += len(chunk)
+        return count
+
+    async def _write(self, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            batch_id, chunk = item
+            await asyncio.to_thread(store_results, batch_id, chunk)
+
+    async def _ingest_batches(self, batch_ids, chunk_size):
+        start = time.perf_counter()
+        outcomes = {}
+        pending = []
+        for batch_id in dict.fromkeys(batch_ids):
+            if await asyncio.to_thread(results_ingested, batch_id):
+                outcomes[batch_id] = await asyncio.to_thread(count_results, batch_id)
+            else:
+                pending.append(batch_id)
+        if not pending:
+            return outcomes
+
+        queue = asyncio.Queue(maxsize=INGEST_QUEUE_CHUNKS)
+        writer = asyncio.create_task(self._write(queue))
+        downloads = asyncio.gather(*(self._download(batch_id, queue, chunk_size) for batch_id in pending),
+                                   return_exceptions=True)
+        await asyncio.wait({writer, downloads}, return_when=asyncio.FIRST_COMPLETED)
+        if writer.done():
+            # The writer only stops early when storing failed
+            downloads.cancel()
+            raise writer.exception()
+        await queue.put(None)
+        await writer
+
+        for batch_id, outcome in zip(pending, downloads.result()):
+            if isinstance(outcome, BaseException):
+                logging.error(f"Error downloading results of batch {batch_id}: {outcome}")
+            else:
+                await asyncio.to_thread(finish_ingest, batch_id, outcome)
+            outcomes[batch_id] = outcome
+        await asyncio.to_thread(evict)
+        INGEST_LATENCY.observe(time.perf_counter() - start)
+        return outcomes
+
+    async def _collect(self, futures):
+        outcomes = {}
+        for batch_id, future in futures.items():
+            try:
+                outcomes[batch_id] = (await asyncio.wrap_future(future))[batch_id]
+            except Exception as e:
+                outcomes[batch_id] = e
+        return outcomes
+
+    def _forget(self, batch_ids, future):
+        with self.ingesting_lock:
+            for batch_id in batch_ids:
+                if self.ingesting.get(batch_id) is future:
+                    del self.ingesting[batch_id]
+
+    def ingest_batches(self, batch_ids, chunk_size=RESULTS_CHUNK_SIZE):
+        """Download the results of several ended batches concurrently into the local store.
+
+        The future's result maps each batch ID to its number of stored
+        results, or to the exception its download raised. Batches already
+        in the store are skipped, and a batch that is already being
+        downloaded (say by the monitor while the UI asks for it too) joins
+        that download instead of starting another.
+        """
+        batch_ids = list(dict.fromkeys(batch_ids))
+        with self.ingesting_lock:
+            new = [batch_id for batch_id in batch_ids if batch_id not in self.ingesting]
+            if new:
+                future = self.run(self._ingest_batches(new, chunk_size))
+                for batch_id in new:
+                    self.ingesting[batch_id] = future
+            futures = {batch_id: self.ingesting[batch_id] for batch_id in batch_ids}
+        if not new:
+            return self.run(self._collect(futures))
+        # Added outside the lock: the callback runs right away if the download already finished
+        future.add_done_callback(lambda done: self._forget(new, done))
+        if len(new) == len(batch_ids):
+            return future
+        return self.run(self._collect(futures))
@@ -1,30 +1,61 @@
-import schedule
 import time
 import anthropic
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 from queue import Queue
 import threading
-import smtplib
+import socket
+import uuid
 import os
 from dotenv import load_dotenv
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from database import (get_pending_batches, record_batch_statuses, mark_batch_handled, mark_batch_failed, acquire_lease,
+                      release_lease, renew_lease)
+from result_store import ingest_results
+from scheduler import RATE_LIMITS, has_queued_submissions, renew_claims, requeue_submissions
+from async_engine import get_engine
+from retry import due_retries, job_status, next_retry_due, postpone_retry, schedule_retry, submit_retry
+from report import format_message_content, render_report_html
+from notifications import NotificationDispatcher
+from log_config import configure_logging
+from metrics import api_call, gauge, histogram, instrumented_http_client, start_exporter
 
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('batch_monitor.log'),
-        logging.StreamHandler()
-    ]
-)
+ACTIVE_BATCHES = gauge('monitor_active_batches', 'Batches currently tracked by the monitor')
+SWEEP_LATENCY = histogram('monitor_sweep_seconds', 'Duration of a monitor status sweep')
+
+# Polling cadence bounds in seconds
+MIN_POLL_INTERVAL = int(os.getenv('MIN_POLL_INTERVAL', '30'))
+MAX_POLL_INTERVAL = int(os.getenv('MAX_POLL_INTERVAL', '600'))
+# Fraction of finished requests after which a batch is polled at the minimum interval
+NEAR_COMPLETION = 0.9
+# A batch whose status check or result download fails is tried again with
+# exponential backoff from MIN_POLL_INTERVAL, and given up after this many failures
+MAX_BATCH_FAILURES = int(os.getenv('MAX_BATCH_FAILURES', '8'))
+# Batches fetched per list call, and how many pages one sweep may read
+LIST_PAGE_SIZE = 100
+MAX_LIST_PAGES = 10
+
+
+# Only one process polls at a time; it holds this lease and renews it every
+# loop, and from a heartbeat thread while the loop is busy with long calls
+LEASE_NAME = 'batch_monitor'
+LEASE_TTL = int(os.getenv('MONITOR_LEASE_TTL', '60'))
+# How often the leader looks for new entries in the submission queue (seconds)
+SCHEDULER_INTERVAL = float(os.getenv('SCHEDULER_INTERVAL', '5'))
+
+
+def is_terminal_error(error):
+    """Client errors, such as an unknown batch or expired results, that retrying will not fix"""
+    return (isinstance(error, anthropic.APIStatusError) and 400 <= error.status_code < 500
+            and error.status_code not in (408, 409, 429))
+
 
 class BatchMonitor:
     _instance = None
     _lock = threading.Lock()
+    # Start the polling thread inside the current process (the Streamlit app).
+    # The standalone worker turns this off and runs the loop itself.
+    autostart = os.getenv('EMBEDDED_MONITOR', 'true').lower() == 'true'
     
     def __new__(cls):
         with cls._lock:
@@ -37,220 +68,338 @@ class BatchMonitor:
         if self.initialized:
             return
         load_dotenv()
+        configure_logging()
         
         self.batch_queue = Queue()
+        self.wake_event = threading.Event()
         self.client = anthropic.Anthropic(
-            api_key=os.getenv('ANTHROPIC_API_KEY')
+            api_key=os.getenv('ANTHROPIC_API_KEY'),
+            http_client=instrumented_http_client([RATE_LIMITS.observe_response]),
         )
+        # Result downloads and queued submissions run concurrently on the
+        # async engine, so a large download never holds up status polling
+        self.engine = get_engine()
+        self.releasing = None
         self.active_batches = {}
-        
-        self.smtp_server = os.getenv('SMTP_SERVER')
-        self.smtp_port = int(os.getenv('SMTP_PORT'))
-        self.sender_email = os.getenv('SENDER_EMAIL')
-        self.sender_password = os.getenv('SENDER_PASSWORD')
-        self.recipient_email = os.getenv('RECIPIENT_EMAIL')
-
-        self.monitor_thread = threading.Thread(target=self.run_monitor, daemon=True)
-        self.monitor_thread.start()
-        
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self.stop_event = threading.Event()
+
+        self.notifier = NotificationDispatcher()
+        start_exporter()
+
+        self.monitor_thread = None
+        if self.autostart:
+            self.start()
+
         self.initialized = True
 
+    def start(self):
+        """Run the monitoring loop in a background thread"""
+        with self._lock:
+            if self.monitor_thread is None:
+                self.monitor_thread = threading.Thread(target=self.run_monitor, daemon=True)
+                self.monitor_thread.start()
+
+    def stop(self):
+        """Stop the monitoring loop and hand the lease over to another worker"""
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def wake(self):
+        """Run the next loop iteration now, e.g. after a batch was queued for submission"""
+        self.wake_event.set()
+
     def add_batch(self, batch_id):
         """Add a new batch to monitor"""
         self.batch_queue.put(batch_id)
+        self.wake_event.set()
         logging.info(f"Added batch {batch_id} to monitoring queue")
 
     def process_queue(self):
-        """Process any new batches in the queue"""
+        """Pick up new batches from the queue and pending batches from the database"""
+        batch_ids = get_pending_batches()
         while not self.batch_queue.empty():
-            batch_id = self.batch_queue.get()
+            batch_ids.append(self.batch_queue.get())
+
+        for batch_id in batch_ids:
             if batch_id not in self.active_batches:
-                self.active_batches[batch_id] = None
+                self.active_batches[batch_id] = {
+                    'status': None,
+                    'created_at': None,
+                    'request_counts': None,
+                    'next_check': 0,
+                    'failures': 0,
+                }
                 logging.info(f"Batch {batch_id} added to active monitoring")
 
+    def poll_interval(self, message_batch):
+        """Seconds until a batch should be checked again.
+
+        Young batches and batches close to completion are polled often,
+        long-running ones back off towards MAX_POLL_INTERVAL.
+        """
+        age = max((datetime.now(timezone.utc) - message_batch.created_at).total_seconds(), 0)
+        interval = age / 10
+
+        counts = message_batch.request_counts
+        total = counts.processing + counts.succeeded + counts.errored + counts.canceled + counts.expired
+        done = total - counts.processing
+        if message_batch.processing_status == "canceling" or (total and done / total >= NEAR_COMPLETION):
+            interval = MIN_POLL_INTERVAL
+        elif done and age:
+            # Estimated time to completion at the current completion rate
+            eta = counts.processing / (done / age)
+            interval = min(interval, eta / 2)
+
+        return min(max(interval, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+    def list_batches(self, batch_ids):
+        """Fetch the given batches from the paginated list endpoint.
+
+        The list is newest first, so paging stops once every batch has been
+        seen, once it goes past the oldest batch we are looking for, or after
+        MAX_LIST_PAGES pages.
+        """
+        found = {}
+        created = [self.active_batches[batch_id]['created_at'] for batch_id in batch_ids]
+        oldest = min(created) if created and None not in created else None
+
+        with api_call('list'):
+            page = self.client.messages.batches.list(limit=LIST_PAGE_SIZE)
+        for _ in range(MAX_LIST_PAGES):
+            for message_batch in page.data:
+                if message_batch.id in batch_ids:
+                    found[message_batch.id] = message_batch
+            if len(found) == len(batch_ids) or not page.has_next_page():
+                break
+            if oldest is not None and page.data and page.data[-1].created_at < oldest:
+                break
+            with api_call('list'):
+                page = page.get_next_page()
+        return found
+
+    @SWEEP_LATENCY.time()
     def check_batch_status(self):
-        """Check status of all active batches"""
+        """Check status of all active batches that are due for a poll"""
         self.process_queue()  # Process any new batches first
-        
-        completed_batches = []
-        for batch_id in self.active_batches.keys():
-            try:
-                message_batch = self.client.messages.batches.retrieve(batch_id)
-                current_status = message_batch.processing_status
-                previous_status = self.active_batches[batch_id]
+        ACTIVE_BATCHES.set(len(self.active_batches))
 
-                if current_status != previous_status:
-                    logging.info(f"Batch {batch_id} status changed from {previous_status} to {current_status}")
-                    self.active_batches[batch_id] = current_status
+        now = time.time()
+        due = {batch_id for batch_id, state in self.active_batches.items() if state['next_check'] <= now}
+        if not due:
+            return
 
-                if current_status == "ended":
-                    logging.info(f"Batch {batch_id} has completed")
-                    completed_batches.append(batch_id)
-                    self.handle_completed_batch(batch_id)
+        try:
+            statuses = self.list_batches(due)
+        except Exception as e:
+            logging.error(f"Error listing batches: {e}")
+            statuses = {}
 
+        # Anything the list did not return is retrieved on its own
+        for batch_id in due - statuses.keys():
+            try:
+                with api_call('retrieve'):
+                    statuses[batch_id] = self.client.messages.batches.retrieve(batch_id)
             except Exception as e:
                 logging.error(f"Error checking batch {batch_id}: {e}")
+                self.batch_failed(batch_id, e, now)
+
+        # Status snapshot read by the UI instead of calling the API itself
+        record_batch_statuses(statuses.values(), now)
+
+        ended = []
+        for batch_id, message_batch in statuses.items():
+            state = self.active_batches[batch_id]
+            current_status = message_batch.processing_status
+            previous_status = state['status']
 
-        # Remove completed batches from monitoring
-        for batch_id in completed_batches:
+            if current_status != previous_status:
+                logging.info(f"Batch {batch_id} status changed from {previous_status} to {current_status}")
+                state['status'] = current_status
+            state['created_at'] = message_batch.created_at
+            state['request_counts'] = message_batch.request_counts
+            state['next_check'] = now + self.poll_interval(message_batch)
+            if current_status != "ended":
+                state['failures'] = 0
+
+            if current_status == "ended" and 'ingesting' not in state:
+                logging.info(f"Batch {batch_id} has completed")
+                ended.append(batch_id)
+
+        if ended:
+            self.start_ingestion(ended)
+
+    def batch_failed(self, batch_id, error, now):
+        """Back off a batch whose status check or result download failed, or give up on it.
+
+        Terminal errors and the MAX_BATCH_FAILURES-th failure give up: the
+        error is recorded and the batch is marked handled, so it is not
+        picked up again. Returns True if the batch was given up.
+        """
+        state = self.active_batches[batch_id]
+        state['failures'] = state.get('failures', 0) + 1
+        if is_terminal_error(error) or state['failures'] >= MAX_BATCH_FAILURES:
+            logging.error(f"Giving up on batch {batch_id} after {state['failures']} failed attempt(s): {error}")
+            mark_batch_failed(batch_id, str(error))
             del self.active_batches[batch_id]
+            return True
+        state['next_check'] = now + min(MIN_POLL_INTERVAL * 2 ** (state['failures'] - 1), MAX_POLL_INTERVAL)
+        return False
+
+    def start_ingestion(self, batch_ids):
+        """Download the results of ended batches in the background; finish_ingestions() picks them up"""
+        future = self.engine.ingest_batches(batch_ids)
+        future.add_done_callback(lambda _: self.wake_event.set())
+        for batch_id in batch_ids:
+            state = self.active_batches[batch_id]
+            state['ingesting'] = future
+            state['next_check'] = float('inf')
+
+    def finish_ingestions(self):
+        """Handle the batches whose results finished downloading; failed ones back off through batch_failed()"""
+        now = time.time()
+        for batch_id, state in list(self.active_batches.items()):
+            future = state.get('ingesting')
+            if future is None or not future.done():
+                continue
+            del state['ingesting']
+            try:
+                outcome = future.result()[batch_id]
+            except Exception as e:
+                outcome = e
+            if isinstance(outcome, BaseException):
+                logging.error(f"Error ingesting results of batch {batch_id}: {outcome}")
+                self.batch_failed(batch_id, outcome, now)
+            elif self.handle_completed_batch(batch_id):
+                mark_batch_handled(batch_id)
+                del self.active_batches[batch_id]
+            else:
+                self.batch_failed(batch_id, RuntimeError("handling the completed batch failed"), now)
+        ACTIVE_BATCHES.set(len(self.active_batches))
+
+    def heartbeat(self):
+        """Renew the lease and the claims on queue entries being submitted every LEASE_TTL / 3 seconds.
+
+        Runs in its own thread, so a slow API call or download in the loop
+        never lets the lease lapse while this process is alive.
+        """
+        while not self.stop_event.wait(LEASE_TTL / 3):
+            try:
+                if self.is_leader and not renew_lease(LEASE_NAME, self.worker_id, LEASE_TTL):
+                    logging.warning(f"Monitor {self.worker_id} lost the lease")
+                # Entries still being submitted stay claimed even if the lease was lost
+                renew_claims(self.worker_id, LEASE_TTL)
+            except Exception as e:
+                logging.error(f"Error renewing the monitor lease: {e}")
 
     def run_monitor(self):
-        """Run the monitoring loop"""
-        schedule.every(5).minutes.do(self.check_batch_status)
-        
-        # Do an initial check right away
-        self.check_batch_status()
-        
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
+        """Run the monitoring loop, polling only while this process holds the lease"""
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        while not self.stop_event.is_set():
+            try:
+                was_leader = self.is_leader
+                self.is_leader = acquire_lease(LEASE_NAME, self.worker_id, LEASE_TTL)
+                if self.is_leader and not was_leader:
+                    # Entries a previous leader was submitting when it died
+                    requeue_submissions()
+                if self.is_leader:
+                    self.check_batch_status()
+                    self.finish_ingestions()
+                    self.submit_due_retries()
+                    self.release_submissions()
+                else:
+                    # Another worker polls; its batches are reloaded if we take over
+                    self.active_batches.clear()
+            except Exception as e:
+                logging.error(f"Error in monitoring loop: {e}")
+
+            # Sleep until the next batch is due or a new batch is added, waking
+            # up often enough to renew the lease before it expires
+            now = time.time()
+            next_check = min((state['next_check'] for state in self.active_batches.values()), default=now + MAX_POLL_INTERVAL)
+            if self.is_leader:
+                next_check = min(next_check, next_retry_due() or next_check)
+                if self.releasing is None and has_queued_submissions():
+                    next_check = min(next_check, now + max(SCHEDULER_INTERVAL, RATE_LIMITS.remaining_pause()))
+            self.wake_event.wait(timeout=min(max(next_check - now, 1), MAX_POLL_INTERVAL, LEASE_TTL / 3))
+            self.wake_event.clear()
+
+        if self.is_leader:
+            release_lease(LEASE_NAME, self.worker_id)
+            self.is_leader = False
+        logging.info(f"Monitor {self.worker_id} stopped")
 
     def format_message_content(self, content) -> str:
         """Format the message content with preserved formatting"""
-        if isinstance(content, list):
-            formatted_content = ""
-            for block in content:
-                if hasattr(block, 'text'):
-                    # Preserve line breaks and format them as HTML
-                    text = block.text.replace('\n', '<br>')
-                    # Preserve indentation (spaces at start of lines)
-                    text = text.replace('  ', '&nbsp;&nbsp;')
-                    # Add paragraph styling
-                    formatted_content += f'<p style="margin: 8px 0;">{text}</p>'
-                else:
-                    formatted_content += f'<p>{str(block)}</p>'
-            return formatted_content
-        return str(content)
+        return format_message_content(content)
 
     def format_batch_results(self, results) -> str:
-        """Format batch results into readable HTML with better styling"""
-        html_content = """
-        <div style="font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto;">
-            <h2 style="color: #2c3e50; border-bottom: 2px solid #3498db; padding-bottom: 10px;">
-                Batch Processing Results
-            </h2>
-        """
-        
-        for idx, result in enumerate(results, 1):
-            html_content += f"""
-            <div style="margin: 20px 0;">
-                <h3 style="color: #2c3e50; margin-bottom: 10px;">
-                    Message {idx} (ID: {result.custom_id})
-                </h3>
-            """
-            
-            if result.result.type == "succeeded":
-                message = result.result.message
-                html_content += f"""
-                <div style="background-color: #f8f9fa; border-left: 4px solid #2ecc71; 
-                            padding: 15px; border-radius: 4px; margin: 10px 0;">
-                    <div style="margin-bottom: 10px;">
-                        <strong style="color: #2c3e50;">Message ID:</strong> 
-                        <span style="color: #7f8c8d;">{message.id}</span>
-                    </div>
-                    <div style="background-color: white; padding: 15px; border-radius: 4px; 
-                                margin-top: 10px; line-height: 1.6;">
-                        <strong style="color: #2c3e50; display: block; margin-bottom: 10px;">
-                            Content:
-                        </strong>
-                        <div style="color: #34495e;">
-                            {self.format_message_content(message.content)}
-                        </div>
-                    </div>
-                </div>
-                """
-            elif result.result.type == "errored":
-                html_content += f"""
-                <div style="background-color: #fff5f5; border-left: 4px solid #e74c3c; 
-                            padding: 15px; border-radius: 4px; margin: 10px 0;">
-                    <strong style="color: #c0392b;">Error:</strong> 
-                    <span style="color: #7f8c8d;">{result.result.error}</span>
-                </div>
-                """
-            else:
-                html_content += f"""
-                <div style="background-color: #fff9e6; border-left: 4px solid #f1c40f; 
-                            padding: 15px; border-radius: 4px; margin: 10px 0;">
-                    <strong style="color: #f39c12;">Status:</strong> 
-                    <span style="color: #7f8c8d;">{result.result.type}</span>
-                </div>
-                """
-            
-            html_content += "</div>"
-        
-        html_content += "</div>"
-        return html_content
+        """Format batch results into a size-bounded HTML report"""
+        return render_report_html(results)
 
-    def send_email_notification(self, batch_id: str, html_content: str):
-        """Send email notification with formatted results"""
-        try:
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = f'Batch Processing Complete - {batch_id}'
-            msg['From'] = self.sender_email
-            msg['To'] = self.recipient_email
-
-            # Add HTML content
-            html_part = MIMEText(html_content, 'html')
-            msg.attach(html_part)
-
-            # Send email
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.sender_email, self.sender_password)
-                server.send_message(msg)
-                
-            logging.info(f"Email notification sent for batch {batch_id}")
-            
-        except Exception as e:
-            logging.error(f"Failed to send email notification: {e}")
+    def track_submitted(self, submitted):
+        """Start tracking a batch this process submitted"""
+        if submitted.processing_status == "ended":
+            # Every request was served from the response cache
+            self.handle_completed_batch(submitted.id)
+        else:
+            self.add_batch(submitted.id)
+
+    def release_submissions(self):
+        """Submit queued batches that fit under the in-flight quotas, concurrently on the async engine"""
+        if self.releasing is not None:
+            if not self.releasing.done():
+                return
+            future, self.releasing = self.releasing, None
+            try:
+                released = future.result()
+            except Exception as e:
+                logging.error(f"Error releasing queued submissions: {e}")
+                released = []
+            for submitted in released:
+                self.track_submitted(submitted)
+            # The rest of the queue waits for the next scheduler interval
+            return
+        if has_queued_submissions():
+            self.releasing = self.engine.release_submissions(self.worker_id, LEASE_TTL)
+            self.releasing.add_done_callback(lambda _: self.wake_event.set())
+
+    def submit_due_retries(self):
+        """Submit follow-up batches for the failed requests of batches whose retry is due"""
+        for batch_id in due_retries():
+            try:
+                submitted = submit_retry(self.client, batch_id)
+            except Exception as e:
+                logging.error(f"Error submitting retry for batch {batch_id}: {e}")
+                postpone_retry(batch_id, MIN_POLL_INTERVAL)
+                continue
+            if submitted is not None:
+                self.track_submitted(submitted)
 
     def handle_completed_batch(self, batch_id):
-        """Handle completed batch by sending email notification"""
-        try:
-            # Retrieve results
-            results = list(self.client.messages.batches.results(batch_id))
-            
-            # Format results
-            html_content = self.format_batch_results(results)
-            
-            # Send email notification
-            self.send_email_notification(batch_id, html_content)
-            
-            logging.info(f"Successfully processed completed batch {batch_id}")
-            
-        except Exception as e:
-            logging.error(f"Error handling completed batch {batch_id}: {e}")
-            
-    def add_batch(self, batch_id):
-        """Add a new batch to monitor"""
-        self.active_batches[batch_id] = None
-        logging.info(f"Added batch {batch_id} to monitoring")
+        """Store the results of a completed batch, schedule retries and notify once its job is finished.
 
-    def check_batch_status(self):
-        """Check status of all active batches"""
-        completed_batches = []
+        Returns True on success.
+        """
+        try:
+            # Download results into the local store (a no-op if already there)
+            ingest_results(self.client, batch_id)
+            schedule_retry(batch_id)
 
-        for batch_id in self.active_batches.keys():
-            try:
-                message_batch = self.client.messages.batches.retrieve(batch_id)
-                current_status = message_batch.processing_status
-                previous_status = self.active_batches[batch_id]
+            # Rendering and sending happen on the notification thread, for
+            # every batch of the job once all its requests have a final outcome
+            job = job_status(batch_id)
+            if job['finished']:
+                for batch in job['batches']:
+                    self.notifier.enqueue(batch['batch_id'])
+                logging.info(f"Job {job['root_batch_id']} finished: {dict(job['outcomes'])}")
 
-                # Log if status has changed
-                if current_status != previous_status:
-                    logging.info(f"Batch {batch_id} status changed from {previous_status} to {current_status}")
-                    self.active_batches[batch_id] = current_status
+            logging.info(f"Successfully processed completed batch {batch_id}")
+            return True
 
-                # If batch is complete
-                if current_status == "ended":
-                    logging.info(f"Batch {batch_id} has completed")
-                    completed_batches.append(batch_id)
-                    self.handle_completed_batch(batch_id)
+        except Exception as e:
+            logging.error(f"Error handling completed batch {batch_id}: {e}")
+            return False
 
-            except Exception as e:
-                logging.error(f"Error checking batch {batch_id}: {e}")
 
-        # Remove completed batches from monitoring
-        for batch_id in completed_batches:
-            del self.active_batches[batch_id]
\ No newline at end of file
@@ -0,0 +1,197 @@
+"""Local stand-in for the Message Batches API.
+
+Implements create, retrieve, list and results for /v1/messages/batches well
+enough for the Anthropic client. Point a client at it with
+``base_url=server.base_url`` (or ANTHROPIC_BASE_URL).
+"""
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BATCHES_PATH = '/v1/messages/batches'
+
+
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class FakeBatchesServer:
+    """In-memory batches backend served over HTTP from a background thread.
+
+    latency: seconds added to every response
+    processing_time: seconds after creation at which a batch ends
+    result_size: characters of text in each succeeded result
+    error_every: every n-th request errors (0 for none)
+    """
+
+    def __init__(self, latency=0.0, processing_time=0.0, result_size=200, error_every=0):
+        self.latency = latency
+        self.processing_time = processing_time
+        self.result_size = result_size
+        self.error_every = error_every
+
+        self.batches = {}
+        self.order = []
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def create_batch(self, requests, ended=False):
+        """Register a batch directly, without going through HTTP"""
+        with self.lock:
+            batch_id = f'msgbatch_{len(self.order) + 1:024d}'
+            created = time.time() - (self.processing_time if ended else 0)
+            self.batches[batch_id] = {'requests': requests, 'created': created}
+            self.order.append(batch_id)
+        return self.batch_json(batch_id)
+
+    def batch_json(self, batch_id):
+        batch = self.batches[batch_id]
+        total = len(batch['requests'])
+        elapsed = time.time() - batch['created']
+        ended = elapsed >= self.processing_time
+        done = total if ended else int(total * elapsed / self.processing_time)
+        errored = done // self.error_every if self.error_every else 0
+        return {
+            'id': batch_id,
+            'type': 'message_batch',
+            'processing_status': 'ended' if ended else 'in_progress',
+            'request_counts': {
+                'processing': total - done,
+                'succeeded': done - errored,
+                'errored': errored,
+                'canceled': 0,
+                'expired': 0,
+            },
+            'created_at': _timestamp(batch['created']),
+            'expires_at': _timestamp(batch['created'] + 24 * 3600),
+            'ended_at': _timestamp(batch['created'] + self.processing_time) if ended else None,
+            'archived_at': None,
+            'cancel_initiated_at': None,
+            'results_url': f'{self.base_url}{BATCHES_PATH}/{batch_id}/results' if ended else None,
+        }
+
+    def result_json(self, index, request):
+        if self.error_every and (index + 1) % self.error_every == 0:
+            result = {'type': 'errored', 'error': {'type': 'error', 'error': {'type': 'api_error', 'message': 'Internal error'}}}
+        else:
+            params = request.get('params', {})
+            text = ('lorem ipsum ' * (self.result_size // 12 + 1))[:self.result_size]
+            result = {
+                'type': 'succeeded',
+                'message': {
+                    'id': f'msg_{index:024d}',
+                    'type': 'message',
+                    'role': 'assistant',
+                    'model': params.get('model', 'claude-3-5-sonnet-20241022'),
+                    'content': [{'type': 'text', 'text': text}],
+                    'stop_reason': 'end_turn',
+                    'stop_sequence': None,
+                    'usage': {'input_tokens': 10, 'output_tokens': self.result_size // 4},
+                },
+            }
+        return {'custom_id': request['custom_id'], 'result': result}
+
+    def list_page(self, query):
+        limit = int(query.get('limit', ['20'])[0])
+        newest_first = list(reversed(self.order))
+        start = 0
+        if 'after_id' in query:
+            start = newest_first.index(query['after_id'][0]) + 1
+        page = newest_first[start:start + limit]
+        return {
+            'data': [self.batch_json(batch_id) for batch_id in page],
+            'has_more': start + limit < len(newest_first),
+            'first_id': page[0] if page else None,
+            'last_id': page[-1] if page else None,
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _not_found(self):
+                self._send_json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': 'Not found'}})
+
+            def _begin(self):
+                with server.lock:
+                    server.request_count += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+            def do_POST(self):
+                self._begin()
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if urlparse(self.path).path != BATCHES_PATH:
+                    return self._not_found()
+                self._send_json(200, server.create_batch(body['requests']))
+
+            def do_GET(self):
+                self._begin()
+                url = urlparse(self.path)
+                if url.path == BATCHES_PATH:
+                    return self._send_json(200, server.list_page(parse_qs(url.query)))
+
+                parts = url.path[len(BATCHES_PATH) + 1:].split('/')
+                batch_id = parts[0]
+                if not url.path.startswith(BATCHES_PATH + '/') or batch_id not in server.batches:
+                    return self._not_found()
+                if len(parts) == 1:
+                    return self._send_json(200, server.batch_json(batch_id))
+                if parts[1:] == ['results']:
+                    return self._send_results(batch_id)
+                return self._not_found()
+
+            def _send_results(self, batch_id):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/binary')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                requests = server.batches[batch_id]['requests']
+                for start in range(0, len(requests), 500):
+                    lines = ''.join(
+                        json.dumps(server.result_json(index, request)) + '\n'
+                        for index, request in enumerate(requests[start:start + 500], start)
+                    ).encode()
+                    self.wfile.write(f'{len(lines):x}\r\n'.encode() + lines + b'\r\n')
+                self.wfile.write(b'0\r\n\r\n')
+
+        return Handler
@@ -0,0 +1,219 @@
+"""Benchmark suite for the batch tool, run against a local fake batches server.
+
+    python -m benchmarks.run --output benchmark_report.json
+
+Measures submission throughput, monitor sweep time, results ingestion rate
+(sequential and on the async engine), history query latency and report render time, and writes the numbers to a
+JSON report so runs can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# The database location and API endpoint are read at import time
+os.environ['DATA_LOCATION'] = tempfile.mkdtemp(prefix='batch-bench-')
+os.environ.setdefault('ANTHROPIC_API_KEY', 'benchmark')
+os.environ['EMBEDDED_MONITOR'] = 'false'
+os.environ['SMTP_SERVER'] = ''
+
+import anthropic
+
+from async_engine import AsyncEngine
+from benchmarks.fake_server import FakeBatchesServer
+from database import init_db, transaction, get_batch_history, get_batch_requests
+from ingestion import build_request, submit_batch
+from result_store import ingest_results
+from report import render_batch_report_html
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return time.perf_counter() - start, value
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': statistics.median(samples) * 1000,
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def make_requests(count, prefix):
+    return [build_request(f'{prefix}-{i}', f'Benchmark prompt {prefix} {i}') for i in range(count)]
+
+
+def bench_submission(client, batches, requests_per_batch):
+    start = time.perf_counter()
+    for b in range(batches):
+        submit_batch(client, make_requests(requests_per_batch, f'submit{b}'))
+    elapsed = time.perf_counter() - start
+    return {
+        'batches': batches,
+        'requests_per_batch': requests_per_batch,
+        'seconds': elapsed,
+        'batches_per_second': batches / elapsed,
+        'requests_per_second': batches * requests_per_batch / elapsed,
+    }
+
+
+def bench_async_submission(engine, batches, requests_per_batch):
+    shards = (make_requests(requests_per_batch, f'async{b}') for b in range(batches))
+    elapsed, outcomes = timed(lambda: engine.submit_shards(shards).result())
+    failed = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    return {
+        'batches': batches,
+        'requests_per_batch': requests_per_batch,
+        'concurrency': engine.concurrency,
+        'failed': len(failed),
+        'seconds': elapsed,
+        'batches_per_second': batches / elapsed,
+        'requests_per_second': batches * requests_per_batch / elapsed,
+    }
+
+
+def bench_monitor_sweep(server, active_batches):
+    from batch_monitor import BatchMonitor
+
+    with transaction() as conn:
+        for _ in range(active_batches):
+            batch = server.create_batch(make_requests(1, 'sweep'))
+            conn.execute("INSERT INTO batches (batch_id, status, request_count) VALUES (?, ?, ?)",
+                         (batch['id'], 'in_progress', 1))
+
+    monitor = BatchMonitor()
+    requests_before = server.request_count
+    elapsed, _ = timed(monitor.check_batch_status)
+    return {
+        'active_batches': len(monitor.active_batches),
+        'seconds': elapsed,
+        'api_calls': server.request_count - requests_before,
+    }
+
+
+def bench_ingestion(server, client, results):
+    batch = server.create_batch(make_requests(results, 'ingest'), ended=True)
+    with transaction() as conn:
+        conn.execute("INSERT INTO batches (batch_id, status, request_count) VALUES (?, ?, ?)",
+                     (batch['id'], 'ended', results))
+    elapsed, count = timed(ingest_results, client, batch['id'])
+    return batch['id'], {
+        'results': count,
+        'seconds': elapsed,
+        'results_per_second': count / elapsed,
+    }
+
+
+def bench_async_ingestion(server, engine, batches, results):
+    batch_ids = []
+    with transaction() as conn:
+        for b in range(batches):
+            batch = server.create_batch(make_requests(results, f'async-ingest{b}'), ended=True)
+            conn.execute("INSERT INTO batches (batch_id, status, request_count) VALUES (?, ?, ?)",
+                         (batch['id'], 'ended', results))
+            batch_ids.append(batch['id'])
+    elapsed, outcomes = timed(lambda: engine.ingest_batches(batch_ids).result())
+    count = sum(outcome for outcome in outcomes.values() if not isinstance(outcome, BaseException))
+    return {
+        'batches': batches,
+        'results': count,
+        'concurrency': engine.concurrency,
+        'seconds': elapsed,
+        'results_per_second': count / elapsed,
+    }
+
+
+def bench_render(batch_id):
+    elapsed, html = timed(render_batch_report_html, batch_id)
+    return {'seconds': elapsed, 'html_bytes': len(html)}
+
+
+def bench_history(sizes, samples=20):
+    report = []
+    with transaction() as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
+    for size in sizes:
+        missing = size - existing
+        if missing > 0:
+            with transaction() as conn:
+                conn.executemany(
+                    "INSERT INTO batches (batch_id, status, request_count) VALUES (?, ?, ?)",
+                    ((f'history_{existing + i}', 'ended', 10) for i in range(missing)))
+                conn.executemany(
+                    "INSERT INTO batch_requests (batch_id, custom_id, status, params) VALUES (?, ?, ?, ?)",
+                    ((f'history_{existing + i}', f'm{j}', 'succeeded', '{"messages": []}')
+                     for i in range(missing) for j in range(10)))
+            existing = size
+
+        first_page, second_page, requests_page = [], [], []
+        for _ in range(samples):
+            elapsed, (_, cursor) = timed(get_batch_history)
+            first_page.append(elapsed)
+            second_page.append(timed(get_batch_history, cursor=cursor)[0])
+            requests_page.append(timed(get_batch_requests, f'history_{size // 2}')[0])
+        report.append({
+            'batches': size,
+            'history_first_page': percentiles(first_page),
+            'history_next_page': percentiles(second_page),
+            'batch_requests_page': percentiles(requests_page),
+        })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark_report.json', help='where to write the JSON report')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency per fake API call')
+    parser.add_argument('--result-size', type=int, default=500, help='characters of text per result')
+    parser.add_argument('--submit-batches', type=int, default=20)
+    parser.add_argument('--requests-per-batch', type=int, default=100)
+    parser.add_argument('--active-batches', type=int, default=500)
+    parser.add_argument('--results', type=int, default=10000)
+    parser.add_argument('--async-batches', type=int, default=8, help='batches ingested at once on the async engine')
+    parser.add_argument('--history-sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    args = parser.parse_args(argv)
+
+    init_db()
+    # Batches stay in progress unless created as ended
+    with FakeBatchesServer(latency=args.latency, processing_time=3600, result_size=args.result_size) as server:
+        os.environ['ANTHROPIC_BASE_URL'] = server.base_url
+        client = anthropic.Anthropic(base_url=server.base_url, max_retries=0)
+
+        report = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'config': vars(args),
+        }
+        print('Submission throughput...', file=sys.stderr)
+        report['submission'] = bench_submission(client, args.submit_batches, args.requests_per_batch)
+        print('Monitor sweep...', file=sys.stderr)
+        report['monitor_sweep'] = bench_monitor_sweep(server, args.active_batches)
+        print('Results ingestion...', file=sys.stderr)
+        batch_id, report['ingestion'] = bench_ingestion(server, client, args.results)
+        engine = AsyncEngine(client=anthropic.AsyncAnthropic(base_url=server.base_url, max_retries=0))
+        print('Async submission throughput...', file=sys.stderr)
+        report['async_submission'] = bench_async_submission(engine, args.submit_batches, args.requests_per_batch)
+        print('Async results ingestion...', file=sys.stderr)
+        report['async_ingestion'] = bench_async_ingestion(server, engine, args.async_batches,
+                                                          args.results // args.async_batches)
+        engine.stop()
+        print('Report rendering...', file=sys.stderr)
+        report['render'] = bench_render(batch_id)
+        print('History queries...', file=sys.stderr)
+        report['history'] = bench_history(args.history_sizes)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
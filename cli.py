@@ -0,0 +1,114 @@
+"""Command line tools for the batch store.
+
+    python cli.py export BATCH_ID --format parquet --output results.parquet
+    python cli.py join SOURCE_ID|BATCH_ID input.csv --output input.joined.csv
+    python cli.py train-dictionary
+    python cli.py compress
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from compression import DICTIONARY_SIZE, TRAINING_SAMPLES, recompress_all, train_dictionary
+from database import connection, init_db, transaction
+from export import EXPORT_CHUNK_SIZE, FORMATS, export_results
+from log_config import configure_logging
+from metrics import instrumented_http_client
+from result_store import ingest_results, results_ingested
+from sources import SOURCE_CHUNK_SIZE, get_source, join_results, source_batches, source_of_batch
+
+
+def _client():
+    import anthropic
+
+    return anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), http_client=instrumented_http_client())
+
+
+def export_command(args):
+    """Export the results of a batch, downloading them first if they are not stored yet"""
+    if not results_ingested(args.batch_id):
+        ingest_results(_client(), args.batch_id)
+
+    output = args.output or f"{args.batch_id}.{args.format}"
+    count = export_results(args.batch_id, output, args.format, args.chunk_size)
+    print(f"Wrote {count} results to {output}", file=sys.stderr)
+
+
+def join_command(args):
+    """Join the results of an uploaded file's batches onto the file, downloading ended batches first"""
+    source_id = int(args.source) if args.source.isdigit() else source_of_batch(args.source)
+    source = get_source(source_id) if source_id is not None else None
+    if source is None:
+        sys.exit(f"{args.source} is neither a source ID nor a batch submitted from a file")
+
+    client = None
+    for batch_id, status, ingested in source_batches(source_id):
+        if ingested:
+            continue
+        client = client or _client()
+        # The stored status may be stale when no monitor is running
+        if status == 'ended' or client.messages.batches.retrieve(batch_id).processing_status == 'ended':
+            ingest_results(client, batch_id)
+
+    input_path = Path(args.input)
+    output = args.output or str(input_path.with_name(f"{input_path.stem}.joined{input_path.suffix}"))
+    with open(input_path, 'rb') as f:
+        rows, joined = join_results(source_id, f, output, args.chunk_size)
+    print(f"Wrote {rows} rows ({joined} with results) to {output}", file=sys.stderr)
+
+
+def train_dictionary_command(args):
+    """Train a zstd dictionary for new payloads on the stored prompts and results"""
+    dictionary_id = train_dictionary(args.size, args.samples)
+    print(f"Trained dictionary {dictionary_id}; run `cli.py compress` to apply it to stored payloads", file=sys.stderr)
+
+
+def compress_command(args):
+    """Re-encode every stored payload with the configured codec, then give the freed pages back to the OS"""
+    with transaction() as conn:
+        changed = recompress_all(conn)
+    print(f"Recompressed {sum(changed.values())} payloads", file=sys.stderr)
+    if not args.no_vacuum:
+        with connection() as conn:
+            conn.execute('VACUUM')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='write the results of a batch to a Parquet or Arrow file')
+    export.add_argument('batch_id')
+    export.add_argument('--format', choices=FORMATS, default='parquet')
+    export.add_argument('--output', help='file to write (default: BATCH_ID.FORMAT)')
+    export.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='results per record batch')
+    export.set_defaults(func=export_command)
+
+    join = commands.add_parser('join', help='add the results of an uploaded file to each of its rows')
+    join.add_argument('source', help='source ID, or the ID of any batch submitted from the file')
+    join.add_argument('input', help='the file that was uploaded')
+    join.add_argument('--output', help='file to write (default: INPUT.joined.EXT next to the input)')
+    join.add_argument('--chunk-size', type=int, default=SOURCE_CHUNK_SIZE, help='rows joined per query')
+    join.set_defaults(func=join_command)
+
+    train = commands.add_parser('train-dictionary', help='train a zstd dictionary on stored payloads')
+    train.add_argument('--size', type=int, default=DICTIONARY_SIZE, help='dictionary size in bytes')
+    train.add_argument('--samples', type=int, default=TRAINING_SAMPLES, help='payloads to sample')
+    train.set_defaults(func=train_dictionary_command)
+
+    compress = commands.add_parser('compress', help='recompress stored payloads with the configured codec')
+    compress.add_argument('--no-vacuum', action='store_true', help='skip the VACUUM that shrinks the file')
+    compress.set_defaults(func=compress_command)
+
+    args = parser.parse_args(argv)
+    load_dotenv()
+    configure_logging()
+    init_db()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
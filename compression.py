@@ -0,0 +1,226 @@
+"""Transparent compression of the large payload columns.
+
+Request params, result payloads, cached responses and queued submissions are
+stored as BLOBs: one codec byte followed by the compressed UTF-8 JSON. Values
+written before compression was enabled are TEXT and are returned unchanged,
+so old and new rows can be mixed freely. Metadata columns are never
+compressed and stay queryable.
+
+zstd needs the zstandard package, which is imported on first use; without it
+new values fall back to zlib. A zstd dictionary trained on stored prompts and
+results (python cli.py train-dictionary) improves the ratio of the many short
+payloads that share the same structure.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from dotenv import load_dotenv
+
+from metrics import counter
+
+# Imported by database before it loads the environment itself
+load_dotenv()
+
+# Codec for new values: zstd, zlib or none
+PAYLOAD_COMPRESSION = os.getenv('PAYLOAD_COMPRESSION', 'zlib').lower()
+# Values shorter than this (in bytes) are stored as plain TEXT
+MIN_COMPRESS_BYTES = 128
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# Compress new zstd values with the latest trained dictionary, if there is one
+PAYLOAD_DICTIONARY = os.getenv('PAYLOAD_DICTIONARY', 'true').lower() == 'true'
+# Dictionary size and number of stored payloads sampled to train it
+DICTIONARY_SIZE = 112640
+TRAINING_SAMPLES = 20000
+
+# (table, column) of every compressed payload column
+PAYLOAD_COLUMNS = (
+    ('batch_requests', 'params'),
+    ('batch_results', 'payload'),
+    ('response_cache', 'result'),
+    ('submission_queue', 'requests'),
+)
+# Rows re-encoded per statement batch
+RECOMPRESS_CHUNK_SIZE = 1000
+
+# Codec byte at the start of every compressed value
+ZLIB = 1
+ZSTD = 2
+# Followed by the 4-byte ID of the dictionary in compression_dictionaries
+ZSTD_DICT = 3
+
+PAYLOAD_BYTES = counter('payload_bytes_total', 'Payload bytes before and after compression', ['stage'])
+
+_local = threading.local()
+_dictionaries = {}
+_dictionaries_lock = threading.Lock()
+# ID of the dictionary new values are compressed with, looked up once per process
+_active_dictionary = None
+_warned = False
+
+
+def _zstd():
+    import zstandard
+
+    return zstandard
+
+
+def _codec():
+    """Codec for new values, falling back to zlib if zstandard is not installed"""
+    global _warned
+    if PAYLOAD_COMPRESSION != 'zstd':
+        return PAYLOAD_COMPRESSION
+    try:
+        _zstd()
+        return 'zstd'
+    except ImportError:
+        if not _warned:
+            _warned = True
+            logging.warning("PAYLOAD_COMPRESSION=zstd but zstandard is not installed; compressing with zlib")
+        return 'zlib'
+
+
+def _dictionary(dictionary_id):
+    """Loaded zstd dictionary by ID, read from the database once"""
+    with _dictionaries_lock:
+        if dictionary_id not in _dictionaries:
+            from database import connection
+
+            with connection() as conn:
+                row = conn.execute("SELECT data FROM compression_dictionaries WHERE id = ?",
+                                   (dictionary_id,)).fetchone()
+            if row is None:
+                raise ValueError(f"Compression dictionary {dictionary_id} not found")
+            _dictionaries[dictionary_id] = _zstd().ZstdCompressionDict(row['data'])
+        return _dictionaries[dictionary_id]
+
+
+def _active_dictionary_id():
+    global _active_dictionary
+    if not PAYLOAD_DICTIONARY:
+        return None
+    if _active_dictionary is None:
+        from database import connection
+
+        with connection() as conn:
+            _active_dictionary = conn.execute("SELECT MAX(id) FROM compression_dictionaries").fetchone()[0] or 0
+    return _active_dictionary or None
+
+
+def _compressor(dictionary_id):
+    # zstd (de)compressors must not be shared between threads
+    compressors = _local.__dict__.setdefault('compressors', {})
+    if dictionary_id not in compressors:
+        dictionary = _dictionary(dictionary_id) if dictionary_id is not None else None
+        compressors[dictionary_id] = _zstd().ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary)
+    return compressors[dictionary_id]
+
+
+def _decompressor(dictionary_id):
+    decompressors = _local.__dict__.setdefault('decompressors', {})
+    if dictionary_id not in decompressors:
+        dictionary = _dictionary(dictionary_id) if dictionary_id is not None else None
+        decompressors[dictionary_id] = _zstd().ZstdDecompressor(dict_data=dictionary)
+    return decompressors[dictionary_id]
+
+
+def encode(text):
+    """Stored form of a payload: compressed BLOB, or the text itself if short or compression is off"""
+    if text is None:
+        return None
+    data = text.encode()
+    codec = _codec()
+    if codec == 'none' or len(data) < MIN_COMPRESS_BYTES:
+        return text
+
+    if codec == 'zstd':
+        dictionary_id = _active_dictionary_id()
+        if dictionary_id is not None:
+            encoded = bytes([ZSTD_DICT]) + struct.pack('>I', dictionary_id) + _compressor(dictionary_id).compress(data)
+        else:
+            encoded = bytes([ZSTD]) + _compressor(None).compress(data)
+    else:
+        encoded = bytes([ZLIB]) + zlib.compress(data, ZLIB_LEVEL)
+    PAYLOAD_BYTES.inc(len(data), stage='raw')
+    PAYLOAD_BYTES.inc(len(encoded), stage='stored')
+    return encoded
+
+
+def decode(value):
+    """Payload text of a stored value; TEXT stored before compression passes through"""
+    if value is None or isinstance(value, str):
+        return value
+    codec = value[0]
+    if codec == ZLIB:
+        data = zlib.decompress(value[1:])
+    elif codec == ZSTD:
+        data = _decompressor(None).decompress(value[1:])
+    elif codec == ZSTD_DICT:
+        dictionary_id, = struct.unpack('>I', value[1:5])
+        data = _decompressor(dictionary_id).decompress(value[5:])
+    else:
+        raise ValueError(f"Unknown payload codec {codec}")
+    return data.decode()
+
+
+def recompress(conn, table, column, only_text=False):
+    """Re-encode the values of a payload column with the current codec; returns the number of rows changed.
+
+    With only_text, only values stored before compression was enabled are
+    touched.
+    """
+    where = f"typeof({column}) = 'text'" if only_text else f"{column} IS NOT NULL"
+    changed = 0
+    last_rowid = 0
+    while True:
+        rows = conn.execute(f"SELECT rowid, {column} FROM {table} WHERE rowid > ? AND {where} ORDER BY rowid LIMIT ?",
+                            (last_rowid, RECOMPRESS_CHUNK_SIZE)).fetchall()
+        if not rows:
+            return changed
+        updates = []
+        for rowid, value in rows:
+            encoded = encode(decode(value))
+            if encoded != value:
+                updates.append((encoded, rowid))
+        conn.executemany(f"UPDATE {table} SET {column} = ? WHERE rowid = ?", updates)
+        changed += len(updates)
+        last_rowid = rows[-1][0]
+
+
+def recompress_all(conn, only_text=False):
+    """Re-encode every payload column; returns {table: rows changed}"""
+    changed = {table: recompress(conn, table, column, only_text) for table, column in PAYLOAD_COLUMNS}
+    logging.info(f"Recompressed payloads: {changed}")
+    return changed
+
+
+def train_dictionary(size=DICTIONARY_SIZE, samples=TRAINING_SAMPLES):
+    """Train a zstd dictionary on a sample of stored prompts and results; returns its ID.
+
+    New values written by this process use it right away, other processes
+    after a restart. Existing rows keep their encoding until recompressed.
+    """
+    global _active_dictionary
+    zstandard = _zstd()
+    from database import connection, transaction
+
+    with connection() as conn:
+        sample = [decode(row[0]) for row in conn.execute(
+            "SELECT params FROM batch_requests WHERE rowid IN "
+            "(SELECT rowid FROM batch_requests ORDER BY random() LIMIT ?)", (samples // 2,))]
+        sample += [decode(row[0]) for row in conn.execute(
+            "SELECT payload FROM batch_results WHERE rowid IN "
+            "(SELECT rowid FROM batch_results ORDER BY random() LIMIT ?)", (samples // 2,))]
+    dictionary = zstandard.train_dictionary(size, [text.encode() for text in sample if text])
+
+    with transaction() as conn:
+        dictionary_id = conn.execute("INSERT INTO compression_dictionaries (data, created_at) VALUES (?, ?)",
+                                     (dictionary.as_bytes(), time.time())).lastrowid
+    _active_dictionary = dictionary_id
+    logging.info(f"Trained compression dictionary {dictionary_id} ({len(dictionary.as_bytes())} bytes) "
+                 f"on {len(sample)} payloads")
+    return dictionary_id
@@ -1,112 +1,680 @@
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from queue import LifoQueue, Empty, Full
 import sqlite3
 import hashlib
+import threading
+import time
 import os
 import json
 
+from compression import decode, encode, recompress_all
+from metrics import DB_QUERY_LATENCY
+
 # Load environment variables
 load_dotenv()
 
 database_location = os.getenv('DATA_LOCATION', '.') + '/app_data.db'
 
-# Initialize database
-def init_db():
-    conn = sqlite3.connect(database_location)
-    c = conn.cursor()
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY,
-        username TEXT UNIQUE,
-        password TEXT
+# Maximum number of idle connections kept around for reuse
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+# Seconds a connection waits on a locked database before giving up
+BUSY_TIMEOUT = 30
+
+# Page sizes for the batch history and per-batch request views
+HISTORY_PAGE_SIZE = 20
+REQUESTS_PAGE_SIZE = 50
+
+
+def _migrate_batch_requests(conn):
+    """Move per-request data out of the batches.messages blob into its own table"""
+    conn.execute('''
+    CREATE TABLE batch_requests (
+        batch_id TEXT NOT NULL,
+        custom_id TEXT NOT NULL,
+        status TEXT,
+        params TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (batch_id, custom_id)
+    )
+    ''')
+    conn.execute('CREATE INDEX idx_batch_requests_status ON batch_requests (status)')
+    conn.execute('CREATE INDEX idx_batch_requests_created_at ON batch_requests (created_at)')
+    conn.execute('ALTER TABLE batches ADD COLUMN request_count INTEGER')
+    conn.execute('CREATE INDEX idx_batches_created_at ON batches (created_at, id)')
+
+    legacy = conn.execute("SELECT batch_id, status, messages, created_at FROM batches WHERE messages IS NOT NULL")
+    for batch_id, status, messages, created_at in legacy.fetchall():
+        requests = json.loads(messages) if messages else []
+        conn.executemany(
+            "INSERT OR IGNORE INTO batch_requests (batch_id, custom_id, status, params, created_at) VALUES (?, ?, ?, ?, ?)",
+            ((batch_id, request['custom_id'], status, json.dumps(request['params']), created_at) for request in requests),
+        )
+        conn.execute("UPDATE batches SET request_count = ?, messages = NULL WHERE batch_id = ?",
+                     (len(requests), batch_id))
+
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Entries are lists of SQL statements or callables taking the connection.
+def _migrate_search_index(conn):
+    """Full-text index over prompts and responses, filled from what is already stored"""
+    from search import backfill
+
+    conn.execute('''
+    CREATE VIRTUAL TABLE search_index USING fts5(
+        batch_id UNINDEXED,
+        custom_id UNINDEXED,
+        kind UNINDEXED,
+        body,
+        tokenize = 'porter unicode61 remove_diacritics 2'
     )
     ''')
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS batches (
+    backfill(conn)
+
+
+def _migrate_usage_rollups(conn):
+    """Per-batch and per-day usage rollups; filled by _migrate_cache_usage"""
+    conn.execute('ALTER TABLE batch_results ADD COLUMN model TEXT')
+    conn.execute("UPDATE batch_results SET model = json_extract(payload, '$.result.message.model') "
+                 "WHERE result_type = 'succeeded'")
+    for table, key in (('batch_usage', 'batch_id TEXT PRIMARY KEY'), ('daily_usage', 'day TEXT PRIMARY KEY')):
+        conn.execute(f'''
+        CREATE TABLE {table} (
+            {key},
+            requests INTEGER NOT NULL DEFAULT 0,
+            succeeded INTEGER NOT NULL DEFAULT 0,
+            errored INTEGER NOT NULL DEFAULT 0,
+            canceled INTEGER NOT NULL DEFAULT 0,
+            expired INTEGER NOT NULL DEFAULT 0,
+            cached INTEGER NOT NULL DEFAULT 0,
+            input_tokens INTEGER NOT NULL DEFAULT 0,
+            output_tokens INTEGER NOT NULL DEFAULT 0,
+            cost REAL NOT NULL DEFAULT 0
+        )
+        ''')
+
+
+def _migrate_cache_usage(conn):
+    """Prompt cache token counts on results and rollups"""
+    from usage import backfill
+
+    for table in ('batch_results', 'batch_usage', 'daily_usage'):
+        default = '' if table == 'batch_results' else ' NOT NULL DEFAULT 0'
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN cache_creation_tokens INTEGER{default}')
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN cache_read_tokens INTEGER{default}')
+    conn.execute('''
+    UPDATE batch_results SET
+        cache_creation_tokens = json_extract(payload, '$.result.message.usage.cache_creation_input_tokens'),
+        cache_read_tokens = json_extract(payload, '$.result.message.usage.cache_read_input_tokens')
+    WHERE result_type = 'succeeded'
+    ''')
+    # Rollups are computed here, once the results have all their columns,
+    # unless they were already being kept up to date
+    if conn.execute('SELECT 1 FROM batch_usage LIMIT 1').fetchone() is None:
+        backfill(conn)
+
+
+def _migrate_compress_payloads(conn):
+    """Compress the payload columns of existing rows.
+
+    Retries select errored results by error type, which SQL cannot read from
+    a compressed payload, so it gets a column of its own first.
+    """
+    conn.execute('CREATE TABLE compression_dictionaries (id INTEGER PRIMARY KEY, data BLOB NOT NULL, created_at REAL NOT NULL)')
+    conn.execute('ALTER TABLE batch_results ADD COLUMN error_type TEXT')
+    conn.execute("UPDATE batch_results SET error_type = json_extract(payload, '$.result.error.error.type') "
+                 "WHERE result_type = 'errored'")
+    recompress_all(conn, only_text=True)
+
+
+def _migrate_contentless_search_index(conn):
+    """Rebuild the full-text index without its own copy of the text.
+
+    The index kept every prompt and response uncompressed next to the
+    compressed payloads; now it only points at them through search_documents.
+    """
+    from search import backfill
+
+    conn.execute('DROP TABLE search_index')
+    conn.execute('''
+    CREATE TABLE search_documents (
         id INTEGER PRIMARY KEY,
-        batch_id TEXT UNIQUE,
-        status TEXT,
-        messages TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        batch_id TEXT NOT NULL,
+        custom_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        UNIQUE (batch_id, custom_id, kind)
+    )
+    ''')
+    conn.execute('''
+    CREATE VIRTUAL TABLE search_index USING fts5(
+        body,
+        content = '',
+        tokenize = 'porter unicode61 remove_diacritics 2'
     )
     ''')
-    
-    admin_username = os.getenv('ADMIN_USERNAME', 'admin')
-    admin_password = os.getenv('ADMIN_PASSWORD', 'password')
-    
-    password_hash = hashlib.sha256(admin_password.encode()).hexdigest()
-    
-    c.execute("SELECT * FROM users WHERE username = ?", (admin_username,))
-    if not c.fetchone():
-        c.execute("INSERT INTO users (username, password) VALUES (?, ?)", 
-                 (admin_username, password_hash))
-    
-    conn.commit()
-    conn.close()
+    backfill(conn)
+
+
+MIGRATIONS = [
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT UNIQUE,
+            password TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY,
+            batch_id TEXT UNIQUE,
+            status TEXT,
+            messages TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ],
+    _migrate_batch_requests,
+    [
+        '''
+        CREATE TABLE batch_results (
+            batch_id TEXT NOT NULL,
+            custom_id TEXT NOT NULL,
+            result_type TEXT,
+            payload TEXT,
+            PRIMARY KEY (batch_id, custom_id)
+        )
+        ''',
+        'ALTER TABLE batches ADD COLUMN results_ingested_at TIMESTAMP',
+    ],
+    [
+        '''
+        CREATE TABLE monitor_lease (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        'ALTER TABLE batches ADD COLUMN handled_at TIMESTAMP',
+        # Batches that ended before this migration were already handled in-process
+        "UPDATE batches SET handled_at = CURRENT_TIMESTAMP WHERE status = 'ended'",
+    ],
+    [
+        '''
+        CREATE TABLE response_cache (
+            params_hash TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX idx_response_cache_last_used_at ON response_cache (last_used_at)',
+    ],
+    [
+        'ALTER TABLE batch_results ADD COLUMN stop_reason TEXT',
+        'ALTER TABLE batch_results ADD COLUMN input_tokens INTEGER',
+        'ALTER TABLE batch_results ADD COLUMN output_tokens INTEGER',
+        '''
+        UPDATE batch_results SET
+            stop_reason = json_extract(payload, '$.result.message.stop_reason'),
+            input_tokens = json_extract(payload, '$.result.message.usage.input_tokens'),
+            output_tokens = json_extract(payload, '$.result.message.usage.output_tokens')
+        WHERE result_type = 'succeeded'
+        ''',
+        'CREATE INDEX idx_batch_results_type ON batch_results (batch_id, result_type)',
+    ],
+    [
+        'ALTER TABLE batches ADD COLUMN status_checked_at REAL',
+    ],
+    _migrate_search_index,
+    _migrate_usage_rollups,
+    _migrate_cache_usage,
+    [
+        # Retry batches: the failed requests of a batch are resubmitted as a
+        # child batch; all batches of a job share the root batch ID
+        'ALTER TABLE batches ADD COLUMN parent_batch_id TEXT',
+        'ALTER TABLE batches ADD COLUMN root_batch_id TEXT',
+        'ALTER TABLE batches ADD COLUMN attempt INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE batches ADD COLUMN retry_due_at REAL',
+        'ALTER TABLE batches ADD COLUMN retry_batch_id TEXT',
+        'UPDATE batches SET root_batch_id = batch_id',
+        'CREATE INDEX idx_batches_root ON batches (root_batch_id)',
+        'CREATE INDEX idx_batches_retry_due ON batches (retry_due_at) WHERE retry_due_at IS NOT NULL',
+    ],
+    [
+        # Per-user accounts with a fair-share weight; the users so far were all admins
+        'ALTER TABLE users ADD COLUMN weight REAL NOT NULL DEFAULT 1',
+        'ALTER TABLE users ADD COLUMN is_admin INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE users ADD COLUMN last_finish_tag REAL NOT NULL DEFAULT 0',
+        'UPDATE users SET is_admin = 1',
+        'ALTER TABLE batches ADD COLUMN username TEXT',
+        '''
+        CREATE TABLE submission_queue (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            finish_tag REAL NOT NULL,
+            request_count INTEGER NOT NULL,
+            requests TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            batch_id TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            submitted_at REAL
+        )
+        ''',
+        'CREATE INDEX idx_submission_queue_next ON submission_queue (status, priority DESC, finish_tag, id)',
+        'CREATE INDEX idx_submission_queue_user ON submission_queue (username, id)',
+        'CREATE TABLE scheduler_state (name TEXT PRIMARY KEY, value REAL NOT NULL)',
+        "CREATE INDEX idx_batches_inflight ON batches (status) WHERE status != 'ended'",
+    ],
+    [
+        # Progress snapshot written by the monitor, read by the UI's status panel
+        'ALTER TABLE batches ADD COLUMN processing_count INTEGER',
+        'ALTER TABLE batches ADD COLUMN succeeded_count INTEGER',
+        'ALTER TABLE batches ADD COLUMN errored_count INTEGER',
+        'ALTER TABLE batches ADD COLUMN canceled_count INTEGER',
+        'ALTER TABLE batches ADD COLUMN expired_count INTEGER',
+        'ALTER TABLE batches ADD COLUMN ended_at REAL',
+    ],
+    _migrate_compress_payloads,
+    [
+        # Uploaded files and the row each custom_id was read from, for joining
+        # results back onto the file
+        '''
+        CREATE TABLE sources (
+            id INTEGER PRIMARY KEY,
+            filename TEXT,
+            format TEXT NOT NULL,
+            id_field TEXT,
+            username TEXT,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE source_rows (
+            source_id INTEGER NOT NULL,
+            row_number INTEGER NOT NULL,
+            custom_id TEXT NOT NULL,
+            PRIMARY KEY (source_id, row_number)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE UNIQUE INDEX idx_source_rows_custom_id ON source_rows (source_id, custom_id)',
+        'ALTER TABLE batches ADD COLUMN source_id INTEGER',
+        'CREATE INDEX idx_batches_source ON batches (source_id) WHERE source_id IS NOT NULL',
+        'ALTER TABLE submission_queue ADD COLUMN source_id INTEGER',
+    ],
+    _migrate_contentless_search_index,
+    [
+        # Worker submitting a queue entry, and until when its claim holds
+        'ALTER TABLE submission_queue ADD COLUMN claimed_by TEXT',
+        'ALTER TABLE submission_queue ADD COLUMN claim_expires_at REAL',
+    ],
+    [
+        # Before the monitor tracked batches their status only changed on a
+        # manual refresh, so old batches are still 'processing'. Anything the
+        # monitor never checked and that is past the 24h processing window is
+        # history, and has ended on the API side anyway: it is not polled,
+        # downloaded, notified about or counted as in flight.
+        "UPDATE batches SET status = 'ended', handled_at = CURRENT_TIMESTAMP "
+        "WHERE handled_at IS NULL AND status_checked_at IS NULL AND created_at < datetime('now', '-1 day')",
+    ],
+    [
+        # Why the monitor gave up on a batch it could not check or download
+        'ALTER TABLE batches ADD COLUMN error TEXT',
+    ],
+]
+
+# batches columns holding the request_counts of the last status check
+REQUEST_COUNT_TYPES = ('processing', 'succeeded', 'errored', 'canceled', 'expired')
+
+
+class ConnectionPool:
+    """Small pool of SQLite connections shared by all threads.
+
+    Connections are opened in WAL mode so readers never block the writer,
+    and are handed out to one thread at a time.
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.idle = LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT,
+            isolation_level=None,  # transactions are managed explicitly
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT * 1000}')
+        return conn
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+_initialized = False
+_init_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(database_location)
+    return _pool
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection; nested calls on the same thread share it"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    pool = _get_pool()
+    conn = pool.acquire()
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        pool.release(conn)
+
+
+@contextmanager
+def transaction():
+    """Run a block as a single write transaction.
+
+    BEGIN IMMEDIATE takes the write lock up front, so concurrent writers
+    queue on the busy timeout instead of failing half way through.
+    """
+    with connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+
+def _migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for target, migration in enumerate(MIGRATIONS[version:], version + 1):
+        if callable(migration):
+            migration(conn)
+        else:
+            for statement in migration:
+                conn.execute(statement)
+        conn.execute(f'PRAGMA user_version = {target}')
+
 
+# Initialize database
+def init_db():
+    """Create or migrate the schema and seed the admin user, once per process"""
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+
+        with transaction() as conn:
+            _migrate(conn)
+
+            admin_username = os.getenv('ADMIN_USERNAME', 'admin')
+            admin_password = os.getenv('ADMIN_PASSWORD', 'password')
+
+            password_hash = hashlib.sha256(admin_password.encode()).hexdigest()
+
+            conn.execute("INSERT OR IGNORE INTO users (username, password, is_admin) VALUES (?, ?, 1)",
+                         (admin_username, password_hash))
+
+        _initialized = True
+
+
+@DB_QUERY_LATENCY.time(query='verify_credentials')
 def verify_credentials(username, password):
-    conn = sqlite3.connect(database_location)
-    c = conn.cursor()
-    
     password_hash = hashlib.sha256(password.encode()).hexdigest()
-    
-    c.execute("SELECT * FROM users WHERE username = ? AND password = ?", 
-             (username, password_hash))
-    user = c.fetchone()
-    conn.close()
-    
+
+    with connection() as conn:
+        user = conn.execute("SELECT id FROM users WHERE username = ? AND password = ?",
+                            (username, password_hash)).fetchone()
+
     return user is not None
 
-def save_batch_to_db(batch_id, messages_json):
-    conn = sqlite3.connect(database_location)
-    c = conn.cursor()
-    
-    # First, ensure we have a batches table
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS batches (
-        id INTEGER PRIMARY KEY,
-        batch_id TEXT UNIQUE,
-        status TEXT,
-        messages TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    c.execute("INSERT OR IGNORE INTO batches (batch_id, status, messages) VALUES (?, ?, ?)", 
-             (batch_id, "processing", messages_json))
-    
-    conn.commit()
-    conn.close()
 
+@DB_QUERY_LATENCY.time(query='get_user')
+def get_user(username):
+    """Account settings of a user, or None"""
+    with connection() as conn:
+        row = conn.execute("SELECT username, weight, is_admin FROM users WHERE username = ?", (username,)).fetchone()
+    return dict(row) if row is not None else None
+
+
+def list_users():
+    with connection() as conn:
+        return [dict(row) for row in conn.execute("SELECT username, weight, is_admin FROM users ORDER BY username")]
+
+
+def save_user(username, password=None, weight=1.0, is_admin=False):
+    """Create a user or update its settings; the password is only changed when given"""
+    with transaction() as conn:
+        if password:
+            password_hash = hashlib.sha256(password.encode()).hexdigest()
+            conn.execute(
+                "INSERT INTO users (username, password, weight, is_admin) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (username) DO UPDATE SET password = excluded.password, "
+                "weight = excluded.weight, is_admin = excluded.is_admin",
+                (username, password_hash, weight, int(is_admin)))
+        else:
+            conn.execute("UPDATE users SET weight = ?, is_admin = ? WHERE username = ?",
+                         (weight, int(is_admin), username))
+
+
+@DB_QUERY_LATENCY.time(query='save_batch_to_db')
+def save_batch_to_db(batch_id, requests, parent_batch_id=None, username=None, source_id=None):
+    """Record a submitted batch and one batch_requests row per request.
+
+    A retry batch passes the batch it retries as parent_batch_id and joins
+    that batch's job, its owner and its source file as its next attempt.
+    """
+    from search import index_requests
+
+    with transaction() as conn:
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO batches (batch_id, status, request_count, root_batch_id, username, source_id) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (batch_id, "processing", len(requests), batch_id, username, source_id)).rowcount
+        if inserted and parent_batch_id:
+            conn.execute(
+                "UPDATE batches SET parent_batch_id = ?, (root_batch_id, attempt, username, source_id) = "
+                "(SELECT COALESCE(root_batch_id, batch_id), attempt + 1, username, source_id FROM batches "
+                "WHERE batch_id = ?) WHERE batch_id = ?", (parent_batch_id, parent_batch_id, batch_id))
+        conn.executemany(
+            "INSERT OR IGNORE INTO batch_requests (batch_id, custom_id, status, params) VALUES (?, ?, ?, ?)",
+            ((batch_id, request['custom_id'], "processing", encode(json.dumps(request['params']))) for request in requests),
+        )
+        # A batch is only saved once; its prompts are indexed with it
+        if inserted:
+            index_requests(conn, batch_id, requests)
+
+
+@DB_QUERY_LATENCY.time(query='update_batch_status')
 def update_batch_status(batch_id, status):
-    conn = sqlite3.connect(database_location)
-    c = conn.cursor()
-    
-    c.execute("UPDATE batches SET status = ? WHERE batch_id = ?", 
-             (status, batch_id))
-    
-    conn.commit()
-    conn.close()
-    
-def get_batch_history():
-    conn = sqlite3.connect(database_location)
-    conn.row_factory = sqlite3.Row  # To get column names
-    c = conn.cursor()
-    
-    c.execute("SELECT * FROM batches ORDER BY created_at DESC")
-    batches = [dict(row) for row in c.fetchall()]
-    
-    conn.close()
-    return batches
+    with transaction() as conn:
+        conn.execute("UPDATE batches SET status = ?, status_checked_at = ? WHERE batch_id = ?",
+                     (status, time.time(), batch_id))
+
+
+@DB_QUERY_LATENCY.time(query='record_batch_statuses')
+def record_batch_statuses(message_batches, checked_at):
+    """Write the status and request counts of several retrieved MessageBatch objects at once"""
+    columns = ', '.join(f'{name}_count = ?' for name in REQUEST_COUNT_TYPES)
+    with transaction() as conn:
+        conn.executemany(
+            f"UPDATE batches SET status = ?, status_checked_at = ?, {columns}, ended_at = ? WHERE batch_id = ?",
+            ((message_batch.processing_status, checked_at,
+              *(getattr(message_batch.request_counts, name) for name in REQUEST_COUNT_TYPES),
+              message_batch.ended_at.timestamp() if message_batch.ended_at else None,
+              message_batch.id) for message_batch in message_batches))
 
+
+@DB_QUERY_LATENCY.time(query='get_status_snapshot')
+def get_status_snapshot(batch_id):
+    """Return (status, checked_at) last recorded for a batch, or None if unknown"""
+    with connection() as conn:
+        row = conn.execute("SELECT status, status_checked_at FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+    if row is None:
+        return None
+    return row['status'], row['status_checked_at']
+
+
+@DB_QUERY_LATENCY.time(query='get_batch_progress')
+def get_batch_progress(batch_id):
+    """Last recorded status and request counts of a batch, as a dict, or None if unknown.
+
+    Besides the status and status_checked_at it holds created_at and
+    ended_at as Unix times, and a counts dict keyed by request state.
+    """
+    columns = ', '.join(f'{name}_count' for name in REQUEST_COUNT_TYPES)
+    with connection() as conn:
+        row = conn.execute(
+            f"SELECT status, status_checked_at, CAST(strftime('%s', created_at) AS REAL) AS created_at, ended_at, "
+            f"request_count, {columns} FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+    if row is None:
+        return None
+    progress = {key: row[key] for key in ('status', 'status_checked_at', 'created_at', 'ended_at', 'request_count')}
+    progress['counts'] = {name: row[f'{name}_count'] for name in REQUEST_COUNT_TYPES}
+    return progress
+
+
+@DB_QUERY_LATENCY.time(query='get_pending_batches')
+def get_pending_batches():
+    """IDs of batches still being processed or whose completion was not handled yet"""
+    with connection() as conn:
+        rows = conn.execute("SELECT batch_id FROM batches WHERE status != 'ended' OR handled_at IS NULL").fetchall()
+    return [row['batch_id'] for row in rows]
+
+
+@DB_QUERY_LATENCY.time(query='mark_batch_handled')
+def mark_batch_handled(batch_id):
+    with transaction() as conn:
+        conn.execute("UPDATE batches SET status = 'ended', handled_at = CURRENT_TIMESTAMP WHERE batch_id = ?",
+                     (batch_id,))
+
+
+@DB_QUERY_LATENCY.time(query='mark_batch_failed')
+def mark_batch_failed(batch_id, error):
+    """Record why a batch was given up and mark it handled, so it is no longer picked up"""
+    with transaction() as conn:
+        conn.execute("UPDATE batches SET status = 'ended', handled_at = CURRENT_TIMESTAMP, error = ? WHERE batch_id = ?",
+                     (error, batch_id))
+
+
+@DB_QUERY_LATENCY.time(query='acquire_lease')
+def acquire_lease(name, holder, ttl):
+    """Take or renew a named lease for ttl seconds; False if someone else holds it"""
+    now = time.time()
+    with transaction() as conn:
+        row = conn.execute("SELECT holder, expires_at FROM monitor_lease WHERE name = ?", (name,)).fetchone()
+        if row is not None and row['holder'] != holder and row['expires_at'] > now:
+            return False
+        conn.execute("INSERT OR REPLACE INTO monitor_lease (name, holder, expires_at) VALUES (?, ?, ?)",
+                     (name, holder, now + ttl))
+    return True
+
+
+@DB_QUERY_LATENCY.time(query='renew_lease')
+def renew_lease(name, holder, ttl):
+    """Extend a lease held by holder for ttl seconds from now; False if it is no longer held"""
+    with transaction() as conn:
+        return conn.execute("UPDATE monitor_lease SET expires_at = ? WHERE name = ? AND holder = ?",
+                            (time.time() + ttl, name, holder)).rowcount > 0
+
+
+@DB_QUERY_LATENCY.time(query='release_lease')
+def release_lease(name, holder):
+    with transaction() as conn:
+        conn.execute("DELETE FROM monitor_lease WHERE name = ? AND holder = ?", (name, holder))
+
+
+@DB_QUERY_LATENCY.time(query='get_batch_history')
+def get_batch_history(limit=HISTORY_PAGE_SIZE, cursor=None):
+    """Return one page of batch metadata, newest first, and the cursor for the next page.
+
+    The cursor is the (created_at, id) of the last row returned, or None
+    when there are no more pages.
+    """
+    with connection() as conn:
+        if cursor is None:
+            rows = conn.execute(
+                "SELECT id, batch_id, status, request_count, created_at FROM batches "
+                "ORDER BY created_at DESC, id DESC LIMIT ?", (limit + 1,)).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT id, batch_id, status, request_count, created_at FROM batches "
+                "WHERE (created_at, id) < (?, ?) "
+                "ORDER BY created_at DESC, id DESC LIMIT ?", (*cursor, limit + 1)).fetchall()
+
+    batches = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = (batches[-1]['created_at'], batches[-1]['id'])
+    return batches, next_cursor
+
+
+@DB_QUERY_LATENCY.time(query='get_batch_requests')
+def get_batch_requests(batch_id, limit=REQUESTS_PAGE_SIZE, after=None):
+    """Return one page of a batch's requests in submission order and the cursor for the next page"""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT rowid, custom_id, status, params FROM batch_requests "
+            "WHERE batch_id = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+            (batch_id, after or 0, limit + 1)).fetchall()
+
+    requests = [
+        {'custom_id': row['custom_id'], 'status': row['status'], 'params': json.loads(decode(row['params']))}
+        for row in rows[:limit]
+    ]
+    next_cursor = rows[limit - 1]['rowid'] if len(rows) > limit else None
+    return requests, next_cursor
+
+
+@DB_QUERY_LATENCY.time(query='get_batch_messages')
 def get_batch_messages(batch_id):
-    conn = sqlite3.connect(database_location)
-    c = conn.cursor()
-    
-    c.execute("SELECT messages FROM batches WHERE batch_id = ?", (batch_id,))
-    result = c.fetchone()
-    
-    conn.close()
-    
-    if result and result[0]:
-        return json.loads(result[0])
+    with connection() as conn:
+        rows = conn.execute("SELECT custom_id, params FROM batch_requests WHERE batch_id = ? ORDER BY rowid",
+                            (batch_id,)).fetchall()
+
+    if rows:
+        return [{'custom_id': row['custom_id'], 'params': json.loads(decode(row['params']))} for row in rows]
     return None
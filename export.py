@@ -0,0 +1,151 @@
+"""Columnar export of stored batch results to Parquet or Arrow IPC.
+
+Results are read from the local store and written one record batch at a
+time, so memory use depends on the chunk size rather than the batch size.
+Requires pyarrow, which is imported on first use.
+
+prepare_downloads() writes the files offered for download in the app to
+EXPORT_DIR, where they are shared by all sessions instead of being held in
+memory by each of them.
+"""
+import json
+import logging
+import os
+import uuid
+from contextlib import contextmanager
+
+from report import render_batch_report_html, write_results_jsonl_gz
+from result_store import iter_result_chunks, iter_results
+from search import content_text
+from metrics import histogram
+
+FORMATS = ('parquet', 'arrow')
+# Prepared download files; a batch's results never change once stored, so they are built once
+EXPORT_DIR = os.path.join(os.getenv('DATA_LOCATION', '.'), 'exports')
+# Results per record batch (and Parquet row group)
+EXPORT_CHUNK_SIZE = 5000
+
+EXPORT_LATENCY = histogram('results_export_seconds', 'Time to write the results of a batch to a columnar file', ['format'])
+
+COLUMNS = (
+    ('custom_id', 'string'),
+    ('result_type', 'string'),
+    ('model', 'string'),
+    ('stop_reason', 'string'),
+    ('input_tokens', 'int64'),
+    ('output_tokens', 'int64'),
+    ('cache_creation_tokens', 'int64'),
+    ('cache_read_tokens', 'int64'),
+    ('text', 'string'),
+    ('error_type', 'string'),
+    ('error_message', 'string'),
+)
+
+
+def schema():
+    import pyarrow as pa
+
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in COLUMNS])
+
+
+def result_record(row):
+    """Flat COLUMNS dict of a batch_results row (with its payload decompressed)"""
+    result = json.loads(row['payload'])['result']
+    message = result.get('message') or {}
+    error = (result.get('error') or {}).get('error') or {}
+    record = {name: row[name] for name in ('custom_id', 'result_type', 'model', 'stop_reason', 'input_tokens',
+                                           'output_tokens', 'cache_creation_tokens', 'cache_read_tokens')}
+    record['text'] = content_text(message.get('content')) if message else None
+    record['error_type'] = error.get('type')
+    record['error_message'] = error.get('message')
+    return record
+
+
+def _columns(rows):
+    """Column lists for one chunk of batch_results rows"""
+    columns = {name: [] for name, _ in COLUMNS}
+    for row in rows:
+        for name, value in result_record(row).items():
+            columns[name].append(value)
+    return columns
+
+
+def export_results(batch_id, sink, format='parquet', chunk_size=EXPORT_CHUNK_SIZE):
+    """Write the stored results of a batch to sink (a path or binary file object).
+
+    Returns the number of exported results.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unknown export format {format!r}, expected one of {', '.join(FORMATS)}")
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table_schema = schema()
+    count = 0
+    with EXPORT_LATENCY.time(format=format):
+        if format == 'parquet':
+            writer = pq.ParquetWriter(sink, table_schema, compression='zstd')
+        else:
+            writer = pa.ipc.new_file(sink, table_schema)
+        with writer:
+            for rows in iter_result_chunks(batch_id, chunk_size=chunk_size):
+                writer.write_batch(pa.RecordBatch.from_pydict(_columns(rows), schema=table_schema))
+                count += len(rows)
+            if count == 0:
+                # Still produce a valid file with the schema
+                writer.write_table(table_schema.empty_table())
+    logging.info(f"Exported {count} results of batch {batch_id} as {format}")
+    return count
+
+
+@contextmanager
+def replaced_when_done(path):
+    """Yield a temporary path next to path that replaces it once the block succeeds.
+
+    Readers never see a partly written file, and concurrent writers of the
+    same file do not interleave.
+    """
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _write_report(batch_id, path):
+    with open(path, 'w', encoding='utf-8') as out:
+        out.write(render_batch_report_html(batch_id))
+
+
+def _write_jsonl(batch_id, path):
+    with open(path, 'wb') as out:
+        write_results_jsonl_gz(iter_results(batch_id), out)
+
+
+# kind -> (file extension, writer)
+DOWNLOADS = {
+    'report': ('html', _write_report),
+    'jsonl': ('jsonl.gz', _write_jsonl),
+    'parquet': ('parquet', lambda batch_id, path: export_results(batch_id, path, 'parquet')),
+}
+
+
+def prepare_downloads(batch_id, directory=EXPORT_DIR):
+    """Write the report and exports of a stored batch to files, streaming; returns {kind: path}.
+
+    Files that already exist are reused. Parquet is left out without pyarrow.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for kind, (extension, write) in DOWNLOADS.items():
+        path = os.path.join(directory, f"{batch_id}.{extension}")
+        if not os.path.exists(path):
+            try:
+                with replaced_when_done(path) as tmp:
+                    write(batch_id, tmp)
+            except ImportError:
+                continue
+        paths[kind] = path
+    return paths
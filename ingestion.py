@@ -0,0 +1,316 @@
+import csv
+import io
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import anthropic
+from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
+from anthropic.types.messages.batch_create_params import Request
+from database import connection, save_batch_to_db, mark_batch_handled, transaction
+from request_cache import split_cached
+from metrics import api_call
+from result_store import store_cached_results, mark_ingested
+
+DEFAULT_MODEL = "claude-3-5-sonnet-20241022"
+DEFAULT_MAX_TOKENS = 1024
+# Models offered in the UI; any model name can be used programmatically
+MODELS = (
+    "claude-3-5-sonnet-20241022",
+    "claude-3-7-sonnet-20250219",
+    "claude-sonnet-4-20250514",
+    "claude-opus-4-20250514",
+    "claude-3-5-haiku-20241022",
+    "claude-3-haiku-20240307",
+)
+
+# Message Batches API limits per batch. The byte limit keeps 1 MiB of headroom
+# for the request envelope and headers.
+MAX_BATCH_REQUESTS = 100_000
+MAX_BATCH_BYTES = 256 * 1024 * 1024 - 1024 * 1024
+
+# A create that timed out on the client may still have gone through: the newest
+# batches are listed to find it before the create is tried again
+RECONCILE_PAGE_SIZE = 100
+# Allowed difference between the local clock and the API's created_at (seconds)
+RECONCILE_CLOCK_SKEW = 60
+
+SubmittedBatch = namedtuple('SubmittedBatch', ['id', 'processing_status', 'request_count', 'cached_count'])
+
+# Columns / keys checked (in order) for the prompt text of a row
+PROMPT_FIELDS = ("prompt", "content", "message")
+# Keys of a JSONL row that are sent as request params; everything else (IDs,
+# metadata columns kept for the join) stays local
+PARAMS_FIELDS = (MessageCreateParamsNonStreaming.__required_keys__ | MessageCreateParamsNonStreaming.__optional_keys__
+                 | {"temperature", "top_k", "top_p"}) - {"stream"}
+# Characters the API accepts in a custom_id, and its maximum length
+CUSTOM_ID_INVALID = re.compile(r"[^a-zA-Z0-9_-]")
+MAX_CUSTOM_ID_LENGTH = 64
+
+
+def shared_prefix(system_prompt=None, context=None):
+    """System blocks shared by every request of a batch, or None if both are empty.
+
+    The last block carries a cache_control breakpoint, so the API caches the
+    whole prefix on the first request and reads it from cache for the rest.
+    Prefixes shorter than the model's minimum cacheable length (1024 tokens
+    for most models) are sent normally.
+    """
+    blocks = [{"type": "text", "text": text} for text in (system_prompt, context) if text and text.strip()]
+    if not blocks:
+        return None
+    blocks[-1]["cache_control"] = {"type": "ephemeral"}
+    return blocks
+
+
+def build_request(custom_id, content, model=DEFAULT_MODEL, max_tokens=DEFAULT_MAX_TOKENS, system=None):
+    """Build a single batch request with one user message, after the optional shared system blocks"""
+    params = MessageCreateParamsNonStreaming(
+        model=model,
+        max_tokens=max_tokens,
+        messages=[
+            {
+                "role": "user",
+                "content": content,
+            }
+        ],
+    )
+    if system:
+        params["system"] = system
+    return Request(custom_id=custom_id, params=params)
+
+
+def _prompt_from_row(row, line_number):
+    for field in PROMPT_FIELDS:
+        if row.get(field):
+            return row[field]
+    raise ValueError(f"Line {line_number}: no {'/'.join(PROMPT_FIELDS)} field found")
+
+
+def row_custom_id(row, index, line_number, id_field=None):
+    """custom_id of an input row.
+
+    With id_field it is derived from that column / key, with characters the
+    API does not accept replaced by "_". Otherwise it is the row's own
+    custom_id, or message-<index> if it has none.
+    """
+    if id_field:
+        value = row.get(id_field)
+        if value is None or str(value) == "":
+            raise ValueError(f"Line {line_number}: no {id_field} value for the custom_id")
+        return CUSTOM_ID_INVALID.sub("_", str(value))[:MAX_CUSTOM_ID_LENGTH]
+    return row.get("custom_id") or f"message-{index}"
+
+
+def _request_from_jsonl(record, index, line_number, model, max_tokens, system, id_field=None):
+    custom_id = row_custom_id(record, index, line_number, id_field)
+    if "params" in record:
+        # Already a full batch request, pass it through untouched
+        return Request(custom_id=custom_id, params=record["params"])
+    if "messages" in record:
+        params = {"model": model, "max_tokens": max_tokens}
+        if system:
+            params["system"] = system
+        params.update({k: v for k, v in record.items() if k in PARAMS_FIELDS and k != id_field})
+        return Request(custom_id=custom_id, params=MessageCreateParamsNonStreaming(**params))
+    return build_request(custom_id, _prompt_from_row(record, line_number), model, max_tokens, system)
+
+
+def iter_jsonl_records(fileobj):
+    """Yield (index, line_number, object) for the non-empty lines of a JSONL file"""
+    index = 0
+    for line_number, line in enumerate(fileobj, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {line_number}: invalid JSON ({e})")
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {line_number}: expected a JSON object")
+        yield index, line_number, record
+        index += 1
+
+
+def iter_csv_records(fileobj):
+    """Yield (index, line_number, row dict) for the rows of a CSV file"""
+    reader = csv.DictReader(fileobj)
+    for index, row in enumerate(reader):
+        # DictReader counts the header as line 1
+        yield index, reader.line_num, row
+
+
+def file_format(filename):
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+
+def iter_file_records(fileobj, filename):
+    """Stream the rows of an uploaded JSONL or CSV file (binary file object) as (index, line_number, row)"""
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    if file_format(filename) == "csv":
+        return iter_csv_records(text)
+    return iter_jsonl_records(text)
+
+
+def iter_jsonl_requests(fileobj, model=DEFAULT_MODEL, max_tokens=DEFAULT_MAX_TOKENS, system=None, id_field=None):
+    """Yield batch requests from a JSONL file, one line at a time.
+
+    Each line is either a full ``{"custom_id", "params"}`` request, a params
+    object with ``messages``, or an object with a ``prompt``/``content`` field.
+    Full requests are passed through as they are; the others get the given
+    model, max_tokens and shared system blocks unless the line sets its own.
+    """
+    for index, line_number, record in iter_jsonl_records(fileobj):
+        yield _request_from_jsonl(record, index, line_number, model, max_tokens, system, id_field)
+
+
+def iter_csv_requests(fileobj, model=DEFAULT_MODEL, max_tokens=DEFAULT_MAX_TOKENS, system=None, id_field=None):
+    """Yield batch requests from a CSV file with a prompt column, one row at a time.
+
+    The prompt is read from the first of ``prompt``/``content``/``message``
+    present; an optional ``custom_id`` column (or the id_field column)
+    overrides the generated ID.
+    """
+    for index, line_number, row in iter_csv_records(fileobj):
+        custom_id = row_custom_id(row, index, line_number, id_field)
+        yield build_request(custom_id, _prompt_from_row(row, line_number), model, max_tokens, system)
+
+
+def iter_file_requests(fileobj, filename, model=DEFAULT_MODEL, max_tokens=DEFAULT_MAX_TOKENS, system=None,
+                       id_field=None):
+    """Stream requests out of an uploaded JSONL or CSV file (binary file object), one per row"""
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    if file_format(filename) == "csv":
+        return iter_csv_requests(text, model, max_tokens, system, id_field)
+    return iter_jsonl_requests(text, model, max_tokens, system, id_field)
+
+
+def shard_requests(requests, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """Group a stream of requests into lists that fit within a single batch.
+
+    Only one shard is held in memory at a time.
+    """
+    shard = []
+    shard_bytes = 2  # surrounding "[]"
+    custom_ids = set()
+    for request in requests:
+        request_bytes = len(json.dumps(request).encode()) + 1  # trailing comma
+        if request_bytes + 2 > max_bytes:
+            raise ValueError(f"Request {request['custom_id']} is larger than the batch size limit")
+
+        if shard and (len(shard) >= max_requests or shard_bytes + request_bytes > max_bytes):
+            yield shard
+            shard = []
+            shard_bytes = 2
+            custom_ids = set()
+
+        if request["custom_id"] in custom_ids:
+            raise ValueError(f"Duplicate custom_id {request['custom_id']}")
+        custom_ids.add(request["custom_id"])
+        shard.append(request)
+        shard_bytes += request_bytes
+
+    if shard:
+        yield shard
+
+
+def _request_total(counts):
+    return counts.processing + counts.succeeded + counts.errored + counts.canceled + counts.expired
+
+
+_reconciled = set()
+_reconciled_lock = threading.Lock()
+
+
+def reconcile_timed_out_create(listed, request_count, since):
+    """The batch a timed-out create made after all, from the listed newest batches, or None.
+
+    It is the oldest batch created since the create started with the same
+    number of requests that is neither stored locally nor already taken by
+    another timed-out create of this process.
+    """
+    candidates = [
+        message_batch for message_batch in listed
+        if message_batch.created_at.timestamp() >= since - RECONCILE_CLOCK_SKEW
+        and _request_total(message_batch.request_counts) == request_count
+    ]
+    if not candidates:
+        return None
+    with connection() as conn:
+        placeholders = ','.join('?' * len(candidates))
+        known = {row[0] for row in conn.execute(f"SELECT batch_id FROM batches WHERE batch_id IN ({placeholders})",
+                                                [message_batch.id for message_batch in candidates])}
+    with _reconciled_lock:
+        for message_batch in sorted(candidates, key=lambda message_batch: message_batch.created_at):
+            if message_batch.id not in known and message_batch.id not in _reconciled:
+                _reconciled.add(message_batch.id)
+                logging.warning(f"Creating a batch of {request_count} requests timed out, "
+                                f"but it was created as {message_batch.id}")
+                return message_batch
+    return None
+
+
+def create_batch(client, requests):
+    """Send the requests without a cached response to the API; returns (hits, batch_id, status).
+
+    ``batch_id`` and ``status`` are None when every request was a cache hit.
+    If the create times out, the batch it may have made anyway is looked up
+    before the timeout is raised.
+    """
+    hits, misses = split_cached(requests)
+    batch_id = status = None
+    if misses:
+        started = time.time()
+        try:
+            with api_call('create'):
+                message_batch = client.messages.batches.create(requests=misses)
+        except anthropic.APITimeoutError:
+            with api_call('list'):
+                listed = client.messages.batches.list(limit=RECONCILE_PAGE_SIZE).data
+            message_batch = reconcile_timed_out_create(listed, len(misses), started)
+            if message_batch is None:
+                raise
+        batch_id, status = message_batch.id, message_batch.processing_status
+    return hits, batch_id, status
+
+
+def record_submission(batch_id, status, requests, hits, parent_batch_id=None, username=None, source_id=None):
+    """Save a created batch and its cache hits in one transaction; returns its SubmittedBatch.
+
+    ``batch_id`` is None when every request was a cache hit, in which case
+    the batch gets a local ``cached_`` ID and is stored as ended. Callers
+    that keep their own record of the batch can wrap this in their
+    transaction, so both are written together or not at all.
+    """
+    misses = len(requests) - len(hits)
+    if batch_id is None:
+        batch_id, status = f"cached_{uuid.uuid4().hex}", "ended"
+
+    with transaction():
+        save_batch_to_db(batch_id, requests, parent_batch_id, username, source_id)
+        if hits:
+            store_cached_results(batch_id, hits)
+        if not misses:
+            mark_ingested(batch_id)
+            mark_batch_handled(batch_id)
+
+    logging.info(f"Submitted batch {batch_id} with {misses} requests ({len(hits)} served from cache)")
+    return SubmittedBatch(batch_id, status, len(requests), len(hits))
+
+
+def submit_batch(client, requests, parent_batch_id=None, username=None, source_id=None):
+    """Submit one batch, serving requests that have a cached response locally.
+
+    Only cache misses are sent to the API. Returns a SubmittedBatch; when
+    every request is a cache hit no API batch is created and the batch ID is
+    a local ``cached_`` one whose results are already stored. Retry batches
+    pass the batch they retry as parent_batch_id; username records the owner
+    and source_id the uploaded file the requests were read from.
+    """
+    hits, batch_id, status = create_batch(client, requests)
+    return record_submission(batch_id, status, requests, hits, parent_batch_id, username, source_id)
@@ -0,0 +1,65 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import threading
+from datetime import datetime, timezone
+from queue import Queue
+
+LOG_FILE = os.getenv('LOG_FILE', 'batch_monitor.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including any ``extra`` fields of the record"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """Route logging through a queue so callers never wait on file or console I/O.
+
+    Records are put on an unbounded queue by a QueueHandler and written by a
+    QueueListener thread as JSON lines to LOG_FILE and the console. Safe to
+    call more than once.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+
+        formatter = JsonFormatter()
+        handlers = [logging.FileHandler(LOG_FILE), logging.StreamHandler()]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        queue = Queue()
+        listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+        # Replace handlers added by an implicit basicConfig() from an early logging call
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(logging.handlers.QueueHandler(queue))
+        _configured = True
@@ -1,25 +1,81 @@
+import asyncio
 import time
 import streamlit as st
-import anthropic
-from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
-from anthropic.types.messages.batch_create_params import Request
-from batch_monitor import BatchMonitor
-from database import init_db, verify_credentials, save_batch_to_db, update_batch_status, get_batch_history, get_batch_messages
+from database import init_db, verify_credentials, get_user, list_users, save_user, record_batch_statuses, get_status_snapshot, get_batch_progress, get_batch_history, get_batch_requests
+from ingestion import DEFAULT_MAX_TOKENS, MODELS, build_request, shared_prefix, iter_file_requests, shard_requests
+from result_store import results_ingested, count_matching_results, query_results, get_result
+from search import search
+from export import EXPORT_DIR, prepare_downloads, replaced_when_done
+from sources import create_source, track_rows, source_of_batch, get_source, join_results
+from usage import get_batch_usage, get_daily_usage
+from retry import job_status
+from scheduler import PRIORITIES, enqueue_submission, get_submissions, queue_position
+from metrics import instrumented_http_client
 import os
 from dotenv import load_dotenv
-import json
 import datetime
-init_db()
+
+# A status written by the monitor less than this many seconds ago is shown without calling the API
+STATUS_SNAPSHOT_TTL = float(os.getenv('STATUS_SNAPSHOT_TTL', '60'))
+# How often the status panel re-reads the monitor's snapshot from the database (seconds)
+STATUS_REFRESH_INTERVAL = float(os.getenv('STATUS_REFRESH_INTERVAL', '5'))
+
+
+# Process-wide resources, created on first use instead of on every rerun
+@st.cache_resource
+def setup_database():
+    init_db()
+
+
+@st.cache_resource
+def get_client():
+    import anthropic
+
+    return anthropic.Anthropic(
+        api_key=os.getenv('ANTHROPIC_API_KEY'),
+        http_client=instrumented_http_client())
+
+
+@st.cache_resource
+def get_monitor():
+    """The monitor running inside the app, or None when a standalone worker polls (EMBEDDED_MONITOR=false)"""
+    from batch_monitor import BatchMonitor
+
+    if not BatchMonitor.autostart:
+        return None
+    return BatchMonitor()
+
+
+def wake_monitor():
+    """Have the embedded monitor submit newly queued batches now; a standalone worker checks the queue by itself"""
+    monitor = get_monitor()
+    if monitor is not None:
+        monitor.wake()
+
+
+@st.cache_resource
+def get_engine():
+    import async_engine
+
+    return async_engine.get_engine()
+
+
+setup_database()
+# Started with the app, so pending batches and queued submissions are picked
+# up after a restart without waiting for the next submission
+get_monitor()
 
 # Initialize session state variables
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
+if "username" not in st.session_state:
+    st.session_state.username = None
 if "batch_id" not in st.session_state:
     st.session_state.batch_id = None
 if "batch_status" not in st.session_state:
     st.session_state.batch_status = None
-if "results" not in st.session_state:
-    st.session_state.results = None
+if "history_cursors" not in st.session_state:
+    st.session_state.history_cursors = [None]
 
 # Login page
 def login_page():
@@ -31,16 +87,79 @@ def login_page():
     if st.button("Login"):
         if verify_credentials(username, password):
             st.session_state.authenticated = True
+            st.session_state.username = username
             st.success("Login successful!")
             st.rerun()
         else:
             st.error("Invalid username or password")
 
+def current_batch_status(client, batch_id):
+    """Status of a batch, from the monitor's snapshot when it is recent enough"""
+    snapshot = get_status_snapshot(batch_id)
+    if snapshot is not None:
+        status, checked_at = snapshot
+        # Ended is final, so it never needs to be checked again
+        if status == "ended" or (checked_at and time.time() - checked_at < STATUS_SNAPSHOT_TTL):
+            return status
+
+    message_batch = client.messages.batches.retrieve(batch_id)
+    record_batch_statuses([message_batch], time.time())
+    return message_batch.processing_status
+
+
+def progress_eta(progress, now=None):
+    """(fraction of requests finished, estimated seconds to completion or None) of a get_batch_progress() dict"""
+    counts = progress['counts']
+    if progress['status'] == "ended":
+        return 1.0, None
+    if counts['processing'] is None or not sum(counts.values()):
+        return 0.0, None
+    total = sum(counts.values())
+    done = total - counts['processing']
+    # Extrapolate the completion rate so far, as the monitor does for its polling cadence
+    elapsed = (progress['status_checked_at'] or now or time.time()) - (progress['created_at'] or 0)
+    if not done or elapsed <= 0:
+        return done / total, None
+    return done / total, counts['processing'] / (done / elapsed)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m" if hours else f"{minutes}m {seconds:02d}s"
+
+
+@st.fragment(run_every=STATUS_REFRESH_INTERVAL)
+def status_panel(batch_id):
+    """Live status of a batch, re-read from the monitor's snapshot without calling the API"""
+    progress = get_batch_progress(batch_id)
+    if progress is None:
+        st.caption("This batch is not tracked locally; use Refresh Batch Status to look it up.")
+        return
+
+    fraction, eta = progress_eta(progress)
+    counts = progress['counts']
+    if counts['processing'] is not None:
+        finished = sum(counts.values()) - counts['processing']
+        st.progress(fraction, text=f"{progress['status']}: {finished} of {sum(counts.values())} requests finished")
+        st.caption(" · ".join(f"{counts[name]} {name}" for name in ('succeeded', 'errored', 'canceled', 'expired')
+                              if counts[name]) or "No requests finished yet")
+    else:
+        st.write(f"Current Processing Status: {progress['status']}")
+    if eta is not None:
+        st.caption(f"Estimated time remaining: {format_duration(eta)}")
+    if progress['status_checked_at']:
+        st.caption(f"Checked {format_duration(time.time() - progress['status_checked_at'])} ago by the monitor")
+
+    if progress['status'] != st.session_state.batch_status and batch_id == st.session_state.batch_id:
+        st.session_state.batch_status = progress['status']
+        if progress['status'] == "ended":
+            # The results section below depends on the status
+            st.rerun()
+
 # Main application
 def main_app():
-    # Initialize Anthropic client
-    client = anthropic.Anthropic(
-        api_key=os.getenv('ANTHROPIC_API_KEY'))
+    client = get_client()
     
     st.title("Claude Batch API Interface")
 
@@ -67,44 +186,99 @@ def main_app():
 
         create_new_batch = st.checkbox("I want to create a new batch")
         if create_new_batch:
-            num_messages = st.number_input("How many messages do you want to send?", min_value=1, max_value=10, value=2, step=1)
-            message_inputs = {}
-            for i in range(int(num_messages)):
-                message_inputs[f"message_{i}"] = st.text_area(f"Message {i+1}", key=f"msg_{i}", value=f"Hello, this is message {i+1}")
-
-            if st.button("Submit Batch Creation"):
-                requests = []
-                for i, message in enumerate(message_inputs.values()):
-                    requests.append(
-                        Request(
-                            custom_id=f"message-{i}",
-                            params=MessageCreateParamsNonStreaming(
-                                model="claude-3-5-sonnet-20241022",
-                                max_tokens=1024,
-                                messages=[
-                                    {
-                                        "role": "user",
-                                        "content": message,
-                                    }
-                                ],
-                            ),
-                        )
-                    )
-                try:
-                    message_batch = client.messages.batches.create(requests=requests)
-                    if message_batch.id:
-                        monitor = BatchMonitor()
-                        monitor.add_batch(message_batch.id)
-                    st.session_state.batch_id = message_batch.id
-                    st.session_state.batch_status = message_batch.processing_status
-                    st.success("Batch created successfully!")
-                    st.info(f"Batch ID: {message_batch.id}\n\nCopy this ID for future reference.")
-                    st.text_input("Copy Batch ID", value=message_batch.id, key="copy_batch_id")
-                    
-                    # Save batch to database
-                    save_batch_to_db(message_batch.id, json.dumps(requests))
-                except Exception as e:
-                    st.error(f"Error creating batch: {e}")
+            col_model, col_tokens = st.columns([2, 1])
+            with col_model:
+                model = st.selectbox("Model", MODELS)
+            with col_tokens:
+                max_tokens = st.number_input("Max tokens", min_value=1, max_value=64000, value=DEFAULT_MAX_TOKENS, step=256)
+            max_tokens = int(max_tokens)
+
+            # Sent as the same system prefix with every request, so the API can cache it
+            st.markdown("**Shared prompt** (optional, sent with every request of the batch)")
+            system_prompt = st.text_area("System prompt / instructions", key="system_prompt")
+            shared_context = st.text_area("Shared context or document", key="shared_context", height=150)
+            system = shared_prefix(system_prompt, shared_context)
+            if system:
+                st.caption("The shared prompt is marked for prompt caching; prefixes shorter than about 1024 tokens are not cached.")
+
+            # Priorities above normal skip everyone else's fair share, so only admins get them
+            user = get_user(st.session_state.username)
+            priorities = [name for name, value in PRIORITIES.items()
+                          if value <= PRIORITIES['normal'] or (user and user['is_admin'])]
+            priority = st.radio("Priority", priorities, index=priorities.index('normal'), horizontal=True)
+            input_method = st.radio("Input method", ["Type messages", "Upload JSONL/CSV file"], horizontal=True)
+
+            if input_method == "Type messages":
+                num_messages = st.number_input("How many messages do you want to send?", min_value=1, max_value=10, value=2, step=1)
+                message_inputs = {}
+                for i in range(int(num_messages)):
+                    message_inputs[f"message_{i}"] = st.text_area(f"Message {i+1}", key=f"msg_{i}", value=f"Hello, this is message {i+1}")
+
+                if st.button("Submit Batch Creation"):
+                    requests = [
+                        build_request(f"message-{i}", message, model, max_tokens, system)
+                        for i, message in enumerate(message_inputs.values())
+                    ]
+                    try:
+                        # The monitor submits queued batches in fair order as quotas allow
+                        entry_id = enqueue_submission(st.session_state.username, requests, PRIORITIES[priority])
+                        wake_monitor()
+                        st.success(f"Batch queued for submission (#{entry_id}). "
+                                   "Its Batch ID appears under \"Your Submissions\" once it is submitted.")
+                    except Exception as e:
+                        st.error(f"Error creating batch: {e}")
+            else:
+                st.markdown(
+                    "Upload a JSONL file (one request, params object or `prompt` per line) or a CSV file "
+                    "with a `prompt` column. Large files are split automatically into several batches."
+                )
+                uploaded_file = st.file_uploader("Requests file", type=["jsonl", "csv"])
+                # Each row's custom_id is recorded, so results can be joined back onto the file later
+                id_field = st.text_input("ID column (optional)",
+                                         help="Use this column / key of each row as its custom_id instead of "
+                                              "`custom_id` or the row number")
+
+                if uploaded_file is not None and st.button("Submit Batches"):
+                    queued = 0
+                    try:
+                        source_id = create_source(uploaded_file.name, id_field.strip(), st.session_state.username)
+                        requests = track_rows(source_id, iter_file_requests(
+                            uploaded_file, uploaded_file.name, model, max_tokens, system, id_field.strip() or None))
+                        for shard in shard_requests(requests):
+                            entry_id = enqueue_submission(st.session_state.username, shard, PRIORITIES[priority],
+                                                          source_id)
+                            queued += 1
+                            st.write(f"Queued batch #{entry_id} with {len(shard)} requests")
+                    except Exception as e:
+                        st.error(f"Error creating batch: {e}")
+
+                    if queued:
+                        wake_monitor()
+                        st.success(f"{queued} batch(es) queued for submission from source #{source_id}.")
+
+        # Queue entries turn into batches as the scheduler releases them
+        st.markdown("### Your Submissions")
+        submissions = get_submissions(st.session_state.username, limit=10)
+        if not submissions:
+            st.caption("Nothing submitted yet.")
+        for entry in submissions:
+            col_entry, col_state, col_use = st.columns([2, 2, 1])
+            with col_entry:
+                st.write(f"#{entry['id']} · {entry['request_count']} requests")
+            with col_state:
+                if entry['status'] == 'queued':
+                    st.write(f"queued, position {queue_position(entry['id'])}")
+                elif entry['status'] == 'submitting':
+                    st.write("submitting...")
+                elif entry['status'] == 'failed':
+                    st.write(f"failed: {entry['error']}")
+                else:
+                    st.write(entry['batch_id'])
+            with col_use:
+                if entry['batch_id'] and st.button("Use", key=f"use_entry_{entry['id']}"):
+                    st.session_state.batch_id = entry['batch_id']
+                    st.session_state.batch_status = get_status_snapshot(entry['batch_id'])[0]
+                    st.rerun()
 
     # ----------------- SECTION 3: TRACK BATCH STATUS -----------------
     with st.expander("2. Track Batch Status"):
@@ -112,15 +286,24 @@ def main_app():
             st.info("No Batch ID provided or created yet.")
         else:
             st.write(f"Batch ID: {st.session_state.batch_id}")
+            status_panel(st.session_state.batch_id)
 
         if st.button("Refresh Batch Status"):
             try:
-                message_batch = client.messages.batches.retrieve(st.session_state.batch_id)
-                st.session_state.batch_status = message_batch.processing_status
-                st.write(f"Current Processing Status: {message_batch.processing_status}")
-                
-                # Update batch status in database
-                update_batch_status(st.session_state.batch_id, message_batch.processing_status)
+                status = current_batch_status(client, st.session_state.batch_id)
+                st.session_state.batch_status = status
+                st.write(f"Current Processing Status: {status}")
+
+                # Failed requests may be resubmitted automatically as retry batches of the same job
+                job = job_status(st.session_state.batch_id)
+                if len(job['batches']) > 1 or not job['finished'] and status == "ended":
+                    attempts = ", ".join(f"{batch['batch_id']} (attempt {batch['attempt']}, {batch['status']})"
+                                         for batch in job['batches'])
+                    st.write(f"Job {job['root_batch_id']}: {'finished' if job['finished'] else 'in progress'}")
+                    st.caption(f"Batches: {attempts}")
+                    if job['outcomes']:
+                        st.caption("Final outcomes: " + ", ".join(f"{count} {result_type}"
+                                                                   for result_type, count in job['outcomes'].items()))
             except Exception as e:
                 st.error(f"Error retrieving batch status: {e}")
 
@@ -132,44 +315,139 @@ def main_app():
             if st.session_state.batch_status != "ended":
                 st.warning("Batch processing is not ended yet. Ensure the batch is complete before retrieving results.")
             else:
-                if st.button("Retrieve Results"):
-                    try:
-                        results = []
-                        for result in client.messages.batches.results(st.session_state.batch_id):
-                            results.append(result)
-                        st.session_state.results = results
-                        st.success("Results retrieved successfully!")
-                    except Exception as e:
-                        st.error(f"Error retrieving results: {e}")
+                # Results of an ended batch never change, so they are downloaded once
+                # into the local store and read back from there. The download runs on
+                # the async engine, so the page stays responsive meanwhile.
+                download = st.session_state.get('results_download')
+                if download is not None and download['batch_id'] == st.session_state.batch_id:
+                    if not download['future'].done():
+                        st.info("Downloading results in the background...")
+                        st.button("Refresh")
+                    else:
+                        del st.session_state.results_download
+                        try:
+                            outcome = download['future'].result()[download['batch_id']]
+                            if isinstance(outcome, BaseException):
+                                raise outcome
+                            st.success(f"Retrieved {outcome} results.")
+                        except Exception as e:
+                            st.error(f"Error retrieving results: {e}")
+                elif not results_ingested(st.session_state.batch_id) and st.button("Retrieve Results"):
+                    st.session_state.results_download = {
+                        'batch_id': st.session_state.batch_id,
+                        'future': get_engine().ingest_batches([st.session_state.batch_id]),
+                    }
+                    st.rerun()
+
+                if results_ingested(st.session_state.batch_id):
+                    batch_id = st.session_state.batch_id
+                    # Download files are written to disk in the background and shared by
+                    # all sessions; only their paths are kept in the session
+                    downloads = st.session_state.get('downloads')
+                    if downloads is not None and downloads['batch_id'] != batch_id:
+                        downloads = None
+                    if downloads is None and st.button("Prepare downloads"):
+                        st.session_state.downloads = {
+                            'batch_id': batch_id,
+                            'future': get_engine().run(asyncio.to_thread(prepare_downloads, batch_id)),
+                        }
+                        st.rerun()
+                    if downloads is not None and not downloads['future'].done():
+                        st.info("Preparing downloads...")
+                        st.button("Refresh", key="refresh_downloads")
+                    elif downloads is not None:
+                        try:
+                            paths = downloads['future'].result()
+                        except Exception as e:
+                            del st.session_state.downloads
+                            st.error(f"Error preparing downloads: {e}")
+                            paths = {}
+                        for kind, label, mime in (("report", "report (HTML)", "text/html"),
+                                                  ("jsonl", "results (JSONL.gz)", "application/gzip"),
+                                                  ("parquet", "results (Parquet)", "application/vnd.apache.parquet")):
+                            if kind in paths:
+                                with open(paths[kind], 'rb') as f:
+                                    st.download_button(f"Download {label}", f, file_name=os.path.basename(paths[kind]),
+                                                       mime=mime)
+                        if paths and 'parquet' not in paths:
+                            st.caption("Install pyarrow to download results as Parquet.")
+
+                    # Batches submitted from a file can have their results added to each row of it
+                    source = get_source(source_of_batch(batch_id))
+                    if source is not None:
+                        st.markdown(f"**Source file:** {source['filename']} ({source['row_count']} rows, source #{source['id']})")
+                        original = st.file_uploader("Original file, to add the results to each row",
+                                                    type=[source['format']], key=f"join_{source['id']}")
+                        if original is not None and st.button("Join results onto file"):
+                            try:
+                                # Streamed to a file rather than held in memory, whatever the size of the source
+                                name, _, extension = source['filename'].rpartition('.')
+                                os.makedirs(EXPORT_DIR, exist_ok=True)
+                                path = os.path.join(EXPORT_DIR, f"source_{source['id']}.joined.{extension}")
+                                with replaced_when_done(path) as tmp:
+                                    rows_written, with_results = join_results(source['id'], original, tmp)
+                                with open(path, 'rb') as f:
+                                    st.download_button(f"Download joined file ({with_results} of {rows_written} rows have results)",
+                                                       f, file_name=f"{name}.joined.{extension}")
+                            except ValueError as e:
+                                st.error(str(e))
 
-                if st.session_state.results is not None:
                     st.markdown("### Batch Results")
-                    for result in st.session_state.results:
-                        custom_id = result.custom_id
-                        result_type = result.result.type
-                        if result_type == "succeeded":
-                            st.write(f"✅ {custom_id}: Success")
-                            st.json(result.result.message)
-                        elif result_type == "errored":
-                            st.write(f"❌ {custom_id}: Error")
-                            st.json(result.result.error)
-                        elif result_type == "canceled":
-                            st.write(f"⚠️ {custom_id}: Canceled")
-                        elif result_type == "expired":
-                            st.write(f"⌛ {custom_id}: Expired")
-                        else:
-                            st.write(f"{custom_id}: Unknown result type: {result_type}")
-                            
+                    col_type, col_search, col_size = st.columns([1, 2, 1])
+                    with col_type:
+                        result_type = st.selectbox("Result type", ["all", "succeeded", "errored", "canceled", "expired"])
+                    with col_search:
+                        result_query = st.text_input("Search custom_id (substring) or response words")
+                    with col_size:
+                        page_size = st.selectbox("Per page", [25, 50, 100], index=1)
+
+                    # Filtering and paging run in SQLite; only the visible page is loaded
+                    result_type = None if result_type == "all" else result_type
+                    total = count_matching_results(batch_id, result_type, result_query)
+                    pages = max((total + page_size - 1) // page_size, 1)
+                    page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, step=1)
+                    rows = query_results(batch_id, result_type, result_query, limit=page_size, offset=(page - 1) * page_size)
+
+                    st.caption(f"{total} matching results")
+                    if rows:
+                        st.dataframe(rows, use_container_width=True, hide_index=True)
+
+                        selected = st.selectbox("Show full result", ["-"] + [row['custom_id'] for row in rows])
+                        if selected != "-":
+                            result = get_result(batch_id, selected)
+                            if result.result.type == "succeeded":
+                                st.json(result.result.message.to_dict())
+                            elif result.result.type == "errored":
+                                st.json(result.result.error.to_dict())
+                            else:
+                                st.write(f"{selected}: {result.result.type}")
+
 
     # ----------------- SECTION 5: BATCH HISTORY -----------------
     with st.expander("4. Batch History"):
         st.markdown("### Previous Batches")
         
         if st.button("Refresh Batch History"):
+            st.session_state.history_cursors = [None]
             st.rerun()
-            
-        batches = get_batch_history()
-        
+
+        # Usage and cost come from rollups kept up to date as results are stored
+        daily_usage = get_daily_usage()
+        if daily_usage:
+            st.markdown("### Usage by Day")
+            st.dataframe(
+                [{"day": day["day"], "requests": day["requests"], "succeeded": day["succeeded"],
+                  "errored": day["errored"], "input tokens": day["input_tokens"],
+                  "output tokens": day["output_tokens"], "cache write tokens": day["cache_creation_tokens"],
+                  "cache read tokens": day["cache_read_tokens"], "est. cost ($)": round(day["cost"], 4)}
+                 for day in daily_usage],
+                use_container_width=True, hide_index=True)
+
+        # Stack of page cursors; the last entry is the page being shown
+        cursors = st.session_state.history_cursors
+        batches, next_cursor = get_batch_history(cursor=cursors[-1])
+        usage = get_batch_usage(batch['batch_id'] for batch in batches)
+
         if not batches:
             st.info("No batch history found.")
         else:
@@ -177,38 +455,108 @@ def main_app():
             for batch in batches:
                 with st.container():
                     col1, col2, col3 = st.columns([2, 1, 1])
-                    
+
                     with col1:
                         st.markdown(f"**Batch ID:** {batch['batch_id']}")
                     with col2:
                         status_color = "green" if batch['status'] == "ended" else "orange"
                         st.markdown(f"**Status:** <span style='color:{status_color}'>{batch['status']}</span>", unsafe_allow_html=True)
                     with col3:
-                        created_at = datetime.datetime.strptime(batch['created_at'].split('.')[0], '%Y-%m-%d %H:%M:%S')                        
+                        created_at = datetime.datetime.strptime(batch['created_at'].split('.')[0], '%Y-%m-%d %H:%M:%S')
                         st.markdown(f"**Created:** {created_at.strftime('%Y-%m-%d %H:%M')}")
-                    
+
+                    batch_usage = usage.get(batch['batch_id'])
+                    if batch_usage:
+                        st.caption(
+                            f"{batch_usage['succeeded']} succeeded, {batch_usage['errored']} errored, "
+                            f"{batch_usage['canceled'] + batch_usage['expired']} canceled/expired, "
+                            f"{batch_usage['cached']} from cache · "
+                            f"{batch_usage['input_tokens']:,} input / {batch_usage['output_tokens']:,} output / "
+                            f"{batch_usage['cache_read_tokens']:,} cache read tokens · "
+                            f"est. ${batch_usage['cost']:.4f}")
+
                     # Use this batch button
                     if st.button(f"Use this batch", key=f"use_{batch['batch_id']}"):
                         st.session_state.batch_id = batch['batch_id']
                         st.session_state.batch_status = batch['status']
                         st.success(f"Now using batch {batch['batch_id']}")
                         st.rerun()
-                    
-                    # Show messages
-                    st.markdown("**Messages:**")
-                    messages = json.loads(batch['messages']) if isinstance(batch['messages'], str) else batch['messages']
-                    if messages:
-                        messages_list = messages[0]['params']['messages']
-                        for j, message in enumerate(messages_list):
-                            st.markdown(f"**Message {j+1}:**")
-                            st.text_area(f"Content", value=message['content'], height=100, key=f"hist_msg_{batch['batch_id']}_{j}", disabled=True)
-                    else:
-                        st.info("No messages stored for this batch.")
-                    
+
+                    # Messages are only loaded once the batch is expanded
+                    request_count = batch['request_count'] or 0
+                    if st.toggle(f"Show messages ({request_count})", key=f"show_{batch['batch_id']}"):
+                        requests, more = get_batch_requests(batch['batch_id'])
+                        if requests:
+                            for request in requests:
+                                st.markdown(f"**{request['custom_id']}:**")
+                                for j, message in enumerate(request['params']['messages']):
+                                    st.text_area(f"Content", value=str(message['content']), height=100,
+                                                 key=f"hist_msg_{batch['batch_id']}_{request['custom_id']}_{j}", disabled=True)
+                            if more is not None:
+                                st.caption(f"Showing the first {len(requests)} of {request_count} messages.")
+                        else:
+                            st.info("No messages stored for this batch.")
+
                     st.markdown("---")
 
+            col_newer, col_older = st.columns(2)
+            with col_newer:
+                if len(cursors) > 1 and st.button("Newer batches"):
+                    cursors.pop()
+                    st.rerun()
+            with col_older:
+                if next_cursor is not None and st.button("Older batches"):
+                    cursors.append(next_cursor)
+                    st.rerun()
+
+    # ----------------- SECTION 6: SEARCH -----------------
+    with st.expander("5. Search Prompts and Responses"):
+        col_query, col_kind = st.columns([3, 1])
+        with col_query:
+            query = st.text_input("Search all batches", key="search_query")
+        with col_kind:
+            kind = st.selectbox("In", ["prompts and responses", "prompts", "responses"], key="search_kind")
+
+        if query:
+            kind = {"prompts": "prompt", "responses": "response"}.get(kind)
+            hits = search(query, kind=kind)
+            if not hits:
+                st.info("No matches found.")
+            else:
+                st.caption(f"Best {len(hits)} matches")
+                st.dataframe(hits, use_container_width=True, hide_index=True)
+
+                labels = [f"{hit['batch_id']} / {hit['custom_id']}" for hit in hits]
+                selected = st.selectbox("Open batch of", ["-"] + list(dict.fromkeys(labels)))
+                if selected != "-" and st.button("Use this batch", key="use_search_hit"):
+                    batch_id = hits[labels.index(selected)]['batch_id']
+                    st.session_state.batch_id = batch_id
+                    st.session_state.batch_status = get_status_snapshot(batch_id)[0]
+                    st.success(f"Now using batch {batch_id}")
+                    st.rerun()
+
+    # ----------------- SECTION 7: USERS (admins only) -----------------
+    user = get_user(st.session_state.username)
+    if user and user['is_admin']:
+        with st.expander("Users and Fair Share"):
+            st.markdown("Queued batches of different users are released in proportion to their weight.")
+            st.dataframe(list_users(), use_container_width=True, hide_index=True)
+
+            new_username = st.text_input("Username", key="user_name")
+            new_password = st.text_input("Password (leave empty to keep)", type="password", key="user_password")
+            new_weight = st.number_input("Weight", min_value=0.1, max_value=100.0, value=1.0, step=0.5, key="user_weight")
+            new_is_admin = st.checkbox("Admin", key="user_is_admin")
+            if st.button("Save user") and new_username:
+                if get_user(new_username) is None and not new_password:
+                    st.error("New users need a password.")
+                else:
+                    save_user(new_username, new_password or None, new_weight, new_is_admin)
+                    st.success(f"Saved user {new_username}")
+                    st.rerun()
+
 def logout():
     st.session_state.authenticated = False
+    st.session_state.username = None
     st.rerun()
 
 # Main app flow
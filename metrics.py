@@ -0,0 +1,286 @@
+"""In-process metrics with a Prometheus text exporter.
+
+Counters, gauges and histograms are registered at import time by the
+modules that use them. Set METRICS_PORT to serve them over HTTP at
+/metrics, or METRICS_FILE to have them written to a file periodically
+(for the node exporter textfile collector, for instance).
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import ContextDecorator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from sub-millisecond SQLite queries to slow API calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            state['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def time(self, **labels):
+        """Context manager / decorator that observes the wall time of a block"""
+        return _Timer(self, labels)
+
+    def _render_sample(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), state['counts']):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, [('le', _format_value(bound))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.label_names, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(state["sum"])}')
+        lines.append(f'{self.name}_count{labels} {state["count"]}')
+        return lines
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def _recreate_cm(self):
+        # A fresh timer per call, so a decorated function can run on several threads at once
+        return _Timer(self.histogram, self.labels)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name, documentation, labels=()):
+    return REGISTRY.register(Gauge(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+# Metrics shared by several modules
+API_LATENCY = histogram('batch_api_request_seconds', 'Latency of Message Batches API calls', ['operation'])
+API_ERRORS = counter('batch_api_errors_total', 'Failed Message Batches API calls', ['operation', 'error'])
+API_RETRYABLE_RESPONSES = counter(
+    'batch_api_retryable_responses_total',
+    'HTTP responses from the API that the client retries (429 and 5xx)', ['status'])
+DB_QUERY_LATENCY = histogram('db_query_seconds', 'Latency of database operations', ['query'])
+
+
+class api_call(ContextDecorator):
+    """Time an API call and count it as an error if it raises"""
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        API_LATENCY.observe(time.perf_counter() - self.start, operation=self.operation)
+        if exc_type is not None:
+            API_ERRORS.inc(operation=self.operation, error=exc_type.__name__)
+        return False
+
+
+def count_retryable_response(response):
+    """httpx response hook counting responses the Anthropic client will retry"""
+    if response.status_code == 429 or response.status_code >= 500:
+        API_RETRYABLE_RESPONSES.inc(status=response.status_code)
+
+
+def instrumented_http_client(response_hooks=()):
+    """HTTP client for anthropic.Anthropic that feeds the retryable response counter.
+
+    response_hooks are further httpx response hooks, called for every response.
+    """
+    import anthropic
+
+    return anthropic.DefaultHttpxClient(event_hooks={'response': [count_retryable_response, *response_hooks]})
+
+
+def instrumented_async_http_client(response_hooks=()):
+    """Same as instrumented_http_client(), for anthropic.AsyncAnthropic"""
+    import anthropic
+
+    hooks = [count_retryable_response, *response_hooks]
+
+    async def on_response(response):
+        for hook in hooks:
+            hook(response)
+
+    return anthropic.DefaultAsyncHttpxClient(event_hooks={'response': [on_response]})
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        data = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_metrics_file(path):
+    """Atomically replace path with the current metrics"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp_path, path)
+
+
+def _write_metrics_file_loop(path, interval):
+    while True:
+        try:
+            write_metrics_file(path)
+        except OSError as e:
+            logging.error(f"Failed to write metrics file {path}: {e}")
+        time.sleep(interval)
+
+
+_exporter_started = False
+_exporter_lock = threading.Lock()
+
+
+def start_exporter():
+    """Start the HTTP endpoint and/or file writer configured in the environment, once per process"""
+    global _exporter_started
+    with _exporter_lock:
+        if _exporter_started:
+            return
+        _exporter_started = True
+
+    metrics_port = os.getenv('METRICS_PORT')
+    metrics_file = os.getenv('METRICS_FILE')
+    interval = float(os.getenv('METRICS_FILE_INTERVAL', '15'))
+
+    if metrics_port:
+        try:
+            httpd = ThreadingHTTPServer(('0.0.0.0', int(metrics_port)), _MetricsHandler)
+        except OSError as e:
+            logging.error(f"Could not serve metrics on port {metrics_port}: {e}")
+        else:
+            httpd.daemon_threads = True
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            logging.info(f"Serving metrics on port {metrics_port}")
+
+    if metrics_file:
+        threading.Thread(target=_write_metrics_file_loop, args=(metrics_file, interval), daemon=True).start()
+        logging.info(f"Writing metrics to {metrics_file} every {interval:.0f}s")
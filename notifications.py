@@ -0,0 +1,186 @@
+import logging
+import os
+import threading
+import time
+from queue import Queue, Empty
+
+from report import MAX_ATTACHMENT_BYTES, render_batch_report_html, build_results_attachment
+from result_store import iter_results
+from metrics import counter, histogram
+
+# Completions arriving within this many seconds are sent as one digest email
+DIGEST_WINDOW = float(os.getenv('NOTIFY_DIGEST_WINDOW', '60'))
+# Delivery attempts per email, with exponential backoff starting at NOTIFY_RETRY_BACKOFF seconds
+MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', '5'))
+RETRY_BACKOFF = float(os.getenv('NOTIFY_RETRY_BACKOFF', '5'))
+# An idle SMTP session is closed after this many seconds
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', '300'))
+
+SMTP_SEND_LATENCY = histogram('smtp_send_seconds', 'Time to send one notification email, including reconnects')
+EMAILS_SENT = counter('notification_emails_total', 'Notification emails by outcome', ['outcome'])
+EMAIL_RETRIES = counter('notification_retries_total', 'Retried notification email sends')
+
+_STOP = object()
+
+
+class NotificationDispatcher:
+    """Sends completion emails from a background thread.
+
+    Completed batch IDs are queued by the monitor; the dispatcher collects
+    everything that completes within DIGEST_WINDOW into a single digest,
+    renders it, and sends it over an SMTP session that is kept open and
+    reused between emails.
+    """
+
+    def __init__(self):
+        self.smtp_server = os.getenv('SMTP_SERVER')
+        self.smtp_port = int(os.getenv('SMTP_PORT') or 587)
+        self.use_starttls = os.getenv('SMTP_STARTTLS', 'true').lower() == 'true'
+        self.sender_email = os.getenv('SENDER_EMAIL')
+        self.sender_password = os.getenv('SENDER_PASSWORD')
+        self.recipient_email = os.getenv('RECIPIENT_EMAIL')
+        self.digest_window = DIGEST_WINDOW
+
+        self.queue = Queue()
+        self.server = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def enabled(self):
+        return bool(self.smtp_server and self.recipient_email)
+
+    def enqueue(self, batch_id):
+        """Queue a completed batch for notification"""
+        self.queue.put(batch_id)
+
+    def stop(self, timeout=None):
+        """Send whatever is queued, close the SMTP session and stop the thread"""
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            try:
+                batch_id = self.queue.get(timeout=SMTP_IDLE_TIMEOUT)
+            except Empty:
+                self.close_session()
+                continue
+            if batch_id is _STOP:
+                break
+
+            # Coalesce everything that completes within the digest window
+            batch_ids = [batch_id]
+            deadline = time.monotonic() + self.digest_window
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch_id = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if batch_id is _STOP:
+                    stopping = True
+                    break
+                batch_ids.append(batch_id)
+
+            try:
+                self.deliver(batch_ids)
+            except Exception as e:
+                logging.error(f"Failed to send notification for batches {', '.join(batch_ids)}: {e}")
+
+        self.close_session()
+
+    def build_message(self, batch_ids, max_attachment_bytes=MAX_ATTACHMENT_BYTES):
+        """Build one email covering all given batches, with their results attached.
+
+        All attachments share one size budget; the results of a batch that do
+        not fit in what is left are not attached, and its report says so.
+        """
+        from email.mime.application import MIMEApplication
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+
+        msg = MIMEMultipart('mixed')
+        if len(batch_ids) == 1:
+            msg['Subject'] = f'Batch Processing Complete - {batch_ids[0]}'
+        else:
+            msg['Subject'] = f'Batch Processing Complete - {len(batch_ids)} batches'
+        msg['From'] = self.sender_email
+        msg['To'] = self.recipient_email
+
+        sections = []
+        attachments = []
+        remaining = max_attachment_bytes
+        for batch_id in batch_ids:
+            attachment = build_results_attachment(iter_results(batch_id), remaining)
+            if attachment is None:
+                logging.warning(f"Results of batch {batch_id} do not fit in the email's remaining "
+                                f"{remaining} attachment bytes; not attaching them")
+            else:
+                attachments.append((batch_id, attachment))
+                remaining -= len(attachment)
+
+            if len(batch_ids) > 1:
+                sections.append(f'<h1 style="font-family: Arial, sans-serif; color: #2c3e50;">Batch {batch_id}</h1>')
+            sections.append(render_batch_report_html(batch_id, attached=attachment is not None))
+
+        msg.attach(MIMEText(''.join(sections), 'html'))
+        for batch_id, attachment in attachments:
+            attachment_part = MIMEApplication(attachment, 'gzip')
+            attachment_part.add_header('Content-Disposition', 'attachment', filename=f'{batch_id}.jsonl.gz')
+            msg.attach(attachment_part)
+        return msg
+
+    def deliver(self, batch_ids):
+        """Send the notification for a list of batches, retrying with backoff"""
+        if not self.enabled:
+            logging.info(f"SMTP is not configured, skipping notification for {', '.join(batch_ids)}")
+            return
+
+        msg = self.build_message(batch_ids)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                with SMTP_SEND_LATENCY.time():
+                    self.session().send_message(msg)
+                EMAILS_SENT.inc(outcome='sent')
+                logging.info(f"Email notification sent for {', '.join(batch_ids)}")
+                return
+            except Exception as e:
+                # Drop the session, it is reopened on the next attempt
+                self.close_session()
+                if attempt == MAX_ATTEMPTS:
+                    EMAILS_SENT.inc(outcome='failed')
+                    raise
+                EMAIL_RETRIES.inc()
+                delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+                logging.warning(f"Sending email failed (attempt {attempt}/{MAX_ATTEMPTS}), retrying in {delay:.0f}s: {e}")
+                time.sleep(delay)
+
+    def session(self):
+        """Return the open SMTP session, reconnecting if it was closed or went stale"""
+        import smtplib
+
+        if self.server is not None:
+            try:
+                if self.server.noop()[0] == 250:
+                    return self.server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close_session()
+
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        if self.use_starttls:
+            server.starttls()
+        if self.sender_password:
+            server.login(self.sender_email, self.sender_password)
+        self.server = server
+        return server
+
+    def close_session(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            self.server.close()
+        self.server = None
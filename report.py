@@ -0,0 +1,198 @@
+import gzip
+import io
+import os
+import re
+import tempfile
+from collections import Counter
+from itertools import islice
+
+from metrics import histogram
+from result_store import iter_results, summarize_results
+
+# Number of results rendered inline; the rest only go into the attachment
+INLINE_RESULTS = int(os.getenv('REPORT_INLINE_RESULTS', '50'))
+# Total size of the compressed results attached to one email; batches that
+# do not fit in what is left are not attached
+MAX_ATTACHMENT_BYTES = int(os.getenv('REPORT_MAX_ATTACHMENT_BYTES', str(10 * 1024 * 1024)))
+
+# Escape HTML and keep line breaks / indentation in a single pass
+_CONTENT_PATTERN = re.compile(r'\n|  |[&<>"]')
+_CONTENT_REPLACEMENTS = {
+    '\n': '<br>',
+    '  ': '&nbsp;&nbsp;',
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+}
+
+_RESULT_LABELS = ("succeeded", "errored", "canceled", "expired")
+
+RENDER_LATENCY = histogram('report_render_seconds', 'Time to render a batch results report')
+
+
+def escape_text(text) -> str:
+    return _CONTENT_PATTERN.sub(lambda match: _CONTENT_REPLACEMENTS[match.group()], str(text))
+
+
+def format_message_content(content) -> str:
+    """Format the message content with preserved formatting"""
+    if isinstance(content, list):
+        parts = []
+        for block in content:
+            if hasattr(block, 'text'):
+                parts.append(f'<p style="margin: 8px 0;">{escape_text(block.text)}</p>')
+            else:
+                parts.append(f'<p>{escape_text(block)}</p>')
+        return ''.join(parts)
+    return escape_text(content)
+
+
+def write_result_html(out, idx, result):
+    """Write the HTML block for a single result"""
+    out.write(f"""
+    <div style="margin: 20px 0;">
+        <h3 style="color: #2c3e50; margin-bottom: 10px;">
+            Message {idx} (ID: {escape_text(result.custom_id)})
+        </h3>
+    """)
+
+    if result.result.type == "succeeded":
+        message = result.result.message
+        out.write(f"""
+        <div style="background-color: #f8f9fa; border-left: 4px solid #2ecc71;
+                    padding: 15px; border-radius: 4px; margin: 10px 0;">
+            <div style="margin-bottom: 10px;">
+                <strong style="color: #2c3e50;">Message ID:</strong>
+                <span style="color: #7f8c8d;">{message.id}</span>
+            </div>
+            <div style="background-color: white; padding: 15px; border-radius: 4px;
+                        margin-top: 10px; line-height: 1.6;">
+                <strong style="color: #2c3e50; display: block; margin-bottom: 10px;">
+                    Content:
+                </strong>
+                <div style="color: #34495e;">
+        """)
+        out.write(format_message_content(message.content))
+        out.write("""
+                </div>
+            </div>
+        </div>
+        """)
+    elif result.result.type == "errored":
+        out.write(f"""
+        <div style="background-color: #fff5f5; border-left: 4px solid #e74c3c;
+                    padding: 15px; border-radius: 4px; margin: 10px 0;">
+            <strong style="color: #c0392b;">Error:</strong>
+            <span style="color: #7f8c8d;">{escape_text(result.result.error)}</span>
+        </div>
+        """)
+    else:
+        out.write(f"""
+        <div style="background-color: #fff9e6; border-left: 4px solid #f1c40f;
+                    padding: 15px; border-radius: 4px; margin: 10px 0;">
+            <strong style="color: #f39c12;">Status:</strong>
+            <span style="color: #7f8c8d;">{result.result.type}</span>
+        </div>
+        """)
+
+    out.write("</div>")
+
+
+def write_summary_html(out, counts):
+    """Write the table of result counts by type"""
+    out.write("""
+    <table style="border-collapse: collapse; margin: 10px 0;">
+    """)
+    rows = [(label, counts.get(label, 0)) for label in _RESULT_LABELS]
+    rows += [(label, count) for label, count in counts.items() if label not in _RESULT_LABELS]
+    rows.append(("total", sum(counts.values())))
+    for label, count in rows:
+        out.write(f"""
+        <tr>
+            <td style="padding: 4px 12px; color: #2c3e50;">{label.capitalize()}</td>
+            <td style="padding: 4px 12px; text-align: right;">{count}</td>
+        </tr>
+        """)
+    out.write("</table>")
+
+
+@RENDER_LATENCY.time()
+def render_report(results, out, inline_limit=INLINE_RESULTS, attached=True, counts=None):
+    """Write an HTML report for a stream of results into ``out``.
+
+    Only the first ``inline_limit`` results are rendered, so memory use
+    depends on the inline limit rather than the batch size. With ``counts``
+    (result type -> count) given, only those results are read; otherwise the
+    whole stream is read once to count it for the summary. ``attached`` says
+    whether the full results go with the report.
+    """
+    inline = io.StringIO()
+    if counts is None:
+        counts = Counter()
+        for idx, result in enumerate(results, 1):
+            counts[result.result.type] += 1
+            if idx <= inline_limit:
+                write_result_html(inline, idx, result)
+    else:
+        for idx, result in enumerate(islice(results, inline_limit), 1):
+            write_result_html(inline, idx, result)
+
+    total = sum(counts.values())
+    out.write("""
+    <div style="font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto;">
+        <h2 style="color: #2c3e50; border-bottom: 2px solid #3498db; padding-bottom: 10px;">
+            Batch Processing Results
+        </h2>
+    """)
+    write_summary_html(out, counts)
+    if total > inline_limit:
+        where = ("are in the attached export" if attached
+                 else "did not fit in this email; download them from the Results section of the app")
+        out.write(f"""
+        <p style="color: #7f8c8d;">
+            Showing the first {inline_limit} of {total} results. The full results {where}.
+        </p>
+        """)
+    out.write(inline.getvalue())
+    out.write("</div>")
+
+
+def render_report_html(results, inline_limit=INLINE_RESULTS, attached=True, counts=None) -> str:
+    out = io.StringIO()
+    render_report(results, out, inline_limit, attached, counts)
+    return out.getvalue()
+
+
+def render_batch_report_html(batch_id, inline_limit=INLINE_RESULTS, attached=True) -> str:
+    """Report of a stored batch: counts come from the database, only the inline results are read"""
+    return render_report_html(iter_results(batch_id, limit=inline_limit), inline_limit, attached,
+                              summarize_results(batch_id))
+
+
+def write_results_jsonl_gz(results, fileobj):
+    """Stream results as gzip-compressed JSONL into a binary file object"""
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as gz:
+        for result in results:
+            gz.write(result.to_json(indent=None).encode())
+            gz.write(b'\n')
+
+
+def build_results_attachment(results, max_bytes=MAX_ATTACHMENT_BYTES):
+    """Compress results into an attachment, or return None if it would be larger than max_bytes.
+
+    Results are compressed into a temporary file first so the size check
+    does not require holding the whole export in memory; compression stops
+    as soon as the limit is passed.
+    """
+    with tempfile.TemporaryFile() as tmp:
+        with gzip.GzipFile(fileobj=tmp, mode='wb') as gz:
+            for result in results:
+                gz.write(result.to_json(indent=None).encode())
+                gz.write(b'\n')
+                if tmp.tell() > max_bytes:
+                    return None
+        if tmp.tell() > max_bytes:
+            return None
+        tmp.seek(0)
+        return tmp.read()
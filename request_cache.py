@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from compression import decode, encode
+from database import transaction
+
+CACHE_ENABLED = os.getenv('RESPONSE_CACHE', 'true').lower() == 'true'
+# Cached responses older than this are not served and get evicted
+CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL_DAYS', '30')) * 24 * 3600
+# Least recently used responses are evicted once the cache grows past this size
+CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# Hashes looked up per query
+LOOKUP_CHUNK_SIZE = 500
+
+
+def params_hash(params):
+    """Content hash of normalized request params"""
+    normalized = json.dumps(params, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def lookup(hashes):
+    """Return {params_hash: result JSON} for the hashes that have a fresh cached response"""
+    hashes = list(set(hashes))
+    now = time.time()
+    found = {}
+    with transaction() as conn:
+        for i in range(0, len(hashes), LOOKUP_CHUNK_SIZE):
+            chunk = hashes[i:i + LOOKUP_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(
+                f"SELECT params_hash, result FROM response_cache "
+                f"WHERE params_hash IN ({placeholders}) AND created_at > ?",
+                (*chunk, now - CACHE_TTL)).fetchall()
+            found.update((row['params_hash'], decode(row['result'])) for row in rows)
+        conn.executemany("UPDATE response_cache SET last_used_at = ? WHERE params_hash = ?",
+                         ((now, h) for h in found))
+    return found
+
+
+def split_cached(requests):
+    """Split requests into (hits, misses).
+
+    Hits are (request, result JSON) pairs that can be served from the cache;
+    misses still have to be sent to the API.
+    """
+    if not CACHE_ENABLED:
+        return [], list(requests)
+
+    hashes = [params_hash(request['params']) for request in requests]
+    cached = lookup(hashes)
+    hits, misses = [], []
+    for request, h in zip(requests, hashes):
+        if h in cached:
+            hits.append((request, cached[h]))
+        else:
+            misses.append(request)
+    return hits, misses
+
+
+def cache_results(batch_id, results):
+    """Cache the succeeded results of a batch under the hash of their request params"""
+    if not CACHE_ENABLED:
+        return
+
+    succeeded = {result.custom_id: result for result in results if result.result.type == "succeeded"}
+    if not succeeded:
+        return
+
+    now = time.time()
+    with transaction() as conn:
+        custom_ids = list(succeeded)
+        for i in range(0, len(custom_ids), LOOKUP_CHUNK_SIZE):
+            chunk = custom_ids[i:i + LOOKUP_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(
+                f"SELECT custom_id, params FROM batch_requests WHERE batch_id = ? AND custom_id IN ({placeholders})",
+                (batch_id, *chunk)).fetchall()
+
+            entries = []
+            for row in rows:
+                # size is what the entry takes on disk
+                result = encode(succeeded[row['custom_id']].result.to_json(indent=None))
+                entries.append((params_hash(json.loads(decode(row['params']))), result, len(result), now, now))
+            conn.executemany(
+                "INSERT OR REPLACE INTO response_cache (params_hash, result, size, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?)", entries)
+
+
+def evict(max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+    """Drop expired responses, then the least recently used ones until under max_bytes"""
+    with transaction() as conn:
+        expired = conn.execute("DELETE FROM response_cache WHERE created_at <= ?", (time.time() - ttl,)).rowcount
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+        evicted = 0
+        if total > max_bytes:
+            stale = []
+            for row in conn.execute("SELECT params_hash, size FROM response_cache ORDER BY last_used_at"):
+                if total <= max_bytes:
+                    break
+                stale.append((row['params_hash'],))
+                total -= row['size']
+            conn.executemany("DELETE FROM response_cache WHERE params_hash = ?", stale)
+            evicted = len(stale)
+
+    if expired or evicted:
+        logging.info(f"Evicted {expired} expired and {evicted} least recently used cached responses")
+
@@ -0,0 +1,229 @@
+import json
+import logging
+from collections import Counter
+
+from anthropic.types.messages import MessageBatchIndividualResponse
+from compression import decode, encode
+from database import connection, transaction
+from request_cache import LOOKUP_CHUNK_SIZE, cache_results, evict
+from search import content_text, index_entries, match_expression
+from usage import record_usage
+from metrics import DB_QUERY_LATENCY, api_call, counter, histogram
+
+# Number of results written per transaction / read per query
+RESULTS_CHUNK_SIZE = 500
+
+INGEST_LATENCY = histogram('results_ingest_seconds', 'Time to download and store the results of a batch')
+RESULTS_INGESTED = counter('results_ingested_total', 'Results downloaded into the local store')
+
+
+def results_ingested(batch_id):
+    """Whether the results of a batch are already in the local store"""
+    with connection() as conn:
+        row = conn.execute("SELECT results_ingested_at FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+    return row is not None and row['results_ingested_at'] is not None
+
+
+def _write_results(conn, rows, texts, cached=False):
+    """Insert (batch_id, custom_id, result_type, model, stop_reason, input_tokens, output_tokens,
+    cache_creation_tokens, cache_read_tokens, error_type, payload) rows; payloads are compressed here.
+
+    ``texts`` holds the response text of each row for the search index.
+    Results stored before (by an interrupted ingestion) are not indexed or
+    counted in the usage rollups again.
+    """
+    if not rows:
+        return
+    batch_id = rows[0][0]
+    custom_ids = [row[1] for row in rows]
+    existing = set()
+    for i in range(0, len(custom_ids), LOOKUP_CHUNK_SIZE):
+        chunk = custom_ids[i:i + LOOKUP_CHUNK_SIZE]
+        placeholders = ','.join('?' * len(chunk))
+        existing.update(row[0] for row in conn.execute(
+            f"SELECT custom_id FROM batch_results WHERE batch_id = ? AND custom_id IN ({placeholders})",
+            (batch_id, *chunk)))
+    conn.executemany(
+        "INSERT OR REPLACE INTO batch_results "
+        "(batch_id, custom_id, result_type, model, stop_reason, input_tokens, output_tokens, "
+        "cache_creation_tokens, cache_read_tokens, error_type, payload) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((*row[:-1], encode(row[-1])) for row in rows),
+    )
+    conn.executemany(
+        "UPDATE batch_requests SET status = ? WHERE batch_id = ? AND custom_id = ?",
+        ((row[2], row[0], row[1]) for row in rows),
+    )
+    new = [(row, text) for row, text in zip(rows, texts) if row[1] not in existing]
+    index_entries(conn, ((batch_id, row[1], 'response', text) for row, text in new))
+    record_usage(conn, batch_id, [(row[2], row[3], *row[5:9]) for row, _ in new], cached)
+
+
+@DB_QUERY_LATENCY.time(query='store_results')
+def store_results(batch_id, results):
+    """Write a chunk of results for a batch and mark their requests with the outcome"""
+    rows, texts = [], []
+    for result in results:
+        model = stop_reason = error_type = None
+        usage = (None, None, None, None)
+        text = ''
+        if result.result.type == "succeeded":
+            message = result.result.message
+            model = message.model
+            stop_reason = message.stop_reason
+            usage = (message.usage.input_tokens, message.usage.output_tokens,
+                     message.usage.cache_creation_input_tokens, message.usage.cache_read_input_tokens)
+            text = content_text(message.content)
+        elif result.result.type == "errored":
+            error_type = result.result.error.error.type
+        rows.append((batch_id, result.custom_id, result.result.type, model, stop_reason,
+                     *usage, error_type, result.to_json(indent=None)))
+        texts.append(text)
+    with transaction() as conn:
+        _write_results(conn, rows, texts)
+        cache_results(batch_id, results)
+
+
+def store_cached_results(batch_id, hits):
+    """Store responses served from the cache as results of a batch.
+
+    ``hits`` are (request, result JSON) pairs from request_cache.split_cached().
+    """
+    rows, texts = [], []
+    for request, result in hits:
+        message = json.loads(result)['message']
+        payload = f'{{"custom_id":{json.dumps(request["custom_id"])},"result":{result}}}'
+        usage = message['usage']
+        rows.append((batch_id, request['custom_id'], "succeeded", message.get('model'), message.get('stop_reason'),
+                     usage['input_tokens'], usage['output_tokens'], usage.get('cache_creation_input_tokens'),
+                     usage.get('cache_read_input_tokens'), None, payload))
+        texts.append(content_text(message.get('content')))
+    with transaction() as conn:
+        _write_results(conn, rows, texts, cached=True)
+
+
+def mark_ingested(batch_id):
+    with transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO batches (batch_id, status) VALUES (?, ?)", (batch_id, "ended"))
+        conn.execute("UPDATE batches SET results_ingested_at = CURRENT_TIMESTAMP WHERE batch_id = ?", (batch_id,))
+
+
+def ingest_results(client, batch_id, chunk_size=RESULTS_CHUNK_SIZE):
+    """Stream the results of an ended batch into the local store, once.
+
+    Results are written in chunks as they are downloaded, so memory use does
+    not grow with the batch size. Returns the number of stored results.
+    """
+    if results_ingested(batch_id):
+        return count_results(batch_id)
+
+    count = 0
+    chunk = []
+    with INGEST_LATENCY.time():
+        with api_call('results'):
+            results = client.messages.batches.results(batch_id)
+        for result in results:
+            chunk.append(result)
+            if len(chunk) >= chunk_size:
+                store_results(batch_id, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            store_results(batch_id, chunk)
+            count += len(chunk)
+
+        finish_ingest(batch_id, count)
+        evict()
+    return count
+
+
+def finish_ingest(batch_id, count):
+    """Mark a batch whose results were all stored as ingested"""
+    mark_ingested(batch_id)
+    RESULTS_INGESTED.inc(count)
+    logging.info(f"Stored {count} results for batch {batch_id}")
+
+
+def iter_result_chunks(batch_id, limit=None, chunk_size=RESULTS_CHUNK_SIZE):
+    """Yield the stored result rows of a batch, as dicts with the payload decompressed, a chunk at a time"""
+    last_rowid = 0
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        with connection() as conn, DB_QUERY_LATENCY.time(query='iter_results'):
+            rows = conn.execute(
+                "SELECT rowid, custom_id, result_type, model, stop_reason, input_tokens, output_tokens, "
+                "cache_creation_tokens, cache_read_tokens, payload "
+                "FROM batch_results WHERE batch_id = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                (batch_id, last_rowid, size)).fetchall()
+        if not rows:
+            return
+        yield [dict(row, payload=decode(row['payload'])) for row in rows]
+        last_rowid = rows[-1]['rowid']
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def iter_results(batch_id, limit=None, chunk_size=RESULTS_CHUNK_SIZE):
+    """Lazily yield stored results of a batch, reading one chunk at a time"""
+    for rows in iter_result_chunks(batch_id, limit, chunk_size):
+        for row in rows:
+            yield MessageBatchIndividualResponse.model_validate_json(row['payload'])
+
+
+def count_results(batch_id):
+    with connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM batch_results WHERE batch_id = ?", (batch_id,)).fetchone()[0]
+
+
+def summarize_results(batch_id):
+    """Count stored results by result type"""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT result_type, COUNT(*) FROM batch_results WHERE batch_id = ? GROUP BY result_type",
+            (batch_id,)).fetchall()
+    return Counter({result_type: count for result_type, count in rows})
+
+
+def _result_filters(batch_id, result_type=None, search=None):
+    clauses = ["batch_id = ?"]
+    params = [batch_id]
+    if result_type:
+        clauses.append("result_type = ?")
+        params.append(result_type)
+    if search:
+        # Payloads are compressed, so response text is matched through the full-text index
+        pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        clauses.append("(custom_id LIKE ? ESCAPE '\\' OR custom_id IN (SELECT d.custom_id FROM search_index s "
+                       "JOIN search_documents d ON d.id = s.rowid "
+                       "WHERE search_index MATCH ? AND d.batch_id = ? AND d.kind = 'response'))")
+        params += [pattern, match_expression(search) or '""', batch_id]
+    return ' AND '.join(clauses), params
+
+
+@DB_QUERY_LATENCY.time(query='query_results')
+def query_results(batch_id, result_type=None, search=None, limit=50, offset=0):
+    """One page of result metadata matching the filters, without the payloads"""
+    where, params = _result_filters(batch_id, result_type, search)
+    with connection() as conn:
+        rows = conn.execute(
+            f"SELECT custom_id, result_type, stop_reason, input_tokens, output_tokens FROM batch_results "
+            f"WHERE {where} ORDER BY rowid LIMIT ? OFFSET ?", (*params, limit, offset)).fetchall()
+    return [dict(row) for row in rows]
+
+
+@DB_QUERY_LATENCY.time(query='count_matching_results')
+def count_matching_results(batch_id, result_type=None, search=None):
+    where, params = _result_filters(batch_id, result_type, search)
+    with connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM batch_results WHERE {where}", params).fetchone()[0]
+
+
+def get_result(batch_id, custom_id):
+    """Load a single stored result, or None"""
+    with connection() as conn:
+        row = conn.execute("SELECT payload FROM batch_results WHERE batch_id = ? AND custom_id = ?",
+                           (batch_id, custom_id)).fetchone()
+    if row is None:
+        return None
+    return MessageBatchIndividualResponse.model_validate_json(decode(row['payload']))
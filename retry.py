@@ -0,0 +1,169 @@
+"""Automatic retry batches for requests that failed transiently.
+
+When a batch ends, its retryable failures (server-side errors, expired and
+optionally canceled requests) are scheduled for a follow-up batch after an
+exponential backoff. Follow-up batches are linked to their parent and share
+the root batch ID of the logical job; a job is finished once none of its
+batches is still running or waiting for a retry.
+"""
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+from anthropic.types.messages.batch_create_params import Request
+from compression import decode
+from database import connection, transaction
+from ingestion import create_batch, record_submission
+from metrics import DB_QUERY_LATENCY, counter
+
+MAX_RETRY_ATTEMPTS = int(os.getenv('MAX_RETRY_ATTEMPTS', '3'))
+# Seconds before the first retry; doubled for every further attempt up to RETRY_MAX_BACKOFF
+RETRY_BACKOFF = float(os.getenv('RETRY_BACKOFF', '60'))
+RETRY_MAX_BACKOFF = float(os.getenv('RETRY_MAX_BACKOFF', '3600'))
+# Canceled requests were usually canceled on purpose, so they are only retried on request
+RETRY_CANCELED = os.getenv('RETRY_CANCELED', 'false').lower() == 'true'
+
+# Error types worth retrying; anything else (invalid_request_error, ...) fails the same way again
+RETRYABLE_ERRORS = ('api_error', 'overloaded_error', 'rate_limit_error', 'timeout_error')
+
+# custom_ids read per query
+RETRY_CHUNK_SIZE = 500
+
+RETRIES_SCHEDULED = counter('retry_requests_scheduled_total', 'Failed requests scheduled for a retry batch')
+RETRY_BATCHES = counter('retry_batches_submitted_total', 'Retry batches submitted')
+
+
+def retry_delay(attempt):
+    """Seconds to wait before retrying the failures of a batch at the given attempt"""
+    return min(RETRY_BACKOFF * 2 ** attempt, RETRY_MAX_BACKOFF)
+
+
+def _retryable_filter():
+    types = ['expired'] + (['canceled'] if RETRY_CANCELED else [])
+    placeholders = ','.join('?' * len(RETRYABLE_ERRORS))
+    clause = (f"(result_type IN ({','.join('?' * len(types))}) OR (result_type = 'errored' AND "
+              f"error_type IN ({placeholders})))")
+    return clause, [*types, *RETRYABLE_ERRORS]
+
+
+def retryable_custom_ids(conn, batch_id):
+    clause, params = _retryable_filter()
+    rows = conn.execute(f"SELECT custom_id FROM batch_results WHERE batch_id = ? AND {clause} ORDER BY rowid",
+                        (batch_id, *params))
+    return [row['custom_id'] for row in rows]
+
+
+@DB_QUERY_LATENCY.time(query='schedule_retry')
+def schedule_retry(batch_id):
+    """Schedule the retryable failures of an ended batch for a follow-up batch.
+
+    Returns the number of requests scheduled; 0 if there is nothing to retry
+    or the job ran out of attempts.
+    """
+    with transaction() as conn:
+        row = conn.execute("SELECT attempt, retry_batch_id FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        if row is None or row['retry_batch_id'] is not None:
+            return 0
+        failed = len(retryable_custom_ids(conn, batch_id))
+        if not failed:
+            return 0
+        if row['attempt'] >= MAX_RETRY_ATTEMPTS:
+            logging.warning(f"Batch {batch_id} has {failed} retryable failures but reached {MAX_RETRY_ATTEMPTS} retries")
+            return 0
+        delay = retry_delay(row['attempt'])
+        conn.execute("UPDATE batches SET retry_due_at = ? WHERE batch_id = ?", (time.time() + delay, batch_id))
+
+    RETRIES_SCHEDULED.inc(failed)
+    logging.info(f"Scheduled {failed} requests of batch {batch_id} for retry in {delay:.0f}s")
+    return failed
+
+
+def due_retries(now=None):
+    """Batches whose retry is due, oldest first"""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT batch_id FROM batches WHERE retry_due_at <= ? AND retry_batch_id IS NULL ORDER BY retry_due_at",
+            (now or time.time(),)).fetchall()
+    return [row['batch_id'] for row in rows]
+
+
+def next_retry_due():
+    """Time at which the next scheduled retry is due, or None"""
+    with connection() as conn:
+        return conn.execute(
+            "SELECT MIN(retry_due_at) FROM batches WHERE retry_due_at IS NOT NULL AND retry_batch_id IS NULL"
+        ).fetchone()[0]
+
+
+def postpone_retry(batch_id, delay):
+    """Push back a due retry, after its submission failed"""
+    with transaction() as conn:
+        conn.execute("UPDATE batches SET retry_due_at = ? WHERE batch_id = ?", (time.time() + delay, batch_id))
+
+
+def build_retry_requests(batch_id):
+    """The original requests of a batch's retryable failures"""
+    requests = []
+    with connection() as conn:
+        custom_ids = retryable_custom_ids(conn, batch_id)
+        for i in range(0, len(custom_ids), RETRY_CHUNK_SIZE):
+            chunk = custom_ids[i:i + RETRY_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(
+                f"SELECT custom_id, params FROM batch_requests WHERE batch_id = ? AND custom_id IN ({placeholders}) "
+                f"ORDER BY rowid", (batch_id, *chunk))
+            requests.extend(Request(custom_id=row['custom_id'], params=json.loads(decode(row['params']))) for row in rows)
+    return requests
+
+
+def submit_retry(client, batch_id):
+    """Submit the follow-up batch for a batch whose retry is due; returns the SubmittedBatch or None"""
+    requests = build_retry_requests(batch_id)
+    if not requests:
+        with transaction() as conn:
+            conn.execute("UPDATE batches SET retry_due_at = NULL WHERE batch_id = ?", (batch_id,))
+        return None
+
+    hits, retry_batch_id, status = create_batch(client, requests)
+    # Recorded and linked in one transaction: once the retry batch is stored it is never submitted again
+    with transaction() as conn:
+        submitted = record_submission(retry_batch_id, status, requests, hits, parent_batch_id=batch_id)
+        conn.execute("UPDATE batches SET retry_batch_id = ? WHERE batch_id = ?", (submitted.id, batch_id))
+    RETRY_BATCHES.inc()
+    logging.info(f"Submitted retry batch {submitted.id} for {len(requests)} requests of batch {batch_id}")
+    return submitted
+
+
+def job_root(batch_id):
+    """Root batch ID of the job a batch belongs to"""
+    with connection() as conn:
+        row = conn.execute("SELECT root_batch_id FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+    return row['root_batch_id'] if row is not None and row['root_batch_id'] else batch_id
+
+
+@DB_QUERY_LATENCY.time(query='job_status')
+def job_status(batch_id):
+    """Progress of the job a batch belongs to.
+
+    Returns a dict with the root batch ID, the job's batches in attempt
+    order, whether the job is finished, and the final outcome of each
+    request (its result in the latest attempt that included it) counted by
+    result type.
+    """
+    root = job_root(batch_id)
+    with connection() as conn:
+        batches = [dict(row) for row in conn.execute(
+            "SELECT batch_id, status, attempt, retry_due_at, retry_batch_id FROM batches "
+            "WHERE root_batch_id = ? OR batch_id = ? ORDER BY attempt", (root, root))]
+        outcomes = Counter({row[0]: row[1] for row in conn.execute(
+            "SELECT result_type, COUNT(*) FROM ("
+            "  SELECT r.result_type, ROW_NUMBER() OVER (PARTITION BY r.custom_id ORDER BY b.attempt DESC) AS latest"
+            "  FROM batch_results r JOIN batches b ON b.batch_id = r.batch_id"
+            "  WHERE b.root_batch_id = ? OR b.batch_id = ?"
+            ") WHERE latest = 1 GROUP BY result_type", (root, root))})
+
+    finished = all(batch['status'] == 'ended' and (batch['retry_due_at'] is None or batch['retry_batch_id'] is not None)
+                   for batch in batches)
+    return {'root_batch_id': root, 'batches': batches, 'finished': finished, 'outcomes': outcomes}
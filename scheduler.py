@@ -0,0 +1,272 @@
+"""Shared submission queue with weighted fair queueing and rate-limit backoff.
+
+Users enqueue batches instead of creating them directly. The monitor leader
+releases queued batches while the number of unfinished batches and requests
+stays under MAX_INFLIGHT_BATCHES / MAX_INFLIGHT_REQUESTS. Higher priorities
+go first; within a priority each user gets a share of the throughput
+proportional to their weight (start-time fair queueing on request counts).
+Rate-limit headers of API responses pause releases until the limit resets.
+
+An entry being submitted is claimed by the worker submitting it until
+claim_expires_at, which that worker keeps extending while it is alive. A new
+leader only puts back entries whose claim ran out, and the created batch is
+recorded in the same transaction that marks its entry submitted.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import anthropic
+from compression import decode, encode
+from database import connection, transaction
+from ingestion import record_submission
+from metrics import DB_QUERY_LATENCY, counter, gauge
+
+# Limits on batches / requests that are submitted but not ended yet
+MAX_INFLIGHT_BATCHES = int(os.getenv('MAX_INFLIGHT_BATCHES', '20'))
+MAX_INFLIGHT_REQUESTS = int(os.getenv('MAX_INFLIGHT_REQUESTS', '100000'))
+# Pause after a rate-limited or overloaded response without a retry-after header (seconds)
+RATE_LIMIT_BACKOFF = float(os.getenv('RATE_LIMIT_BACKOFF', '60'))
+
+PRIORITIES = {'low': -1, 'normal': 0, 'high': 1}
+
+# Submission errors after which the entry is tried again later instead of failing.
+# A timed-out create is only retried when no batch it made could be found.
+TRANSIENT_ERRORS = (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.OverloadedError,
+                    anthropic.APIConnectionError)
+
+QUEUED_SUBMISSIONS = gauge('scheduler_queued_submissions', 'Batches waiting in the submission queue')
+RELEASED_SUBMISSIONS = counter('scheduler_released_total', 'Queued batches submitted to the API', ['outcome'])
+RATE_LIMIT_PAUSES = counter('scheduler_rate_limit_pauses_total', 'Times releases were paused by rate limits')
+
+
+class RateLimitState:
+    """Process-wide pause derived from rate-limit headers of API responses"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+
+    def pause(self, seconds, reason):
+        with self.lock:
+            until = time.time() + seconds
+            if until <= self.paused_until:
+                return
+            self.paused_until = until
+        RATE_LIMIT_PAUSES.inc()
+        logging.warning(f"Pausing batch submissions for {seconds:.0f}s: {reason}")
+
+    def remaining_pause(self):
+        return max(self.paused_until - time.time(), 0)
+
+    def observe_response(self, response):
+        """httpx response hook: pause on 429/529 and when the request budget is used up"""
+        headers = response.headers
+        if response.status_code in (429, 529):
+            self.pause(retry_after(headers), f"HTTP {response.status_code}")
+            return
+        if headers.get('anthropic-ratelimit-requests-remaining') == '0':
+            reset = _seconds_until(headers.get('anthropic-ratelimit-requests-reset'))
+            self.pause(reset if reset is not None else RATE_LIMIT_BACKOFF, "request rate limit reached")
+
+
+RATE_LIMITS = RateLimitState()
+
+
+def _seconds_until(timestamp):
+    if not timestamp:
+        return None
+    try:
+        reset = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return max(reset.timestamp() - time.time(), 0)
+
+
+def retry_after(headers, default=RATE_LIMIT_BACKOFF):
+    """Seconds from a retry-after header, or default"""
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return default
+
+
+def _virtual_time(conn):
+    row = conn.execute("SELECT value FROM scheduler_state WHERE name = 'virtual_time'").fetchone()
+    return row['value'] if row is not None else 0.0
+
+
+@DB_QUERY_LATENCY.time(query='enqueue_submission')
+def enqueue_submission(username, requests, priority=0, source_id=None):
+    """Queue a batch of requests for a user; returns the queue entry ID.
+
+    The entry's finish tag is where the user's share of the queue ends after
+    this batch: it starts at the later of the scheduler's virtual time and the
+    user's previous finish tag, and advances by request count over weight.
+    Only admins may queue above normal priority, since higher priorities
+    skip the fair share of everyone else.
+    """
+    with transaction() as conn:
+        user = conn.execute("SELECT weight, last_finish_tag, is_admin FROM users WHERE username = ?",
+                            (username,)).fetchone()
+        if priority > PRIORITIES['normal'] and (user is None or not user['is_admin']):
+            raise ValueError("Only admins can queue batches above normal priority")
+        weight = user['weight'] if user is not None and user['weight'] > 0 else 1.0
+        last_finish = user['last_finish_tag'] if user is not None else 0.0
+        finish_tag = max(_virtual_time(conn), last_finish) + len(requests) / weight
+        conn.execute("UPDATE users SET last_finish_tag = ? WHERE username = ?", (finish_tag, username))
+        entry_id = conn.execute(
+            "INSERT INTO submission_queue (username, priority, finish_tag, request_count, requests, source_id, "
+            "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (username, priority, finish_tag, len(requests), encode(json.dumps(requests)), source_id,
+             time.time())).lastrowid
+    logging.info(f"Queued {len(requests)} requests for {username} as submission {entry_id}")
+    return entry_id
+
+
+def get_submissions(username=None, limit=50):
+    """Most recent queue entries, of one user or all, without their requests"""
+    sql = ("SELECT id, username, priority, request_count, status, batch_id, error, created_at, submitted_at "
+           "FROM submission_queue")
+    params = []
+    if username is not None:
+        sql += " WHERE username = ?"
+        params.append(username)
+    sql += " ORDER BY id DESC LIMIT ?"
+    with connection() as conn:
+        return [dict(row) for row in conn.execute(sql, (*params, limit))]
+
+
+def queue_position(entry_id):
+    """1-based position of a queued entry in release order, or None if it is no longer queued"""
+    with connection() as conn:
+        entry = conn.execute("SELECT priority, finish_tag, status FROM submission_queue WHERE id = ?",
+                             (entry_id,)).fetchone()
+        if entry is None or entry['status'] != 'queued':
+            return None
+        return conn.execute(
+            "SELECT COUNT(*) FROM submission_queue WHERE status = 'queued' AND "
+            "(priority > ? OR (priority = ? AND (finish_tag, id) <= (?, ?)))",
+            (entry['priority'], entry['priority'], entry['finish_tag'], entry_id)).fetchone()[0]
+
+
+def has_queued_submissions():
+    with connection() as conn:
+        return conn.execute("SELECT 1 FROM submission_queue WHERE status = 'queued' LIMIT 1").fetchone() is not None
+
+
+def inflight(conn):
+    """(batches, requests) submitted to the API and not ended yet, including those being submitted"""
+    batches, requests = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(request_count), 0) FROM batches WHERE status != 'ended'").fetchone()
+    submitting, submitting_requests = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(request_count), 0) FROM submission_queue WHERE status = 'submitting'").fetchone()
+    return batches + submitting, requests + submitting_requests
+
+
+@DB_QUERY_LATENCY.time(query='admit_submissions')
+def admit_submissions(holder, ttl):
+    """Claim the queued entries that fit under the in-flight quotas now, in release order.
+
+    Claimed entries are marked as submitting by holder for ttl seconds, so
+    they count towards the quotas and are not claimed twice.
+    """
+    if RATE_LIMITS.remaining_pause():
+        return []
+    admitted = []
+    with transaction() as conn:
+        batches, requests = inflight(conn)
+        entries = conn.execute(
+            "SELECT id, username, finish_tag, request_count, source_id FROM submission_queue "
+            "WHERE status = 'queued' "
+            "ORDER BY priority DESC, finish_tag, id")
+        for entry in entries:
+            # A batch larger than the request quota still goes out once nothing else is in flight
+            if batches >= MAX_INFLIGHT_BATCHES or (batches and requests + entry['request_count'] > MAX_INFLIGHT_REQUESTS):
+                break
+            admitted.append(dict(entry))
+            batches += 1
+            requests += entry['request_count']
+        conn.executemany(
+            "UPDATE submission_queue SET status = 'submitting', claimed_by = ?, claim_expires_at = ? WHERE id = ?",
+            ((holder, time.time() + ttl, entry['id']) for entry in admitted))
+        QUEUED_SUBMISSIONS.set(conn.execute("SELECT COUNT(*) FROM submission_queue WHERE status = 'queued'").fetchone()[0])
+    return admitted
+
+
+def renew_claims(holder, ttl):
+    """Extend the claims of holder on the entries it is still submitting"""
+    with transaction() as conn:
+        conn.execute("UPDATE submission_queue SET claim_expires_at = ? WHERE status = 'submitting' AND claimed_by = ?",
+                     (time.time() + ttl, holder))
+
+
+def requeue_submissions(entry_ids=None):
+    """Put claimed entries back in the queue.
+
+    When entry_ids is None (a new leader taking over), only entries whose
+    claim expired are put back: their worker stopped without finishing them.
+    """
+    with transaction() as conn:
+        if entry_ids is None:
+            conn.execute("UPDATE submission_queue SET status = 'queued' WHERE status = 'submitting' "
+                         "AND (claim_expires_at IS NULL OR claim_expires_at <= ?)", (time.time(),))
+        else:
+            conn.executemany("UPDATE submission_queue SET status = 'queued' WHERE id = ? AND status = 'submitting'",
+                             ((entry_id,) for entry_id in entry_ids))
+
+
+def load_requests(entry_id):
+    with connection() as conn:
+        row = conn.execute("SELECT requests FROM submission_queue WHERE id = ?", (entry_id,)).fetchone()
+    return json.loads(decode(row['requests']))
+
+
+def _finish_entry(entry_id, status, batch_id=None, error=None, finish_tag=None):
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE submission_queue SET status = ?, batch_id = ?, error = ?, submitted_at = ?, requests = NULL "
+            "WHERE id = ?", (status, batch_id, error, time.time(), entry_id))
+        if finish_tag is not None:
+            # Virtual time follows the finish tag of the last released entry
+            conn.execute("INSERT INTO scheduler_state (name, value) VALUES ('virtual_time', ?) "
+                         "ON CONFLICT (name) DO UPDATE SET value = max(value, excluded.value)", (finish_tag,))
+
+
+def record_released(entry, batch_id, status, requests, hits):
+    """Record the batch created for a claimed entry and mark the entry submitted, in one transaction.
+
+    Returns the SubmittedBatch. If the entry was put back and submitted
+    again by another worker meanwhile, both batches are kept and a warning
+    is logged.
+    """
+    with transaction() as conn:
+        submitted = record_submission(batch_id, status, requests, hits, username=entry['username'],
+                                      source_id=entry['source_id'])
+        row = conn.execute("SELECT status, batch_id FROM submission_queue WHERE id = ?", (entry['id'],)).fetchone()
+        if row['status'] == 'submitted':
+            logging.warning(f"Submission {entry['id']} was also submitted as batch {row['batch_id']}; "
+                            f"keeping both it and batch {submitted.id}")
+        else:
+            _finish_entry(entry['id'], 'submitted', batch_id=submitted.id, finish_tag=entry['finish_tag'])
+    RELEASED_SUBMISSIONS.inc(outcome='submitted')
+    return submitted
+
+
+def record_failure(entry, error):
+    """Handle a failed submission; returns True if it was transient and the entry went back to the queue"""
+    if isinstance(error, TRANSIENT_ERRORS):
+        response = getattr(error, 'response', None)
+        headers = response.headers if response is not None else {}
+        RATE_LIMITS.pause(retry_after(headers), f"submission {entry['id']} failed with {type(error).__name__}")
+        requeue_submissions([entry['id']])
+        RELEASED_SUBMISSIONS.inc(outcome='deferred')
+        return True
+    logging.error(f"Submission {entry['id']} of {entry['username']} failed: {error}")
+    _finish_entry(entry['id'], 'failed', error=str(error))
+    RELEASED_SUBMISSIONS.inc(outcome='failed')
+    return False
+
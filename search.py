@@ -0,0 +1,158 @@
+"""Full-text search over the prompts and responses of all batches.
+
+search_index is a contentless FTS5 table: it holds only the inverted index,
+not the text, which stays compressed in batch_requests and batch_results.
+Each indexed row's rowid is the id of its search_documents row, which names
+the prompt or response it came from; snippets are cut from the decoded
+payloads of the hits.
+"""
+import json
+import re
+
+from compression import decode
+from database import connection
+from metrics import DB_QUERY_LATENCY
+
+# Hits returned by a search
+SEARCH_LIMIT = 50
+# Tokens of context around the matched terms in a snippet
+SNIPPET_TOKENS = 16
+# Stored prompts / responses read per query when filling the index
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def _block_text(block):
+    if isinstance(block, dict):
+        return block.get('text', '')
+    return getattr(block, 'text', '')
+
+
+def content_text(content):
+    """Plain text of a message content: a string, or content blocks as dicts or API objects"""
+    if isinstance(content, str):
+        return content
+    return '\n'.join(_block_text(block) for block in content or ())
+
+
+def request_text(params):
+    """Searchable text of a request: the content of its messages"""
+    return '\n'.join(content_text(message.get('content')) for message in params.get('messages', ()))
+
+
+def result_text(result):
+    """Searchable text of a result JSON object: the text of a succeeded response"""
+    if result.get('type') != 'succeeded':
+        return ''
+    return content_text(result['message'].get('content'))
+
+
+def index_entries(conn, entries):
+    """Add (batch_id, custom_id, kind, body) rows to the index, skipping empty bodies and indexed documents"""
+    indexed = []
+    for batch_id, custom_id, kind, body in entries:
+        if not body:
+            continue
+        cursor = conn.execute("INSERT OR IGNORE INTO search_documents (batch_id, custom_id, kind) VALUES (?, ?, ?)",
+                              (batch_id, custom_id, kind))
+        if cursor.rowcount:
+            indexed.append((cursor.lastrowid, body))
+    conn.executemany("INSERT INTO search_index (rowid, body) VALUES (?, ?)", indexed)
+
+
+def index_requests(conn, batch_id, requests):
+    index_entries(conn, ((batch_id, request['custom_id'], 'prompt', request_text(request['params']))
+                         for request in requests))
+
+
+def match_expression(query):
+    """FTS5 query matching all words of free text, each quoted so punctuation is taken literally"""
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+_WORD = re.compile(r'\w+')
+_SUFFIXES = ('ing', 'ed', 'es', 's', 'ly')
+
+
+def _stem(word):
+    """Rough stand-in for the porter stemmer, enough to mark the matched words of a snippet"""
+    word = word.lower()
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            break
+    return word[:-1] if word.endswith('e') and len(word) > 3 else word
+
+
+def snippet(text, query, tokens=SNIPPET_TOKENS):
+    """About `tokens` words of text around the first match of the query, matched words in «»"""
+    words = list(_WORD.finditer(text))
+    if not words:
+        return ''
+    terms = {_stem(word) for word in _WORD.findall(query)}
+    matches = [i for i, word in enumerate(words) if _stem(word.group()) in terms]
+    first = max(0, min(matches[0] - tokens // 4 if matches else 0, len(words) - tokens))
+    last = min(len(words), first + tokens)
+    parts = ['…'] if first > 0 else []
+    position = words[first].start()
+    for i in range(first, last):
+        word = words[i]
+        parts.append(text[position:word.start()])
+        parts.append(f"«{word.group()}»" if i in matches else word.group())
+        position = word.end()
+    if last < len(words):
+        parts.append('…')
+    return ''.join(parts)
+
+
+def document_text(conn, batch_id, custom_id, kind):
+    """Indexed text of a prompt or response, decoded from its stored payload"""
+    if kind == 'prompt':
+        row = conn.execute("SELECT params FROM batch_requests WHERE batch_id = ? AND custom_id = ?",
+                           (batch_id, custom_id)).fetchone()
+        return request_text(json.loads(decode(row['params']))) if row is not None else ''
+    row = conn.execute("SELECT payload FROM batch_results WHERE batch_id = ? AND custom_id = ?",
+                       (batch_id, custom_id)).fetchone()
+    return result_text(json.loads(decode(row['payload']))['result']) if row is not None else ''
+
+
+@DB_QUERY_LATENCY.time(query='search')
+def search(query, limit=SEARCH_LIMIT, kind=None):
+    """Best matching prompts and responses for free text, ranked by bm25"""
+    expression = match_expression(query)
+    if not expression:
+        return []
+    sql = ("SELECT d.batch_id, d.custom_id, d.kind FROM search_index s JOIN search_documents d ON d.id = s.rowid "
+           "WHERE search_index MATCH ?")
+    params = [expression]
+    if kind:
+        sql += " AND d.kind = ?"
+        params.append(kind)
+    sql += " ORDER BY s.rank LIMIT ?"
+    params.append(limit)
+    with connection() as conn:
+        hits = [dict(row) for row in conn.execute(sql, params)]
+        for hit in hits:
+            hit['snippet'] = snippet(document_text(conn, hit['batch_id'], hit['custom_id'], hit['kind']), query)
+    return hits
+
+
+def backfill(conn, chunk_size=BACKFILL_CHUNK_SIZE):
+    """Index every stored prompt and response, reading the payloads a chunk at a time"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_documents'").fetchone() is None:
+        # The first index (migration 8) had another shape; migration 16 replaces it and fills it from scratch
+        return
+    sources = (
+        ('batch_requests', 'params', 'prompt', "1", lambda value: request_text(json.loads(value))),
+        ('batch_results', 'payload', 'response', "result_type = 'succeeded'",
+         lambda value: result_text(json.loads(value)['result'])),
+    )
+    for table, column, kind, where, text in sources:
+        last_rowid = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT rowid, batch_id, custom_id, {column} FROM {table} WHERE rowid > ? AND {where} "
+                f"ORDER BY rowid LIMIT ?", (last_rowid, chunk_size)).fetchall()
+            if not rows:
+                break
+            index_entries(conn, ((row['batch_id'], row['custom_id'], kind, text(decode(row[column]))) for row in rows))
+            last_rowid = rows[-1]['rowid']
@@ -0,0 +1,172 @@
+"""Join batch results back onto the rows of the file their requests came from.
+
+An uploaded file is registered as a source, and while its requests are read
+the custom_id of every row is recorded in source_rows under the row's
+position. join_results() then reads the original file and the stored results
+side by side in row order (a merge join on the row number) and writes every
+input row with its result. Only a chunk of either side is in memory at a
+time, whatever the size of the file.
+"""
+import csv
+import io
+import json
+import logging
+import sqlite3
+import time
+
+from compression import decode
+from database import connection, transaction
+from export import COLUMNS, result_record
+from ingestion import file_format, iter_file_records, row_custom_id
+from metrics import DB_QUERY_LATENCY, histogram
+
+# Rows recorded / joined per query
+SOURCE_CHUNK_SIZE = 1000
+# Result columns added to CSV rows; JSONL rows get them under a "result" key
+JOIN_PREFIX = 'result_'
+
+JOIN_LATENCY = histogram('source_join_seconds', 'Time to join the results of a source onto its file')
+
+
+def create_source(filename, id_field=None, username=None):
+    """Register an uploaded file whose rows are about to be submitted; returns the source ID"""
+    with transaction() as conn:
+        return conn.execute(
+            "INSERT INTO sources (filename, format, id_field, username, created_at) VALUES (?, ?, ?, ?, ?)",
+            (filename, file_format(filename), id_field or None, username, time.time())).lastrowid
+
+
+def _write_rows(source_id, rows):
+    try:
+        with transaction() as conn:
+            conn.executemany("INSERT INTO source_rows (source_id, row_number, custom_id) VALUES (?, ?, ?)",
+                             ((source_id, row_number, custom_id) for row_number, custom_id in rows))
+            conn.execute("UPDATE sources SET row_count = row_count + ? WHERE id = ?", (len(rows), source_id))
+    except sqlite3.IntegrityError:
+        # The unique index on custom_id also catches duplicates in different shards
+        raise ValueError(f"Duplicate custom_id in rows {rows[0][0]}-{rows[-1][0]} of the file")
+
+
+def track_rows(source_id, requests):
+    """Pass requests read from a source's file through, recording the row of each custom_id.
+
+    Requests must come one per row, in file order, as iter_file_requests()
+    yields them.
+    """
+    rows = []
+    for row_number, request in enumerate(requests):
+        rows.append((row_number, request['custom_id']))
+        if len(rows) >= SOURCE_CHUNK_SIZE:
+            _write_rows(source_id, rows)
+            rows = []
+        yield request
+    if rows:
+        _write_rows(source_id, rows)
+
+
+def get_source(source_id):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM sources WHERE id = ?", (source_id,)).fetchone()
+    return dict(row) if row is not None else None
+
+
+def source_of_batch(batch_id):
+    """ID of the source a batch's requests were read from, or None"""
+    with connection() as conn:
+        row = conn.execute("SELECT source_id FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+    return row['source_id'] if row is not None else None
+
+
+def source_batches(source_id):
+    """(batch_id, status, ingested) of every batch submitted from a source, retries included"""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT batch_id, status, results_ingested_at IS NOT NULL AS ingested FROM batches WHERE source_id = ? "
+            "ORDER BY attempt, id", (source_id,)).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def _latest_results(conn, source_id, custom_ids):
+    """{custom_id: batch_results row} from the latest attempt that has a result for it"""
+    placeholders = ','.join('?' * len(custom_ids))
+    rows = conn.execute(
+        f"SELECT r.custom_id, r.result_type, r.model, r.stop_reason, r.input_tokens, r.output_tokens, "
+        f"r.cache_creation_tokens, r.cache_read_tokens, r.payload, b.attempt "
+        f"FROM batch_results r JOIN batches b ON b.batch_id = r.batch_id "
+        f"WHERE b.source_id = ? AND r.custom_id IN ({placeholders})", (source_id, *custom_ids))
+    latest = {}
+    for row in rows:
+        if row['custom_id'] not in latest or row['attempt'] > latest[row['custom_id']]['attempt']:
+            latest[row['custom_id']] = row
+    return latest
+
+
+def iter_source_results(source_id, chunk_size=SOURCE_CHUNK_SIZE):
+    """Yield (row_number, custom_id, result record or None) for every row of a source, in row order"""
+    last_row = -1
+    while True:
+        with connection() as conn, DB_QUERY_LATENCY.time(query='iter_source_results'):
+            rows = conn.execute(
+                "SELECT row_number, custom_id FROM source_rows WHERE source_id = ? AND row_number > ? "
+                "ORDER BY row_number LIMIT ?", (source_id, last_row, chunk_size)).fetchall()
+            if not rows:
+                return
+            results = _latest_results(conn, source_id, [row['custom_id'] for row in rows])
+        for row_number, custom_id in rows:
+            result = results.get(custom_id)
+            if result is not None:
+                result = result_record(dict(result, payload=decode(result['payload'])))
+            yield row_number, custom_id, result
+        last_row = rows[-1]['row_number']
+
+
+def _output_fields(header):
+    return [*header, *(JOIN_PREFIX + name for name, _ in COLUMNS if JOIN_PREFIX + name not in header)]
+
+
+def join_results(source_id, fileobj, sink, chunk_size=SOURCE_CHUNK_SIZE):
+    """Write every row of a source's original file (binary file object) with its result to sink.
+
+    sink is a path or binary file object; the output has the format of the
+    input. Rows without a result yet get empty result fields. Raises
+    ValueError if the file does not match the rows recorded for the source.
+    Returns (rows written, rows with a result).
+    """
+    source = get_source(source_id)
+    if source is None:
+        raise ValueError(f"Unknown source {source_id}")
+
+    owns_sink = isinstance(sink, str)
+    binary = open(sink, 'wb') if owns_sink else sink
+    out = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+    rows = joined = 0
+    start = time.perf_counter()
+    try:
+        results = iter_source_results(source_id, chunk_size)
+        writer = None
+        for index, line_number, record in iter_file_records(fileobj, source['filename']):
+            row_number, custom_id, result = next(results, (None, None, None))
+            if row_number != index or custom_id != row_custom_id(record, index, line_number, source['id_field']):
+                raise ValueError(f"Line {line_number} does not match row {index} of source {source_id}; "
+                                 f"is this the file that was submitted?")
+            result = result or {'custom_id': custom_id}
+            if source['format'] == 'csv':
+                if writer is None:
+                    writer = csv.DictWriter(out, fieldnames=_output_fields(list(record)), extrasaction='ignore')
+                    writer.writeheader()
+                writer.writerow({**record, **{JOIN_PREFIX + name: result.get(name) for name, _ in COLUMNS}})
+            else:
+                out.write(json.dumps({**record, 'result': result}, ensure_ascii=False) + '\n')
+            rows += 1
+            joined += 'result_type' in result
+        if next(results, None) is not None:
+            raise ValueError(f"The file has fewer rows than source {source_id} ({source['row_count']})")
+    finally:
+        out.flush()
+        if owns_sink:
+            out.close()
+        else:
+            out.detach()
+    JOIN_LATENCY.observe(time.perf_counter() - start)
+    logging.info(f"Joined {joined} results onto {rows} rows of source {source_id}")
+    return rows, joined
@@ -0,0 +1,133 @@
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+
+import pytest
+
+# The database location and SMTP settings are read at import time
+os.environ['DATA_LOCATION'] = tempfile.mkdtemp(prefix='batch-tests-')
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test')
+os.environ['EMBEDDED_MONITOR'] = 'false'
+os.environ['SMTP_SERVER'] = ''
+
+import database
+
+
+@pytest.fixture
+def database_path(tmp_path, monkeypatch):
+    """Point the app at an empty database file of its own, not created or migrated yet"""
+    path = tmp_path / 'app_data.db'
+    monkeypatch.setattr(database, 'database_location', str(path))
+    monkeypatch.setattr(database, '_pool', None)
+    monkeypatch.setattr(database, '_initialized', False)
+    return path
+
+
+@pytest.fixture
+def db(database_path):
+    """A fresh, migrated database for one test"""
+    database.init_db()
+    return database_path
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Minimal SMTP server on localhost that records what it receives.
+
+    ``fail_data`` is the number of upcoming messages to reject with a 451,
+    and ``drop_connections()`` hangs up on every open session, as a server
+    closing idle connections does.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.noops = 0
+        self.fail_data = 0
+        self.open_sockets = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def drop_connections(self):
+        with self.lock:
+            sockets, self.open_sockets = self.open_sockets, set()
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.open_sockets.add(self.connection)
+        self.reply('220 localhost ready')
+        try:
+            while line := self.rfile.readline():
+                command = line.decode().strip().split(' ', 1)[0].upper()
+                if command == 'EHLO':
+                    self.reply('250-localhost', '250 8BITMIME')
+                elif command in ('HELO', 'MAIL', 'RCPT', 'RSET'):
+                    self.reply('250 OK')
+                elif command == 'NOOP':
+                    with server.lock:
+                        server.noops += 1
+                    self.reply('250 OK')
+                elif command == 'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    data = self.read_data()
+                    if data is None:
+                        return
+                    with server.lock:
+                        rejected = server.fail_data > 0
+                        if rejected:
+                            server.fail_data -= 1
+                        else:
+                            server.messages.append(data)
+                    self.reply('451 Try again later' if rejected else '250 Queued')
+                elif command == 'QUIT':
+                    self.reply('221 Bye')
+                    return
+                else:
+                    self.reply('502 Not implemented')
+        except OSError:
+            pass
+        finally:
+            with server.lock:
+                server.open_sockets.discard(self.connection)
+
+    def read_data(self):
+        lines = []
+        while (line := self.rfile.readline()) != b'.\r\n':
+            if not line:
+                return None
+            lines.append(line)
+        return b''.join(lines)
+
+    def reply(self, *lines):
+        self.wfile.write(''.join(f'{line}\r\n' for line in lines).encode())
+
+
+@pytest.fixture
+def smtp_server():
+    server = SMTPStandIn()
+    yield server
+    server.stop()
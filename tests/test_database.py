@@ -0,0 +1,76 @@
+import json
+import sqlite3
+import time
+
+import compression
+import database
+from database import MIGRATIONS, acquire_lease, connection, get_batch_requests, get_pending_batches, renew_lease
+from search import search
+
+# Schema and data as the first release of the app left them, before migrations were tracked
+BASELINE_SCHEMA = '''
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY,
+    username TEXT UNIQUE,
+    password TEXT
+);
+CREATE TABLE batches (
+    id INTEGER PRIMARY KEY,
+    batch_id TEXT UNIQUE,
+    status TEXT,
+    messages TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+'''
+
+LONG_PROMPT = 'How do emperor penguins keep their eggs warm through the Antarctic winter? ' * 4
+
+
+def baseline_request(custom_id, prompt):
+    return {'custom_id': custom_id,
+            'params': {'model': 'claude-3-5-sonnet-20241022', 'max_tokens': 1024,
+                       'messages': [{'role': 'user', 'content': prompt}]}}
+
+
+def test_baseline_database_is_migrated_to_the_latest_version(database_path):
+    old_requests = [baseline_request('long', LONG_PROMPT), baseline_request('short', 'Hi')]
+    conn = sqlite3.connect(database_path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (username, password) VALUES ('admin', 'hash')")
+    conn.execute("INSERT INTO batches (batch_id, status, messages, created_at) "
+                 "VALUES ('old', 'in_progress', ?, datetime('now', '-3 days'))", (json.dumps(old_requests),))
+    conn.execute("INSERT INTO batches (batch_id, status, messages) VALUES ('recent', 'in_progress', '[]')")
+    conn.commit()
+    conn.close()
+
+    database.init_db()
+
+    with connection() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        stored = {row['custom_id']: row['params'] for row in
+                  conn.execute("SELECT custom_id, params FROM batch_requests WHERE batch_id = 'old'")}
+    # Large payloads are compressed behind their codec byte, small ones stay text
+    assert isinstance(stored['long'], bytes) and stored['long'][0] == compression.ZLIB
+    assert isinstance(stored['short'], str)
+
+    requests, _ = get_batch_requests('old')
+    assert requests == [{**request, 'status': 'in_progress'} for request in old_requests]
+    assert [hit['custom_id'] for hit in search('penguins')] == ['long']
+    # Batches from before the monitor are history, not work to pick up
+    assert get_pending_batches() == ['recent']
+
+
+def test_lease_is_taken_over_once_heartbeats_stop(db):
+    assert acquire_lease('monitor', 'worker-1', 0.3)
+    assert not acquire_lease('monitor', 'worker-2', 0.3)
+
+    # Heartbeats keep the lease well past its first ttl
+    for _ in range(3):
+        time.sleep(0.15)
+        assert renew_lease('monitor', 'worker-1', 0.3)
+        assert not acquire_lease('monitor', 'worker-2', 0.3)
+
+    time.sleep(0.35)
+    assert acquire_lease('monitor', 'worker-2', 0.3)
+    # The old holder notices on its next heartbeat
+    assert not renew_lease('monitor', 'worker-1', 0.3)
@@ -0,0 +1,134 @@
+import email
+import os
+import smtplib
+import time
+
+import pytest
+from anthropic.types.messages import MessageBatchIndividualResponse
+
+import notifications
+from notifications import NotificationDispatcher
+from report import build_results_attachment
+from result_store import iter_results, store_results
+
+
+@pytest.fixture
+def dispatcher(db, smtp_server, monkeypatch):
+    monkeypatch.setenv('SMTP_SERVER', '127.0.0.1')
+    monkeypatch.setenv('SMTP_PORT', str(smtp_server.port))
+    monkeypatch.setenv('SMTP_STARTTLS', 'false')
+    monkeypatch.setenv('SENDER_EMAIL', 'batches@example.com')
+    monkeypatch.delenv('SENDER_PASSWORD', raising=False)
+    monkeypatch.setenv('RECIPIENT_EMAIL', 'team@example.com')
+    dispatcher = NotificationDispatcher()
+    yield dispatcher
+    dispatcher.stop(timeout=5)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Backoff delays asked for, without waiting them out"""
+    delays = []
+    monkeypatch.setattr(notifications.time, 'sleep', delays.append)
+    return delays
+
+
+def wait_for_messages(server, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while len(server.messages) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return [email.message_from_bytes(data) for data in server.messages]
+
+
+def store_batch(batch_id, count, text_size=300):
+    """Store succeeded results with incompressible text for a batch"""
+    store_results(batch_id, [MessageBatchIndividualResponse.model_validate({
+        'custom_id': f'request-{i}',
+        'result': {
+            'type': 'succeeded',
+            'message': {
+                'id': f'msg_{i:024d}',
+                'type': 'message',
+                'role': 'assistant',
+                'model': 'claude-3-5-sonnet-20241022',
+                'content': [{'type': 'text', 'text': os.urandom(text_size // 2).hex()}],
+                'stop_reason': 'end_turn',
+                'stop_sequence': None,
+                'usage': {'input_tokens': 10, 'output_tokens': 50},
+            },
+        },
+    }) for i in range(count)])
+
+
+def test_completions_within_digest_window_are_sent_as_one_email(dispatcher, smtp_server):
+    dispatcher.digest_window = 0.5
+    dispatcher.enqueue('batch-1')
+    dispatcher.enqueue('batch-2')
+    messages = wait_for_messages(smtp_server, 1)
+    assert [message['Subject'] for message in messages] == ['Batch Processing Complete - 2 batches']
+
+    # A completion after the window has closed starts a new digest
+    dispatcher.enqueue('batch-3')
+    messages = wait_for_messages(smtp_server, 2)
+    assert messages[1]['Subject'] == 'Batch Processing Complete - batch-3'
+
+
+def test_session_is_reused_after_noop_check(dispatcher, smtp_server):
+    dispatcher.deliver(['batch-1'])
+    dispatcher.deliver(['batch-2'])
+
+    assert len(smtp_server.messages) == 2
+    assert smtp_server.connections == 1
+    assert smtp_server.noops == 1
+
+
+def test_reconnects_after_server_drops_connection(dispatcher, smtp_server):
+    dispatcher.deliver(['batch-1'])
+    smtp_server.drop_connections()
+    dispatcher.deliver(['batch-2'])
+
+    messages = wait_for_messages(smtp_server, 2)
+    assert [message['Subject'] for message in messages] == [
+        'Batch Processing Complete - batch-1', 'Batch Processing Complete - batch-2']
+    assert smtp_server.connections == 2
+
+
+def test_failed_send_is_retried_with_backoff(dispatcher, smtp_server, sleeps, monkeypatch):
+    monkeypatch.setattr(notifications, 'MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(notifications, 'RETRY_BACKOFF', 0.5)
+    smtp_server.fail_data = 2
+
+    dispatcher.deliver(['batch-1'])
+
+    assert len(smtp_server.messages) == 1
+    assert sleeps == [0.5, 1.0]
+    # The session is dropped after a failure and reopened for the next attempt
+    assert smtp_server.connections == 3
+
+
+def test_gives_up_after_max_attempts(dispatcher, smtp_server, sleeps, monkeypatch):
+    monkeypatch.setattr(notifications, 'MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(notifications, 'RETRY_BACKOFF', 0.5)
+    smtp_server.fail_data = 10
+
+    with pytest.raises(smtplib.SMTPDataError):
+        dispatcher.deliver(['batch-1'])
+
+    assert smtp_server.messages == []
+    assert len(sleeps) == 2
+    assert smtp_server.fail_data == 7
+
+
+def test_attachments_share_one_size_budget(dispatcher):
+    batch_ids = ['batch-1', 'batch-2', 'batch-3']
+    for batch_id in batch_ids:
+        store_batch(batch_id, 60)
+    sizes = [len(build_results_attachment(iter_results(batch_id))) for batch_id in batch_ids]
+
+    # The third export would fit in the budget on its own, but not in what the first two leave
+    msg = dispatcher.build_message(batch_ids, max_attachment_bytes=sum(sizes) - 1)
+
+    attachments = [part.get_filename() for part in msg.walk() if part.get_filename()]
+    assert attachments == ['batch-1.jsonl.gz', 'batch-2.jsonl.gz']
+    html = next(part for part in msg.walk() if part.get_content_type() == 'text/html').get_payload(decode=True)
+    assert html.decode().count('did not fit in this email') == 1
@@ -0,0 +1,52 @@
+import anthropic
+import pytest
+
+from benchmarks.fake_server import FakeBatchesServer
+from database import connection
+from result_store import count_results, ingest_results
+from usage import get_batch_usage, get_daily_usage
+
+RESULT_SIZE = 200
+
+
+@pytest.fixture
+def server():
+    with FakeBatchesServer(result_size=RESULT_SIZE) as server:
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    return anthropic.Anthropic(base_url=server.base_url, api_key='test', max_retries=0)
+
+
+def test_rerun_ingestion_does_not_count_results_twice(db, server, client, monkeypatch):
+    requests = [{'custom_id': f'request-{i}', 'params': {}} for i in range(35)]
+    batch_id = server.create_batch(requests, ended=True)['id']
+
+    # The first download drops after two chunks have been stored
+    download = client.messages.batches.results
+
+    def interrupted(batch_id):
+        for i, result in enumerate(download(batch_id)):
+            if i == 20:
+                raise anthropic.APIConnectionError(request=None)
+            yield result
+
+    monkeypatch.setattr(client.messages.batches, 'results', interrupted)
+    with pytest.raises(anthropic.APIConnectionError):
+        ingest_results(client, batch_id, chunk_size=10)
+    assert get_batch_usage([batch_id])[batch_id]['requests'] == 20
+
+    monkeypatch.setattr(client.messages.batches, 'results', download)
+    assert ingest_results(client, batch_id, chunk_size=10) == 35
+    assert count_results(batch_id) == 35
+
+    usage = get_batch_usage([batch_id])[batch_id]
+    assert (usage['requests'], usage['succeeded']) == (35, 35)
+    assert usage['output_tokens'] == 35 * (RESULT_SIZE // 4)
+    assert [day['requests'] for day in get_daily_usage()] == [35]
+    with connection() as conn:
+        indexed = conn.execute("SELECT COUNT(*) FROM search_documents WHERE batch_id = ? AND kind = 'response'",
+                               (batch_id,)).fetchone()[0]
+    assert indexed == 35
@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+from database import save_user
+from scheduler import (PRIORITIES, admit_submissions, enqueue_submission, queue_position, renew_claims,
+                       requeue_submissions)
+
+
+def requests(count):
+    return [{'custom_id': f'request-{i}', 'params': {}} for i in range(count)]
+
+
+@pytest.fixture
+def users(db):
+    save_user('alice', 'pw', weight=1.0)
+    save_user('bob', 'pw', weight=2.0)
+    save_user('root', 'pw', is_admin=True)
+
+
+def test_entries_are_released_in_priority_then_finish_tag_order(users):
+    alice_1 = enqueue_submission('alice', requests(10))   # finish tag 10
+    bob_1 = enqueue_submission('bob', requests(10))       # finish tag 5, bob has twice the weight
+    alice_2 = enqueue_submission('alice', requests(10))   # finish tag 20
+    bob_2 = enqueue_submission('bob', requests(10))       # finish tag 10, after alice_1 on a tie
+    low = enqueue_submission('root', requests(1), PRIORITIES['low'])
+    high = enqueue_submission('root', requests(100), PRIORITIES['high'])
+
+    expected = [high, bob_1, alice_1, bob_2, alice_2, low]
+    assert [queue_position(entry_id) for entry_id in expected] == [1, 2, 3, 4, 5, 6]
+
+    admitted = admit_submissions('worker', 60)
+    assert [entry['id'] for entry in admitted] == expected
+    assert queue_position(alice_1) is None
+
+
+def test_only_admins_queue_above_normal_priority(users):
+    with pytest.raises(ValueError):
+        enqueue_submission('alice', requests(1), PRIORITIES['high'])
+    assert enqueue_submission('alice', requests(1), PRIORITIES['low'])
+
+
+def test_new_leader_requeues_only_expired_claims(users):
+    entry_id = enqueue_submission('alice', requests(1))
+    assert [entry['id'] for entry in admit_submissions('worker-1', 0.3)] == [entry_id]
+
+    # The submitting worker is alive and keeps its claim
+    time.sleep(0.2)
+    renew_claims('worker-1', 0.3)
+    time.sleep(0.2)
+    requeue_submissions()
+    assert queue_position(entry_id) is None
+
+    # Once its heartbeats stop, the claim runs out and the entry goes back
+    time.sleep(0.35)
+    requeue_submissions()
+    assert queue_position(entry_id) == 1
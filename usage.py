@@ -0,0 +1,135 @@
+"""Token usage and cost rollups per batch and per day.
+
+Rollups are updated incrementally as results are stored, so dashboards read
+one row per batch or day instead of scanning batch_results. Days are UTC
+dates on which the results were stored.
+"""
+import logging
+from datetime import datetime, timezone
+
+from database import connection
+from metrics import DB_QUERY_LATENCY
+
+# USD per million (input, output) tokens at standard rates, matched by model name prefix
+PRICES = {
+    'claude-3-5-sonnet': (3.00, 15.00),
+    'claude-3-7-sonnet': (3.00, 15.00),
+    'claude-sonnet-4': (3.00, 15.00),
+    'claude-3-5-haiku': (0.80, 4.00),
+    'claude-3-haiku': (0.25, 1.25),
+    'claude-3-opus': (15.00, 75.00),
+    'claude-opus-4': (15.00, 75.00),
+}
+# Message Batches are billed at half the standard rate
+BATCH_DISCOUNT = 0.5
+# Prompt cache writes and reads, relative to the input token price
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+
+RESULT_TYPES = ('succeeded', 'errored', 'canceled', 'expired')
+USAGE_COLUMNS = ('requests', *RESULT_TYPES, 'cached', 'input_tokens', 'output_tokens',
+                 'cache_creation_tokens', 'cache_read_tokens', 'cost')
+
+_unpriced_models = set()
+
+
+def model_prices(model):
+    """(input, output) USD per million tokens for a model, or None if unknown"""
+    for prefix in sorted(PRICES, key=len, reverse=True):
+        if model and model.startswith(prefix):
+            return PRICES[prefix]
+    if model not in _unpriced_models:
+        _unpriced_models.add(model)
+        logging.warning(f"No price known for model {model}; its cost is counted as 0")
+    return None
+
+
+def estimate_cost(model, input_tokens, output_tokens, cache_creation_tokens=0, cache_read_tokens=0):
+    """Estimated batch cost in USD of one result's token usage"""
+    prices = model_prices(model)
+    if prices is None:
+        return 0.0
+    input_price, output_price = prices
+    cost = ((input_tokens or 0) * input_price
+            + (cache_creation_tokens or 0) * input_price * CACHE_WRITE_MULTIPLIER
+            + (cache_read_tokens or 0) * input_price * CACHE_READ_MULTIPLIER
+            + (output_tokens or 0) * output_price)
+    return cost / 1_000_000 * BATCH_DISCOUNT
+
+
+def _totals(rows, cached):
+    """Rollup deltas for (result_type, model, input, output, cache creation, cache read tokens) rows"""
+    totals = dict.fromkeys(USAGE_COLUMNS, 0)
+    for result_type, model, input_tokens, output_tokens, cache_creation_tokens, cache_read_tokens in rows:
+        totals['requests'] += 1
+        totals[result_type] += 1
+        if cached:
+            # Served from the response cache, so nothing was billed
+            totals['cached'] += 1
+            continue
+        if result_type != 'succeeded':
+            continue
+        totals['input_tokens'] += input_tokens or 0
+        totals['output_tokens'] += output_tokens or 0
+        totals['cache_creation_tokens'] += cache_creation_tokens or 0
+        totals['cache_read_tokens'] += cache_read_tokens or 0
+        totals['cost'] += estimate_cost(model, input_tokens, output_tokens, cache_creation_tokens, cache_read_tokens)
+    return totals
+
+
+def _add(conn, batch_id, day, totals):
+    columns = ', '.join(USAGE_COLUMNS)
+    placeholders = ', '.join('?' * len(USAGE_COLUMNS))
+    updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in USAGE_COLUMNS)
+    values = [totals[column] for column in USAGE_COLUMNS]
+    conn.execute(f"INSERT INTO batch_usage (batch_id, {columns}) VALUES (?, {placeholders}) "
+                 f"ON CONFLICT (batch_id) DO UPDATE SET {updates}", (batch_id, *values))
+    conn.execute(f"INSERT INTO daily_usage (day, {columns}) VALUES (?, {placeholders}) "
+                 f"ON CONFLICT (day) DO UPDATE SET {updates}", (day, *values))
+
+
+def record_usage(conn, batch_id, rows, cached=False, day=None):
+    """Add newly stored (result_type, model, input, output, cache creation, cache read tokens) rows to the rollups"""
+    totals = _totals(rows, cached)
+    if totals['requests']:
+        _add(conn, batch_id, day or datetime.now(timezone.utc).date().isoformat(), totals)
+
+
+@DB_QUERY_LATENCY.time(query='get_batch_usage')
+def get_batch_usage(batch_ids):
+    """Rollups of the given batches, as {batch_id: usage dict}"""
+    batch_ids = list(batch_ids)
+    if not batch_ids:
+        return {}
+    placeholders = ','.join('?' * len(batch_ids))
+    with connection() as conn:
+        rows = conn.execute(f"SELECT * FROM batch_usage WHERE batch_id IN ({placeholders})", batch_ids).fetchall()
+    return {row['batch_id']: dict(row) for row in rows}
+
+
+@DB_QUERY_LATENCY.time(query='get_daily_usage')
+def get_daily_usage(days=30):
+    """Rollups of the most recent days with results, newest first"""
+    with connection() as conn:
+        rows = conn.execute("SELECT * FROM daily_usage ORDER BY day DESC LIMIT ?", (days,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def backfill(conn):
+    """Roll up the results stored before the rollup tables existed"""
+    rows = conn.execute(
+        "SELECT r.batch_id, date(COALESCE(b.results_ingested_at, CURRENT_TIMESTAMP)) AS day, "
+        "r.result_type, r.model, r.input_tokens, r.output_tokens, r.cache_creation_tokens, r.cache_read_tokens "
+        "FROM batch_results r LEFT JOIN batches b ON b.batch_id = r.batch_id ORDER BY r.batch_id")
+    batch_rows = []
+    batch_key = None
+    for row in rows:
+        key = (row['batch_id'], row['day'])
+        if key != batch_key and batch_rows:
+            record_usage(conn, batch_key[0], batch_rows, day=batch_key[1])
+            batch_rows = []
+        batch_key = key
+        batch_rows.append((row['result_type'], row['model'], row['input_tokens'], row['output_tokens'],
+                           row['cache_creation_tokens'], row['cache_read_tokens']))
+    if batch_rows:
+        record_usage(conn, batch_key[0], batch_rows, day=batch_key[1])
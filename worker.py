@@ -0,0 +1,37 @@
+"""Standalone batch monitor.
+
+Runs the polling loop outside of the Streamlit app. Pending batches are read
+from the database, and a lease in the database makes sure only one worker
+polls at a time; if it dies another worker takes over once the lease expires.
+
+Run the web app with EMBEDDED_MONITOR=false when using this worker.
+"""
+import logging
+import signal
+
+from batch_monitor import BatchMonitor
+from database import init_db
+
+
+def main():
+    init_db()
+
+    BatchMonitor.autostart = False
+    monitor = BatchMonitor()
+
+    def shutdown(signum, frame):
+        logging.info(f"Received signal {signum}, stopping monitor")
+        monitor.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logging.info(f"Monitor worker {monitor.worker_id} started")
+    monitor.run_monitor()
+
+    # Flush notifications that are still waiting for their digest window
+    monitor.notifier.stop()
+
+
+if __name__ == "__main__":
+    main()